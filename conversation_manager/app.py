@@ -1,12 +1,66 @@
 from flask import Flask
+from typing import Optional
+import logging
+import os
 import sys
 from pathlib import Path
 sys.path.append(str(Path(__file__).resolve().parent.parent))
-from routes.core_bot_routes import bp as core_bp
 
+logger = logging.getLogger(__name__)
+
+
+def warm_up_on_start() -> bool:
+    """WARM_UP_ON_START (activo por defecto): crear el CoreBot y verificar la base al arrancar."""
+    return os.getenv("WARM_UP_ON_START", "1").strip().lower() in ("1", "true", "yes", "on")
+
+
+def warm_up_bot():
+    """
+    Crea el CoreBot del proceso, abre la conexión a la base y verifica índices. Si la base no
+    responde, la app arranca igual y /readyz devuelve 503 hasta que un reintento tenga éxito.
+    """
+    from routes.core_bot_routes import get_bot
+    result = get_bot().warm_up()
+    if result["ready"]:
+        logger.info("[WARM_UP]: listo en %s", result["timings"])
+    elif not result["unique_identifiers"]:
+        logger.error("[WARM_UP]: faltan los índices únicos de contactos (ejecutar scripts/dedupe_transmitters.py); /readyz reintentará")
+    else:
+        logger.warning("[WARM_UP]: la base no respondió; /readyz reintentará")
+
+
+def create_app(warm_up: Optional[bool] = None) -> Flask:
+    """
+    App factory: usada por gunicorn (ver gunicorn.conf.py) y por `flask run`.
+
+    Con `warm_up` (por defecto WARM_UP_ON_START) hace el warm-up (`warm_up_bot`) antes de atender
+    la primera petición. Con GUNICORN_PRELOAD la app se crea en el master sin warm-up: el CoreBot
+    y sus clientes no deben heredarse, cada worker los crea tras el fork (ver gunicorn.conf.py).
+    """
+    from configs.logging_config import configure_logging
+    configure_logging()
+
+    from routes.core_bot_routes import bp as core_bp
+    from routes.health import register_health
+    from routes.json_provider import BsonJSONProvider
+    from routes.metrics import register_metrics
+
+    app = Flask(__name__)
+    # jsonify serializa ObjectId/datetime/Decimal128 directamente (orjson si está disponible)
+    app.json = BsonJSONProvider(app)
+    app.register_blueprint(core_bp, url_prefix='/api')
+    # latencia por ruta y GET /metrics (si prometheus_client está instalado)
+    register_metrics(app)
+    # /healthz y /readyz
+    register_health(app)
+
+    if warm_up is None:
+        warm_up = warm_up_on_start()
+    if warm_up:
+        warm_up_bot()
+    return app
 
-app = Flask(__name__)
-app.register_blueprint(core_bp, url_prefix='/api')
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # Servidor de desarrollo; en producción usar: gunicorn -c gunicorn.conf.py
+    create_app().run(host='0.0.0.0', port=int(os.getenv('PORT', 5000)), debug=os.getenv('FLASK_DEBUG', '1') == '1')
@@ -0,0 +1,265 @@
+"""
+Suite de benchmarks del camino de ingesta y de las lecturas principales:
+
+- core_bot.process_message: sesión nueva, sesión existente (con y sin cache de sesiones)
+- transmitter.get_sessions_by_phone con N sesiones por contacto
+- conversation.get_conversation con N mensajes de historial (completo y últimos 20)
+- http.process_message: POST /api/process_message de punta a punta con el test client de Flask
+- cold_start: proceso nuevo -> import de la app -> create_app (con warm-up) -> primera respuesta
+
+Corre sin red contra un sustituto en memoria (mongomock, `pip install mongomock`), contra un
+mongod local (--mongo-uri) o contra los backends embebidos (STORAGE_BACKEND=sqlite | memory);
+WRITE_BEHIND_MODE=provisional | durable mide la escritura diferida de los mensajes. Cada caso escribe una línea JSON con throughput (ops/s) y latencias
+p50/p95/p99 en ms, junto con el commit y el backend, para comparar resultados entre commits.
+
+Uso:
+    python benchmarks/bench_core_bot.py [--mongo-uri mongodb://localhost:27017] [--iterations 500]
+                                        [--sizes 10,100,1000] [--only process_message] [--output results.jsonl]
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import uuid
+from pathlib import Path
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.append(str(ROOT))
+
+DB_NAME = f"bench_{uuid.uuid4().hex[:8]}"
+os.environ["DB_MONGO_NAME"] = DB_NAME
+
+from configs.config import set_mongo_client, close_mongo_client
+from modules.conversation import ARCHIVE_COLLECTION
+
+SEND_DATA = {"audio": None, "image": None, "location": None, "document": None, "video": None}
+TOKENS = {"prompt_tokens": 120, "completion_tokens": 40, "total_tokens": 160}
+
+
+def content(i: int) -> dict:
+    return {"role": "user", "text": f"Hola, quisiera consultar el estado de mi pedido número {i} por favor."}
+
+
+def percentile(sorted_values, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def measure(name: str, fn, iterations: int, warmup: int, **params) -> dict:
+    """Ejecuta fn(i) `warmup` + `iterations` veces y resume las latencias de las iteraciones medidas."""
+    for i in range(warmup):
+        fn(-1 - i)
+    latencies = []
+    start = time.perf_counter()
+    for i in range(iterations):
+        t0 = time.perf_counter_ns()
+        fn(i)
+        latencies.append((time.perf_counter_ns() - t0) / 1e6)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "case": name,
+        **params,
+        "iterations": iterations,
+        "ops_per_s": round(iterations / elapsed, 1) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 50), 4),
+        "p95_ms": round(percentile(latencies, 95), 4),
+        "p99_ms": round(percentile(latencies, 99), 4),
+        "max_ms": round(latencies[-1], 4) if latencies else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def build_client(mongo_uri):
+    if mongo_uri:
+        from pymongo import MongoClient
+        return MongoClient(mongo_uri, tz_aware=True, serverSelectionTimeoutMS=2000), "mongod"
+    try:
+        import mongomock
+    except ImportError:
+        sys.exit("[BENCH]: instale mongomock (pip install mongomock) o indique --mongo-uri de un mongod local.")
+    ignore_bulk_options(mongomock)
+    client = mongomock.MongoClient(tz_aware=True)
+    # mongomock no soporta opciones de almacenamiento (zstd): se crea el archivo sin ellas
+    client[DB_NAME].create_collection(ARCHIVE_COLLECTION)
+    return client, "mongomock"
+
+
+def ignore_bulk_options(mongomock):
+    """
+    pymongo >= 4.9 pasa `sort` (y otras opciones) a cada operación de un bulk_write, que mongomock
+    todavía no acepta: sin esto fallan los lotes (process_messages, escritura diferida, token_usage).
+    """
+    from mongomock.collection import BulkOperationBuilder
+    for name in ("add_update", "add_replace", "add_delete"):
+        original = getattr(BulkOperationBuilder, name, None)
+        if original is None:
+            continue
+
+        def wrapper(self, *args, _original=original, **kwargs):
+            for option in ("sort", "hint", "collation", "namespace"):
+                kwargs.pop(option, None)
+            return _original(self, *args, **kwargs)
+        setattr(BulkOperationBuilder, name, wrapper)
+
+
+def bench_process_message(bot, iterations, warmup, sizes):
+    run = uuid.uuid4().hex[:6]
+    yield measure("core_bot.process_message", lambda i: bot.process_message(content(i), TOKENS, SEND_DATA, phone=f"new-{run}-{i}"), iterations, warmup, session="new")
+    yield measure("core_bot.process_message", lambda i: bot.process_message(content(i), TOKENS, SEND_DATA, phone=f"existing-{run}"), iterations, warmup, session="existing", cache=bot.session_cache is not None)
+    cache, bot.session_cache = bot.session_cache, None
+    try:
+        yield measure("core_bot.process_message", lambda i: bot.process_message(content(i), TOKENS, SEND_DATA, phone=f"nocache-{run}"), iterations, warmup, session="existing", cache=False)
+    finally:
+        bot.session_cache = cache
+
+
+def bench_get_sessions(bot, iterations, warmup, sizes):
+    transmitter = bot.transmitter_module
+    for n in sizes:
+        phone = f"sessions-{n}-{uuid.uuid4().hex[:6]}"
+        for i in range(n):
+            transmitter.add_session(f"{phone}-{i}", phone=phone)
+        yield measure("transmitter.get_sessions_by_phone", lambda i: transmitter.get_sessions_by_phone(phone), iterations, warmup, sessions=n)
+        yield measure("transmitter.get_sessions_by_phone", lambda i: transmitter.get_sessions_by_phone(phone, limit=1), iterations, warmup, sessions=n, limit=1)
+
+
+def bench_get_conversation(bot, iterations, warmup, sizes):
+    conversation = bot.conversation_module
+    for n in sizes:
+        session_id = conversation.generate_id()
+        conversation.new_conversation(content(0), TOKENS, SEND_DATA, transmitter=f"history-{n}", session_id=session_id)
+        for i in range(1, n):
+            conversation.add_message(session_id, content(i), TOKENS, SEND_DATA)
+        yield measure("conversation.get_conversation", lambda i: conversation.get_conversation(session_id), iterations, warmup, messages=n)
+        yield measure("conversation.get_conversation", lambda i: conversation.get_conversation(session_id, history_limit=20), iterations, warmup, messages=n, history_limit=20)
+
+
+def bench_http(bot, iterations, warmup, sizes):
+    from app import create_app
+    client = create_app().test_client()
+    run = uuid.uuid4().hex[:6]
+
+    def post(i):
+        response = client.post("/api/process_message", json={"content": content(i), "tokens": TOKENS, "send_data": SEND_DATA, "phone": f"http-{run}"})
+        assert response.status_code == 200, response.status_code
+
+    yield measure("http.process_message", post, iterations, warmup, session="existing")
+
+
+# Proceso hijo del caso cold_start: mide import, create_app (warm-up incluido) y la primera petición.
+# Con mongomock el cliente se instala antes de importar la app (su import no se cuenta).
+COLD_START_CHILD = r"""
+import json, os, sys, time
+sys.path.insert(0, {root!r})
+os.environ["DB_MONGO_NAME"] = {db_name!r}
+mongo_uri = {mongo_uri!r}
+from configs.config import set_mongo_client
+if os.getenv("STORAGE_BACKEND", "mongo").strip().lower() == "mongo":
+    if mongo_uri:
+        from pymongo import MongoClient
+        set_mongo_client(MongoClient(mongo_uri, tz_aware=True, serverSelectionTimeoutMS=2000))
+    else:
+        import mongomock
+        client = mongomock.MongoClient(tz_aware=True)
+        client[{db_name!r}].create_collection("conversation_archive")
+        set_mongo_client(client)
+t0 = time.perf_counter()
+from app import create_app
+import routes.core_bot_routes
+t1 = time.perf_counter()
+app = create_app()
+t2 = time.perf_counter()
+response = app.test_client().post("/api/process_message", json={payload!r})
+t3 = time.perf_counter()
+assert response.status_code == 200, response.status_code
+print(json.dumps({{"import_ms": (t1 - t0) * 1000, "create_app_ms": (t2 - t1) * 1000, "first_request_ms": (t3 - t2) * 1000}}))
+"""
+
+
+def bench_cold_start(bot, iterations, warmup, sizes):
+    options = getattr(bot, "cold_start_options", {})
+    child = COLD_START_CHILD.format(
+        root=str(ROOT), db_name=DB_NAME, mongo_uri=options.get("mongo_uri"),
+        payload={"content": content(0), "tokens": TOKENS, "send_data": SEND_DATA, "phone": f"cold-{uuid.uuid4().hex[:6]}"},
+    )
+    breakdowns = []
+
+    def run(i):
+        out = subprocess.run([sys.executable, "-c", child], cwd=ROOT, capture_output=True, text=True, timeout=120)
+        if out.returncode != 0:
+            raise RuntimeError(f"[BENCH]: cold start falló: {out.stderr.strip()[-500:]}")
+        if i >= 0:
+            breakdowns.append(json.loads(out.stdout.strip().splitlines()[-1]))
+
+    # latencias: desde el arranque del intérprete hasta la primera respuesta (proceso completo)
+    result = measure("cold_start", run, options.get("runs", 5), 1)
+    for key in ("import_ms", "create_app_ms", "first_request_ms"):
+        values = sorted(b[key] for b in breakdowns)
+        result[f"{key[:-3]}_p50_ms"] = round(percentile(values, 50), 4)
+    yield result
+
+
+CASES = {
+    "process_message": bench_process_message,
+    "get_sessions": bench_get_sessions,
+    "get_conversation": bench_get_conversation,
+    "http": bench_http,
+    "cold_start": bench_cold_start,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks de CoreBot y de la API HTTP.")
+    parser.add_argument("--mongo-uri", default=os.getenv("BENCH_MONGO_URI"), help="mongod local; sin valor se usa mongomock")
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--sizes", default="10,100,1000", help="tamaños de sesiones / historial")
+    parser.add_argument("--only", action="append", choices=sorted(CASES), help="ejecutar sólo estos casos")
+    parser.add_argument("--cold-starts", type=int, default=5, help="procesos lanzados por el caso cold_start")
+    parser.add_argument("--output", help="archivo JSONL al que se agregan los resultados")
+    args = parser.parse_args()
+
+    storage = os.getenv("STORAGE_BACKEND", "mongo").strip().lower()
+    client, backend = (None, storage) if storage != "mongo" else build_client(args.mongo_uri)
+    if client is not None:
+        set_mongo_client(client)
+    # las rutas usan el CoreBot del proceso: se construye una sola vez, ya con el cliente instalado
+    from routes.core_bot_routes import get_bot
+    bot = get_bot()
+    bot.warm_up()
+    bot.cold_start_options = {"mongo_uri": args.mongo_uri, "runs": args.cold_starts}
+
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    meta = {"commit": git_commit(), "backend": backend, "python": platform.python_version(), "layout": bot.conversation_module.layout, "write_behind": bot.write_behind.ack if bot.write_behind else None}
+    out = open(args.output, "a") if args.output else None
+    try:
+        for name in args.only or CASES:
+            for result in CASES[name](bot, args.iterations, args.warmup, sizes):
+                line = json.dumps({"benchmark": "core_bot", **meta, **result})
+                print(line, flush=True)
+                if out:
+                    out.write(line + "\n")
+    finally:
+        if out:
+            out.close()
+        if client is not None:
+            try:
+                client.drop_database(DB_NAME)
+            except Exception:
+                pass
+            close_mongo_client()
+
+
+if __name__ == "__main__":
+    main()
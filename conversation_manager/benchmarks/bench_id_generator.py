@@ -0,0 +1,93 @@
+"""
+Benchmark del generador de IDs: rendimiento (IDs/s) y duplicados de `modules.id_generator`
+frente al esquema anterior (timestamp en ms + randint(1000, 9999)).
+
+Genera --count IDs repartidos entre --threads hilos en el proceso actual y, opcionalmente,
+en --processes procesos bifurcados (fork), y verifica que no haya duplicados ni desorden.
+
+Uso:
+    python benchmarks/bench_id_generator.py [--count 2000000] [--threads 4] [--processes 0]
+"""
+import argparse
+import json
+import multiprocessing
+import random
+import sys
+import threading
+import time
+from pathlib import Path
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from modules.id_generator import new_id
+
+
+def legacy_id():
+    timestamp = int(time.time() * 1000)
+    random_suffix = random.randint(1000, 9999)
+    return f"{timestamp}{random_suffix}"
+
+
+def generate(fn, count: int, threads: int):
+    """Genera `count` IDs con `fn` en `threads` hilos; devuelve (lista por hilo, segundos)."""
+    per_thread = count // threads
+    results = [None] * threads
+
+    def worker(i):
+        results[i] = [fn() for _ in range(per_thread)]
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return results, time.perf_counter() - start
+
+
+def _child(count, threads, queue):
+    results, _ = generate(new_id, count, threads)
+    queue.put([i for chunk in results for i in chunk])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del generador de IDs.")
+    parser.add_argument("--count", type=int, default=2_000_000)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--processes", type=int, default=0, help="procesos hijos adicionales (fork)")
+    args = parser.parse_args()
+
+    legacy, legacy_s = generate(legacy_id, args.count, args.threads)
+    legacy_all = [i for chunk in legacy for i in chunk]
+
+    current, current_s = generate(new_id, args.count, args.threads)
+    current_all = [i for chunk in current for i in chunk]
+    # cada hilo debe ver IDs estrictamente crecientes
+    ordered = all(all(a < b for a, b in zip(chunk, chunk[1:])) for chunk in current)
+
+    if args.processes:
+        ctx = multiprocessing.get_context("fork")
+        queue = ctx.Queue()
+        procs = [ctx.Process(target=_child, args=(args.count, args.threads, queue)) for _ in range(args.processes)]
+        for p in procs:
+            p.start()
+        for _ in procs:
+            current_all.extend(queue.get())
+        for p in procs:
+            p.join()
+
+    print(json.dumps({
+        "benchmark": "id_generator",
+        "threads": args.threads,
+        "processes": 1 + args.processes,
+        "legacy_ids": len(legacy_all),
+        "legacy_duplicates": len(legacy_all) - len(set(legacy_all)),
+        "legacy_ids_per_s": round(len(legacy_all) / legacy_s),
+        "ids": len(current_all),
+        "duplicates": len(current_all) - len(set(current_all)),
+        "ids_per_s": round(args.count / current_s),
+        "monotonic_per_thread": ordered,
+    }))
+
+
+if __name__ == "__main__":
+    main()
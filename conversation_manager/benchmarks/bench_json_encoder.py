@@ -0,0 +1,79 @@
+"""
+Micro-benchmark de la serialización de respuestas: compara el camino anterior (recorrido
+recursivo `_serialize` + json estándar con sort_keys, como hacía Flask por defecto) con
+`routes.json_provider.dumps_bytes` (una sola pasada, orjson si está instalado).
+
+Uso:
+    python benchmarks/bench_json_encoder.py [--messages 2000] [--repeat 50]
+"""
+import argparse
+import json
+import sys
+import timeit
+from datetime import datetime, timezone
+from pathlib import Path
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from bson.objectid import ObjectId
+from routes.json_provider import dumps_bytes, orjson
+
+
+def build_conversation(n_messages: int) -> dict:
+    return {
+        "_id": ObjectId(),
+        "session_id": "17000000000001234",
+        "state": [{"name": "step", "value": "menu"}],
+        "transmitter": "595981000000",
+        "created_at": datetime.now(timezone.utc),
+        "message": [
+            {
+                "message_id": f"1700000000{i:07d}",
+                "role": "user" if i % 2 else "bot",
+                "tokens": {"prompt_tokens": 120, "completion_tokens": 40, "total_tokens": 160},
+                "content": "Hola, quisiera consultar el estado de mi pedido número %d por favor." % i,
+                "send": {"audio": None, "image": None, "location": None, "document": None, "video": None},
+                "hour": "12:00:00",
+            }
+            for i in range(n_messages)
+        ],
+    }
+
+
+def legacy_dumps(result) -> bytes:
+    def _serialize(obj):
+        if isinstance(obj, ObjectId):
+            return str(obj)
+        if isinstance(obj, datetime):
+            return obj.isoformat()
+        if isinstance(obj, dict):
+            return {k: _serialize(v) for k, v in obj.items()}
+        if isinstance(obj, list):
+            return [_serialize(v) for v in obj]
+        return obj
+    return (json.dumps(_serialize(result), ensure_ascii=False, sort_keys=True) + "\n").encode("utf-8")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del encoder JSON de respuestas.")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    result = {"success": True, "session_id": "17000000000001234", "created": False, "conversation": build_conversation(args.messages)}
+    assert json.loads(legacy_dumps(result)) == json.loads(dumps_bytes(result))
+
+    legacy = min(timeit.repeat(lambda: legacy_dumps(result), number=1, repeat=args.repeat))
+    current = min(timeit.repeat(lambda: dumps_bytes(result), number=1, repeat=args.repeat))
+    print(json.dumps({
+        "benchmark": "json_encoder",
+        "messages": args.messages,
+        "encoder": "orjson" if orjson is not None else "json",
+        "legacy_ms": round(legacy * 1000, 3),
+        "current_ms": round(current * 1000, 3),
+        "speedup": round(legacy / current, 2) if current else None,
+        "bytes": len(dumps_bytes(result)),
+    }))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,124 @@
 from pymongo import MongoClient
-from pymongo.errors import ServerSelectionTimeoutError  
+import pymongo
+from pymongo.errors import ServerSelectionTimeoutError, PyMongoError
 from dotenv import load_dotenv
+from modules.metrics import mongo_event_listeners
+import atexit
+import logging
 import os
+import threading
+
+logger = logging.getLogger(__name__)
 
 load_dotenv()
 
+# Cliente MongoDB compartido por todo el proceso (Conversation, Transmitter, ...).
+# Se crea de forma perezosa y se reconstruye si el proceso fue bifurcado (fork),
+# ya que un MongoClient no debe reutilizarse entre procesos.
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def mongo_client_options() -> dict:
+    """
+    Opciones del pool de conexiones leídas de variables de entorno:
+
+    - DB_MONGO_MAX_POOL_SIZE (100), DB_MONGO_MIN_POOL_SIZE (0)
+    - DB_MONGO_WAIT_QUEUE_TIMEOUT_MS (5000): espera máxima por una conexión libre del pool
+    - DB_MONGO_SERVER_SELECTION_TIMEOUT_MS (5000), DB_MONGO_CONNECT_TIMEOUT_MS (5000)
+    - DB_MONGO_RETRY_WRITES (true)
+    - DB_MONGO_COMPRESSORS (p.ej. "zstd,snappy,zlib"; vacío = sin compresión)
+
+    Las fechas BSON se leen como datetime UTC con zona horaria (tz_aware).
+    Si las métricas están activas se registra un CommandListener (duración y tamaño por comando).
+    """
+    options = {
+        "maxPoolSize": _env_int("DB_MONGO_MAX_POOL_SIZE", 100),
+        "minPoolSize": _env_int("DB_MONGO_MIN_POOL_SIZE", 0),
+        "waitQueueTimeoutMS": _env_int("DB_MONGO_WAIT_QUEUE_TIMEOUT_MS", 5000),
+        "serverSelectionTimeoutMS": _env_int("DB_MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000),
+        "connectTimeoutMS": _env_int("DB_MONGO_CONNECT_TIMEOUT_MS", 5000),
+        "retryWrites": _env_bool("DB_MONGO_RETRY_WRITES", True),
+        "tz_aware": True,
+    }
+    listeners = mongo_event_listeners()
+    if listeners:
+        options["event_listeners"] = listeners
+    compressors = os.getenv("DB_MONGO_COMPRESSORS", "").strip()
+    if compressors:
+        options["compressors"] = compressors
+    return options
+
+
+def get_mongo_client(uri: str) -> MongoClient:
+    """
+    Devuelve el MongoClient compartido del proceso, creándolo si hace falta.
+    """
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+    with _client_lock:
+        if _client is None or _client_pid != pid:
+            _client = MongoClient(uri, **mongo_client_options())
+            _client_pid = pid
+        return _client
+
+
+def set_mongo_client(client):
+    """
+    Instala un cliente ya construido como cliente compartido del proceso (p.ej. un mongod local
+    o un sustituto en memoria para benchmarks). Debe llamarse antes de crear los módulos.
+    """
+    global _client, _client_pid
+    with _client_lock:
+        _client = client
+        _client_pid = os.getpid()
+
+
+def close_mongo_client():
+    """
+    Cierra el MongoClient compartido (se registra con atexit para un apagado limpio).
+    """
+    global _client, _client_pid
+    with _client_lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        _client = None
+        _client_pid = None
+
+
+def reset_mongo_client():
+    """
+    Descarta el cliente heredado del proceso padre sin cerrarlo (sus sockets pertenecen al padre).
+    Debe llamarse en el hijo tras un fork; el próximo `get_mongo_client` crea uno nuevo.
+    """
+    global _client, _client_pid, _client_lock
+    _client = None
+    _client_pid = None
+    _client_lock = threading.Lock()
+
+
+atexit.register(close_mongo_client)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_mongo_client)
+
+
 class Database_conversation:
     def __init__(self,):
         """
@@ -20,28 +134,49 @@ class Database_conversation:
 
     def connect(self):
         """
-        Conecta a la base de datos de MongoDB especificada.
+        Conecta a la base de datos de MongoDB especificada usando el cliente compartido del proceso.
         """
         try:
-            self.client = MongoClient(self.uri)
+            self.client = get_mongo_client(self.uri)
             self.db = self.client[self.db_name]
         except ServerSelectionTimeoutError  as e:
-            print(f"[ERROR_DATABASE_CONVERSATION]: Error al conectar a MongoDB: {e}")
+            logger.error("[ERROR_DATABASE_CONVERSATION]: Error al conectar a MongoDB: %s", e)
             raise
 
+    def ping(self, timeout: float = None) -> bool:
+        """
+        Comprueba que MongoDB responde. `timeout` (segundos) acota la espera, en lugar de
+        serverSelectionTimeoutMS. La primera llamada abre la conexión inicial del pool.
+        """
+        if self.db is None:
+            self.connect()
+        try:
+            if timeout:
+                with pymongo.timeout(timeout):
+                    self.db.command("ping")
+            else:
+                self.db.command("ping")
+            return True
+        except PyMongoError as e:
+            logger.warning("[DATABASE_CONVERSATION]: MongoDB no responde: %s", e)
+            return False
+
     def close_connection(self):
         """
         Cierra la conexión a la base de datos de MongoDB.
+        El cliente es compartido: cerrarlo afecta a todos los módulos del proceso.
         """
         if self.client:
-            self.client.close()
+            close_mongo_client()
+            self.client = None
+            self.db = None
         else:
-            print("[DATABASE_CONVERSATION]: No hay conexión activa a MongoDB.")
+            logger.warning("[DATABASE_CONVERSATION]: No hay conexión activa a MongoDB.")
 
     def get_collection(self, collection_name: str):
         """
         Obtiene una colección de la base de datos.
-        
+
         :param collection_name: Nombre de la colección.
         :return: Colección de MongoDB.
         """
@@ -49,4 +184,3 @@ class Database_conversation:
             return self.db[collection_name]
         else:
             raise RuntimeError("[ERROR_DATABASE_CONVERSATION]: No hay conexión activa a la base de datos. Conéctese primero.")
-
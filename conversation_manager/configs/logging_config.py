@@ -0,0 +1,47 @@
+import json
+import logging
+import os
+import sys
+from datetime import datetime, timezone
+
+_configured = False
+
+
+class JsonFormatter(logging.Formatter):
+    """Una línea JSON por registro: ts, level, logger, message (y exc_info si lo hay)."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "pid": record.process,
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def configure_logging():
+    """
+    Configura el logging del proceso una sola vez:
+
+    - LOG_LEVEL (INFO): DEBUG incluye p.ej. cada conversación creada.
+    - LOG_FORMAT (text | json): json emite una línea JSON por registro, para agregadores de logs.
+    """
+    global _configured
+    if _configured:
+        return
+    handler = logging.StreamHandler(sys.stderr)
+    if os.getenv("LOG_FORMAT", "text").strip().lower() == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s"))
+    root = logging.getLogger()
+    root.addHandler(handler)
+    try:
+        root.setLevel(os.getenv("LOG_LEVEL", "INFO").strip().upper())
+    except ValueError:
+        root.setLevel(logging.INFO)
+    _configured = True
@@ -1,18 +1,66 @@
 # core_bot.py
-from typing import Callable, Dict, Any, Optional, List
+from typing import Callable, Dict, Any, Optional, List, Iterator
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import base64
 import sys
+import time
+from datetime import datetime, timezone, timedelta
 from pathlib import Path
+from bson import json_util
 sys.path.append(str(Path(__file__).resolve().parent.parent))
-from modules.conversation import Conversation  
-from modules.transmitter import Transmitter
+from modules.storage import build_storage, as_utc_datetime, STATE_MODE_KEYED, USAGE_FIELDS, conversation_version, split_version
+from modules.session_cache import build_session_cache
+from modules.write_behind import build_write_behind, ACK_DURABLE
+from modules import metrics
+from modules.search import query_terms, rank
+from modules.live_updates import build_live_updates
+
+SESSION_WINDOW = timedelta(hours=24)
+# coincidencias (las más recientes) que se puntúan por búsqueda
+SEARCH_MAX_CANDIDATES = 1000
 
 class CoreBot:
     """
-    CoreBot: orquesta la conversación, persiste con Conversation (Mongo) y enruta a handlers/flows.
+    CoreBot: orquesta la conversación, persiste con el backend de STORAGE_BACKEND (Mongo por defecto,
+    ver modules.storage) y enruta a handlers/flows.
     """
     def __init__(self):
-        self.conversation_module = Conversation()
-        self.transmitter_module = Transmitter()
+        self.conversation_module, self.transmitter_module = build_storage()
+        # cache identificador -> session_id activo (None si SESSION_CACHE_BACKEND=none)
+        self.session_cache = build_session_cache()
+        # cola de escritura diferida para mensajes de sesiones existentes (None si WRITE_BEHIND_MODE=off)
+        self.write_behind = build_write_behind(self.conversation_module)
+        # eventos en vivo de mensajes y estados para /api/stream (None si están desactivados, ver build_live_updates)
+        self.live_updates = build_live_updates(self.conversation_module)
+        # True tras un warm_up exitoso (la base respondió); lo usa /readyz
+        self.ready = False
+
+    def warm_up(self) -> Dict[str, Any]:
+        """
+        Prepara el proceso para atender peticiones: ping a la base (abre la primera conexión del
+        pool; el resto hasta DB_MONGO_MIN_POOL_SIZE se abre en segundo plano) y verificación de
+        índices. No lanza excepciones: si la base no responde, `ready` queda en False.
+        Tampoco se declara listo si faltan los índices únicos de contactos (colección con
+        duplicados): sin ellos dos workers pueden crear sesiones paralelas para un mismo contacto.
+        Retorna {"ready": bool, "indexes": bool, "unique_identifiers": bool, "timings": {"ping_ms", "indexes_ms"}}.
+        """
+        timings: Dict[str, float] = {}
+        t0 = time.perf_counter()
+        reachable = self.conversation_module.ping()
+        timings["ping_ms"] = self._elapsed_ms(t0)
+        indexes = False
+        if reachable:
+            t0 = time.perf_counter()
+            conversation_ok = self.conversation_module.warm_up()
+            indexes = self.transmitter_module.warm_up() and conversation_ok
+            timings["indexes_ms"] = self._elapsed_ms(t0)
+        unique_identifiers = self.transmitter_module.unique_identifiers
+        self.ready = reachable and unique_identifiers
+        return {"ready": self.ready, "indexes": indexes, "unique_identifiers": unique_identifiers, "timings": timings}
+
+    def is_ready(self, timeout: Optional[float] = None) -> bool:
+        """True si ya hubo un warm_up exitoso y la base responde ahora (acotado por `timeout` segundos)."""
+        return self.ready and self.conversation_module.ping(timeout)
 
     # ----------------- utilitarios -----------------
     def _pick_primary_identifier(self, phone: Optional[str], email: Optional[str], chat_id: Optional[str], meta_id: Optional[str]) -> Optional[str]:
@@ -22,20 +70,69 @@ class CoreBot:
                 return str(v).strip()
         return None
 
-    def _is_timestamp_within_24h(self, iso_ts: str) -> bool:
-        from datetime import datetime, timezone, timedelta
-        try:
-            ts = datetime.fromisoformat(iso_ts)
-            # asegurar tz-aware
-            if ts.tzinfo is None:
-                ts = ts.replace(tzinfo=timezone.utc)
-            now = datetime.now(timezone.utc)
-            return (now - ts) < timedelta(hours=24)
-        except Exception:
-            return False
+    def _pick_primary_field(self, phone: Optional[str], email: Optional[str], chat_id: Optional[str], meta_id: Optional[str]) -> Optional[str]:
+        """Devuelve el nombre del campo usado por `_pick_primary_identifier` (phone, email, chat_id o meta_id)."""
+        for field, v in (("phone", phone), ("email", email), ("chat_id", chat_id), ("meta_id", meta_id)):
+            if v and str(v).strip():
+                return field
+        return None
+
+    def _session_expires_at(self, ts) -> Optional[datetime]:
+        """
+        Devuelve el momento (UTC) en que se cierra la ventana de 24h de una sesión, o None si el timestamp es inválido.
+        `ts` es un datetime (BSON date) o, en documentos antiguos, un string ISO.
+        """
+        ts = as_utc_datetime(ts)
+        return ts + SESSION_WINDOW if ts is not None else None
+
+    def _is_timestamp_within_24h(self, ts) -> bool:
+        expires_at = self._session_expires_at(ts)
+        return expires_at is not None and datetime.now(timezone.utc) < expires_at
+
+    def cache_stats(self) -> Dict[str, Any]:
+        """Contadores de la cache de sesiones activas (hits/misses/tamaño)."""
+        if self.session_cache is None:
+            return {"backend": None}
+        return self.session_cache.stats()
+
+    def write_behind_stats(self) -> Dict[str, Any]:
+        """Estado de la cola de escritura diferida (mensajes encolados, lotes escritos, fallidos)."""
+        if self.write_behind is None:
+            return {"ack": None}
+        return self.write_behind.stats()
+
+    def live_updates_stats(self) -> Dict[str, Any]:
+        """Suscriptores conectados y eventos publicados/descartados del hub de eventos en vivo."""
+        if self.live_updates is None:
+            return {"source": None}
+        return self.live_updates.stats()
+
+    def subscribe(self, session_id: Optional[str] = None, transmitter: Optional[str] = None, last_event_id: Optional[str] = None):
+        """
+        Suscripción a los mensajes y estados nuevos de una sesión o de un contacto (ver
+        modules.live_updates). None si los eventos en vivo están desactivados o no hay lugar.
+        """
+        if self.live_updates is None or not (session_id or transmitter):
+            return None
+        return self.live_updates.subscribe(session_id, transmitter, last_event_id)
+
+    def unsubscribe(self, subscription):
+        if self.live_updates is not None:
+            self.live_updates.unsubscribe(subscription)
+
+    def close(self, timeout: Optional[float] = None):
+        """Drena la cola de escritura diferida (si la hay) y cierra los streams antes de apagar el proceso."""
+        if self.write_behind is not None:
+            self.write_behind.close(timeout)
+        if self.live_updates is not None:
+            self.live_updates.close()
+
+    @staticmethod
+    def _elapsed_ms(start: float) -> float:
+        return round((time.perf_counter() - start) * 1000, 3)
 
     # ----------------- flujo principal -----------------
-    def process_message(self, content: Dict[str, Any], tokens: Dict[str, int], send_data: Dict[str, Any], phone: Optional[str] = None, email: Optional[str] = None, chat_id: Optional[str] = None, meta_id: Optional[str] = None) -> Dict[str, Any]:
+    def process_message(self, content: Dict[str, Any], tokens: Dict[str, int], send_data: Dict[str, Any], phone: Optional[str] = None, email: Optional[str] = None, chat_id: Optional[str] = None, meta_id: Optional[str] = None, history: Optional[Dict[str, Any]] = None, ack: Optional[str] = None, external_id: Optional[str] = None) -> Dict[str, Any]:
         """
         Lógica principal: determina la sesión vigente para el transmitter (si existe y <24h) y:
         - Si no existe sesión activa -> crea nueva sesión en `conversation` y la registra en `transmitter`.
@@ -43,49 +140,302 @@ class CoreBot:
 
         Siempre devuelve el historial (documento de conversation) de la sesión usada.
         Retorna dict con keys: 'success', 'session_id', 'created', 'conversation' (documento o None), 'error'
+        y 'timings' (duración en ms de cada etapa: resolución de sesión, escritura y total).
+
+        `history` permite acotar el historial devuelto: {"limit": N} (últimos N mensajes) y/o
+        {"since_message_id": "..."} (mensajes posteriores a ese id).
+
+        Con la cola de escritura diferida activa (WRITE_BEHIND_MODE), el mensaje de una sesión
+        existente se escribe en lote: `ack` ("provisional" | "durable", por defecto el del entorno)
+        indica si se responde al encolarlo o tras confirmarse el lote; la respuesta incluye 'durable'.
+        Si la confirmación durable no llega a tiempo, el mensaje se retira de la cola (error) o, si
+        su lote ya se está escribiendo, se responde con 'pending': True y su 'message_id'.
+
+        `external_id` (id del mensaje en el canal, p.ej. el de WhatsApp) hace idempotente la
+        escritura: si ese mensaje del contacto ya se persistió (por n8n o por
+        workers/whatsapp_consumer.py) no se vuelve a escribir y se responde con 'duplicate': True
+        y el historial ya guardado.
         """
+        key = self._inbound_key(phone, email, chat_id, meta_id, external_id)
+        if key is None:
+            return self._process_message(content, tokens, send_data, phone, email, chat_id, meta_id, history, ack)
+        if not self.conversation_module.claim_inbound(key):
+            return self._duplicate_inbound(phone, email, chat_id, meta_id, history)
+        result = self._process_message(content, tokens, send_data, phone, email, chat_id, meta_id, history, ack)
+        if not result.get("success"):
+            # la escritura falló: el reintento debe poder reservar la clave otra vez
+            self.conversation_module.release_inbound(key)
+        return result
+
+    def _inbound_key(self, phone, email, chat_id, meta_id, external_id) -> Optional[str]:
+        """Clave de idempotencia de un mensaje entrante (id del canal acotado al contacto), o None sin `external_id`."""
+        if not external_id or not str(external_id).strip():
+            return None
+        id_field = self._pick_primary_field(phone, email, chat_id, meta_id)
+        if id_field is None:
+            return None
+        id_value = {"phone": phone, "email": email, "chat_id": chat_id, "meta_id": meta_id}[id_field]
+        return f"{id_field}:{str(id_value).strip()}:{str(external_id).strip()}"
+
+    def _duplicate_inbound(self, phone, email, chat_id, meta_id, history) -> Dict[str, Any]:
+        """Respuesta de `process_message` para un mensaje ya persistido: la sesión activa y su historial, sin escribir."""
+        history = history or {}
+        id_field = self._pick_primary_field(phone, email, chat_id, meta_id)
+        id_value = {"phone": phone, "email": email, "chat_id": chat_id, "meta_id": meta_id}[id_field]
+        session_id = self.session_cache.get(f"{id_field}:{id_value}") if self.session_cache is not None else None
+        if session_id is None:
+            try:
+                latest_session = self.transmitter_module.get_latest_session(id_field, id_value, window=SESSION_WINDOW)
+            except Exception:
+                latest_session = None
+            session_id = latest_session.get("session_id") if latest_session else None
+        convo = None
+        if session_id:
+            convo = self.conversation_module.get_conversation(session_id, history_limit=history.get("limit"), since_message_id=history.get("since_message_id"))
+        return {"success": True, "duplicate": True, "session_id": session_id, "created": False, "conversation": convo}
+
+    def _process_message(self, content, tokens, send_data, phone, email, chat_id, meta_id, history, ack) -> Dict[str, Any]:
+        history = history or {}
+        history_limit = history.get("limit")
+        since_message_id = history.get("since_message_id")
+        timings: Dict[str, float] = {}
+        t_start = time.perf_counter()
         primary = self._pick_primary_identifier(phone, email, chat_id, meta_id)
         if primary is None:
             return {"success": False, "error": "No transmitter identifier provided"}
 
         # Obtener la última sesión conocida para el identificador
-        sessions = []
-        try:
-            if phone and phone.strip():
-                sessions = self.transmitter_module.get_sessions_by_phone(phone, limit=1, newest_first=True)
-            elif email and email.strip():
-                sessions = self.transmitter_module.get_sessions_by_email(email, limit=1, newest_first=True)
-            elif chat_id and chat_id.strip():
-                sessions = self.transmitter_module.get_sessions_by_chat_id(chat_id, limit=1, newest_first=True)
-            elif meta_id and meta_id.strip():
-                sessions = self.transmitter_module.get_sessions_by_meta_id(meta_id, limit=1, newest_first=True)
-        except Exception:
-            sessions = []
+        t0 = time.perf_counter()
+        id_field = self._pick_primary_field(phone, email, chat_id, meta_id)
+        id_value = {"phone": phone, "email": email, "chat_id": chat_id, "meta_id": meta_id}[id_field]
+        cache_key = f"{id_field}:{id_value}"
+        session_id = self.session_cache.get(cache_key) if self.session_cache is not None else None
+        cache_hit = session_id is not None
+        if self.session_cache is not None:
+            metrics.SESSION_CACHE.labels("hit" if cache_hit else "miss").inc()
+        if session_id is None:
+            # sólo devuelve la sesión si está activa (<24h): el filtro lo resuelve Mongo
+            try:
+                latest_session = self.transmitter_module.get_latest_session(id_field, id_value, window=SESSION_WINDOW)
+            except Exception:
+                latest_session = None
+            if latest_session:
+                session_id = latest_session.get("session_id")
+                expires_at = self._session_expires_at(latest_session.get("timestamp"))
+                if self.session_cache is not None and expires_at is not None:
+                    self.session_cache.set(cache_key, session_id, expires_at)
+        timings["resolve_session_ms"] = self._elapsed_ms(t0)
+
+        new_session_id = None
+        if not session_id:
+            # No hay sesión activa -> reservar una nueva de forma atómica: si otro worker creó
+            # una sesión para el mismo contacto en paralelo, se usa esa en lugar de duplicarla
+            if self.session_cache is not None:
+                self.session_cache.invalidate(cache_key)
+            t0 = time.perf_counter()
+            candidate = self.conversation_module.generate_id()
+            try:
+                session, registered = self.transmitter_module.resolve_or_create_session(candidate, id_field, SESSION_WINDOW, phone=phone, email=email, chat_id=chat_id, meta_id=meta_id)
+            except Exception:
+                session, registered = None, False
+            timings["register_session_ms"] = self._elapsed_ms(t0)
+            if session is None:
+                return {"success": False, "error": "failed to register session"}
+            if registered:
+                new_session_id = candidate
+            else:
+                session_id = session.get("session_id")
+            expires_at = self._session_expires_at(session.get("timestamp"))
+            if self.session_cache is not None and expires_at is not None:
+                self.session_cache.set(cache_key, session.get("session_id"), expires_at)
 
-        latest_session = sessions[0] if sessions else None
+        if session_id and self.write_behind is not None:
+            return self._append_write_behind(session_id, content, tokens, send_data, history_limit, since_message_id, ack, cache_hit, timings, t_start)
 
-        # si hay sesión y está activa (<24h) usamos esa
-        if latest_session and self._is_timestamp_within_24h(latest_session.get("timestamp", "")):
-            session_id = latest_session.get("session_id")
-            # insertar mensaje en conversation
-            res = self.conversation_module.add_message(session_id, content, tokens, send_data)
-            convo = self.conversation_module.get_conversation(session_id, transmitter=primary)
-            return {"success": True, "session_id": session_id, "created": False, "conversation": convo}
+        if session_id:
+            # insertar mensaje y obtener el historial actualizado en un único round trip
+            t0 = time.perf_counter()
+            convo = self.conversation_module.add_message_and_get(session_id, content, tokens, send_data, history_limit=history_limit, since_message_id=since_message_id)
+            timings["append_message_ms"] = self._elapsed_ms(t0)
+            if convo is None:
+                return {"success": False, "session_id": session_id, "error": "failed to add message"}
+            timings["total_ms"] = self._elapsed_ms(t_start)
+            metrics.SESSIONS.labels("reused").inc()
+            return {"success": True, "session_id": session_id, "created": False, "conversation": convo, "cache_hit": cache_hit, "timings": timings}
 
-        # Si no hay sesión o la última expiró -> crear nueva sesión
-        new_conv = self.conversation_module.new_conversation(content, tokens, send_data, transmitter=primary)
+        # Sesión nueva reservada -> crear el documento de conversación con ese session_id
+        t0 = time.perf_counter()
+        new_conv = self.conversation_module.new_conversation(content, tokens, send_data, transmitter=primary, session_id=new_session_id)
+        timings["create_conversation_ms"] = self._elapsed_ms(t0)
         if not new_conv:
-            return {"success": False, "error": "failed to create conversation"}
+            return {"success": False, "session_id": new_session_id, "error": "failed to create conversation"}
+
+        # new_conversation ya devuelve el documento insertado: no hace falta releerlo
+        convo = self.conversation_module.window_messages(new_conv.get("conversation"), history_limit, since_message_id)
+        timings["total_ms"] = self._elapsed_ms(t_start)
+        metrics.SESSIONS.labels("created").inc()
+        return {"success": True, "session_id": new_session_id, "created": True, "transmitter_registered": True, "conversation": convo, "timings": timings}
 
-        new_session_id = new_conv.get("session_id")
-        # registrar sesión en transmitter (upsert)
+    def _append_write_behind(self, session_id, content, tokens, send_data, history_limit, since_message_id, ack, cache_hit, timings, t_start) -> Dict[str, Any]:
+        """Rama de `process_message` con la cola de escritura diferida: encola el mensaje y arma el historial."""
+        t0 = time.perf_counter()
         try:
-            added = self.transmitter_module.add_session(new_session_id, phone=phone, email=email, chat_id=chat_id, meta_id=meta_id)
-        except Exception:
-            added = False
+            entry = self.conversation_module.build_message_entry(content, tokens, send_data)
+        except (KeyError, TypeError) as e:
+            return {"success": False, "session_id": session_id, "error": f"invalid message: {e}"}
+        future = self.write_behind.submit(session_id, entry)
+        durable = (ack or self.write_behind.ack) == ACK_DURABLE
+        in_flight = False
+        if durable:
+            ok = self._wait_write_behind(future, self.write_behind.durable_timeout)
+            if ok is False:
+                return {"success": False, "session_id": session_id, "error": "failed to add message"}
+            # el lote sigue escribiéndose: no es un fallo (reintentarlo duplicaría el mensaje)
+            in_flight = ok is None
+            durable = not in_flight
+        timings["append_message_ms"] = self._elapsed_ms(t0)
+
+        # historial confirmado + mensajes aún en cola (se leen antes para no perder los que se escriban en medio)
+        pending = self.write_behind.pending(session_id)
+        convo = self.conversation_module.get_conversation(session_id, history_limit=history_limit, since_message_id=since_message_id)
+        if convo is None:
+            convo = {"session_id": session_id, "message": []}
+        known = {m.get("message_id") for m in convo.get("message", [])}
+        convo["message"] = convo.get("message", []) + [m for m in pending if m.get("message_id") not in known]
+        convo = self.conversation_module.window_messages(convo, history_limit, since_message_id)
+        timings["total_ms"] = self._elapsed_ms(t_start)
+        metrics.SESSIONS.labels("reused").inc()
+        result = {"success": True, "session_id": session_id, "created": False, "conversation": convo, "cache_hit": cache_hit, "message_id": entry["message_id"], "durable": durable, "timings": timings}
+        if in_flight:
+            result["pending"] = True
+        return result
 
-        convo = self.conversation_module.get_conversation(new_session_id, transmitter=primary)
-        return {"success": True, "session_id": new_session_id, "created": True, "transmitter_registered": added, "conversation": convo}
+    def _wait_write_behind(self, future, timeout: float) -> Optional[bool]:
+        """
+        Espera la confirmación de un mensaje encolado: True/False según el lote. Si vence `timeout`
+        y el mensaje aún no salió de la cola se retira (False: no se escribirá); si ya se está
+        escribiendo devuelve None (pendiente: el resultado llegará igual).
+        """
+        try:
+            return future.result(timeout=max(0.0, timeout))
+        except FutureTimeoutError:
+            return False if self.write_behind.cancel(future) else None
+
+    def process_messages(self, items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Versión en lote de `process_message` para ráfagas de mensajes.
+
+        Cada item: {"content", "tokens", "send_data", "phone", "email", "chat_id", "meta_id"} y
+        opcionalmente "external_id" (ver `process_message`); los repetidos se responden con
+        'duplicate': True sin escribirse.
+        Resuelve las sesiones de todos los identificadores con una sola consulta y escribe con un
+        bulk_write por colección. Los mensajes de un mismo identificador se agregan en orden; si
+        no tiene sesión activa, el primero crea la sesión y los siguientes se agregan a ella.
+
+        Con la cola de escritura diferida activa, los mensajes de sesiones existentes se escriben por
+        la cola (detrás de los ya encolados de la misma sesión) y se espera su confirmación.
+
+        Retorna una lista (mismo orden que `items`) de dicts con keys: 'success', 'session_id',
+        'created', 'message_id' ('pending': True si su lote seguía escribiéndose al vencer
+        WRITE_BEHIND_DURABLE_TIMEOUT) o 'error'. No incluye el historial de la conversación.
+        """
+        results: List[Optional[Dict[str, Any]]] = [None] * len(items)
+        groups: Dict[str, Dict[str, Any]] = {}
+        inbound_keys: Dict[int, str] = {}
+        for i, item in enumerate(items):
+            ids = {f: item.get(f) for f in ("phone", "email", "chat_id", "meta_id")}
+            id_field = self._pick_primary_field(**ids)
+            if id_field is None:
+                results[i] = {"success": False, "error": "No transmitter identifier provided"}
+                continue
+            inbound_key = self._inbound_key(**ids, external_id=item.get("external_id"))
+            if inbound_key is not None:
+                if not self.conversation_module.claim_inbound(inbound_key):
+                    results[i] = {"success": True, "duplicate": True}
+                    continue
+                inbound_keys[i] = inbound_key
+            key = f"{id_field}:{ids[id_field]}"
+            group = groups.setdefault(key, {"id_field": id_field, "id_value": ids[id_field], "ids": ids, "primary": self._pick_primary_identifier(**ids), "key": key, "items": []})
+            try:
+                entry = self.conversation_module.build_message_entry(item["content"], item["tokens"], item["send_data"])
+            except (KeyError, TypeError) as e:
+                results[i] = {"success": False, "error": f"invalid message: {e}"}
+                continue
+            group["items"].append((i, entry))
+
+        # resolver sesiones activas: primero la cache, luego una única consulta (filtrada por la ventana de 24h) para el resto
+        for key, group in groups.items():
+            group["session_id"] = self.session_cache.get(key) if self.session_cache is not None else None
+            if self.session_cache is not None:
+                metrics.SESSION_CACHE.labels("hit" if group["session_id"] is not None else "miss").inc()
+        pending = [(g["id_field"], g["id_value"]) for g in groups.values() if g["session_id"] is None]
+        latest = self.transmitter_module.get_latest_sessions(pending, window=SESSION_WINDOW) if pending else {}
+        for key, group in groups.items():
+            session = latest.get((group["id_field"], group["id_value"]))
+            if group["session_id"] is None and session:
+                group["session_id"] = session.get("session_id")
+                expires_at = self._session_expires_at(session.get("timestamp"))
+                if self.session_cache is not None and expires_at is not None:
+                    self.session_cache.set(key, group["session_id"], expires_at)
+
+        # reservar atómicamente (un bulk_write) las sesiones nuevas de los identificadores sin sesión activa
+        to_create = [g for g in groups.values() if g["items"] and not g["session_id"]]
+        for group in to_create:
+            group["candidate"] = self.conversation_module.generate_id()
+        reserved = self.transmitter_module.resolve_or_create_sessions_bulk(
+            [{"session_id": g["candidate"], "id_field": g["id_field"], **g["ids"]} for g in to_create], SESSION_WINDOW
+        ) if to_create else []
+        for group, (session, registered) in zip(to_create, reserved):
+            if session is None:
+                group["error"] = "failed to register session"
+                continue
+            group["session_id"] = session.get("session_id")
+            group["created"] = registered
+            expires_at = self._session_expires_at(session.get("timestamp"))
+            if self.session_cache is not None and expires_at is not None:
+                self.session_cache.set(group["key"], group["session_id"], expires_at)
+
+        new_conversations, appends = [], {}
+        for group in groups.values():
+            if not group["items"] or group.get("error"):
+                continue
+            entries = [entry for _, entry in group["items"]]
+            if group.get("created"):
+                new_conversations.append(self.conversation_module.build_conversation_doc(group["session_id"], group["primary"], entries))
+            else:
+                appends.setdefault(group["session_id"], []).extend(entries)
+
+        # con escritura diferida, los mensajes de sesiones existentes pasan por la cola: así quedan
+        # detrás de los que ya estaban encolados para la misma sesión (orden por sesión)
+        futures = []
+        if self.write_behind is not None and appends:
+            futures = [(entry["message_id"], self.write_behind.submit(session_id, entry)) for session_id, entries in appends.items() for entry in entries]
+            appends = {}
+        ok = self.conversation_module.bulk_write_messages(new_conversations, appends) if new_conversations or appends else True
+        # message_id -> True/False según su lote, None si sigue escribiéndose (ver `_wait_write_behind`)
+        queued: Dict[str, Optional[bool]] = {}
+        if futures:
+            deadline = time.monotonic() + self.write_behind.durable_timeout
+            for message_id, future in futures:
+                queued[message_id] = self._wait_write_behind(future, deadline - time.monotonic())
+
+        for group in groups.values():
+            for n, (i, entry) in enumerate(group["items"]):
+                if group.get("error"):
+                    results[i] = {"success": False, "error": group["error"]}
+                    continue
+                written = queued.get(entry["message_id"], ok)
+                if written is False:
+                    results[i] = {"success": False, "error": "bulk write failed"}
+                    continue
+                results[i] = {"success": True, "session_id": group["session_id"], "created": bool(group.get("created")) and n == 0, "message_id": entry["message_id"]}
+                if written is None:
+                    results[i]["pending"] = True
+                metrics.SESSIONS.labels("created" if results[i]["created"] else "reused").inc()
+        for i, inbound_key in inbound_keys.items():
+            if not results[i].get("success"):
+                self.conversation_module.release_inbound(inbound_key)
+        return results
 
     # ----------------- consultas simples -----------------
     def get_conversations_by_transmitter_value(self, transmitter_value: str) -> List[Dict[str, Any]]:
@@ -93,11 +443,46 @@ class CoreBot:
         if not transmitter_value:
             return []
         try:
-            docs = list(self.conversation_module.collection.find({"transmitter": transmitter_value}))
-            return docs
+            # incluye las conversaciones archivadas
+            docs = list(self.conversation_module.find_by_transmitter(transmitter_value))
+            return [self.conversation_module.load_messages(d) for d in docs]
         except Exception:
             return []
 
+    def iter_conversations_by_transmitter(self, transmitter_value: str, limit: Optional[int] = None, after: Optional[str] = None, summary: bool = False) -> Iterator[Dict[str, Any]]:
+        """
+        Itera (sin cargar todo en memoria) las conversaciones de `transmitter_value` ordenadas por
+        creación. `after` es el cursor opaco devuelto por `page_conversations_by_transmitter`;
+        con `summary` no se incluye el historial de mensajes.
+        Lanza ValueError si el cursor es inválido.
+        """
+        cursor = self.conversation_module.find_by_transmitter(transmitter_value, limit=limit, after=self._decode_cursor(after) if after else None, summary=summary)
+        for doc in cursor:
+            yield doc if summary else self.conversation_module.load_messages(doc)
+
+    def page_conversations_by_transmitter(self, transmitter_value: str, limit: int, after: Optional[str] = None, summary: bool = False) -> Dict[str, Any]:
+        """
+        Devuelve una página {"conversations": [...], "next_cursor": str|None}.
+        Lanza ValueError si el cursor es inválido.
+        """
+        docs = list(self.iter_conversations_by_transmitter(transmitter_value, limit=limit, after=after, summary=summary))
+        next_cursor = self._encode_cursor(docs[-1]) if limit and len(docs) == limit else None
+        return {"conversations": docs, "next_cursor": next_cursor}
+
+    @staticmethod
+    def _encode_cursor(doc: Dict[str, Any]) -> str:
+        """Cursor opaco (base64 de Extended JSON) con el (created_at, _id) del último documento."""
+        raw = json_util.dumps([doc.get("created_at"), doc.get("_id")])
+        return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+    @staticmethod
+    def _decode_cursor(cursor: str):
+        try:
+            created_at, last_id = json_util.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+            return created_at, last_id
+        except Exception:
+            raise ValueError("invalid cursor")
+
     def get_conversations_by_phone(self, phone: str) -> List[Dict[str, Any]]:
         return self.get_conversations_by_transmitter_value(phone)
 
@@ -110,6 +495,63 @@ class CoreBot:
     def get_conversations_by_meta_id(self, meta_id: str) -> List[Dict[str, Any]]:
         return self.get_conversations_by_transmitter_value(meta_id)
 
+    # ----------------- lectura con versión -----------------
+    def get_conversation_version(self, session_id: str) -> Optional[int]:
+        """Versión actual de la conversación sin leer sus mensajes (ETag / If-None-Match), o None si no existe."""
+        return self.conversation_module.get_version(session_id)
+
+    def get_conversation(self, session_id: str, history_limit: Optional[int] = None, since_message_id: Optional[str] = None, since_version: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """
+        Documento de la conversación con su "version" (ver modules.storage.conversation_version).
+
+        Con `since_version` (una versión devuelta antes) se responde sólo lo nuevo:
+        {"session_id", "version", "delta": True, "message": [mensajes posteriores],
+        "states": {...}} donde "states" (completo) sólo se incluye si cambiaron. Si la versión no es
+        anterior a la actual (p.ej. de otra sesión) se devuelve el documento completo con "delta": False.
+        """
+        store = self.conversation_module
+        if since_version is None:
+            doc = store.get_conversation(session_id, history_limit=history_limit, since_message_id=since_message_id)
+            if doc:
+                doc["version"] = conversation_version(doc)
+            return doc
+        current = store.get_version(session_id)
+        if current is None:
+            return None
+        known_messages, known_revision = split_version(since_version)
+        messages, revision = split_version(current)
+        if messages < known_messages or (messages == known_messages and revision < known_revision):
+            return self._full_conversation(session_id)
+        delta: Dict[str, Any] = {"session_id": session_id, "version": current, "delta": True, "message": []}
+        new = messages - known_messages
+        # la ventana de los últimos N mensajes y sus contadores salen de la misma lectura: si entretanto
+        # llegaron más mensajes, se relee con la ventana correspondiente
+        for _ in range(3):
+            if not new:
+                break
+            doc = store.get_conversation(session_id, history_limit=new)
+            if not doc:
+                return None
+            messages, revision = split_version(conversation_version(doc))
+            if messages - known_messages <= new:
+                window = doc.get("message") or []
+                delta.update(version=conversation_version(doc), message=window[max(0, len(window) - (messages - known_messages)):])
+                break
+            new = messages - known_messages
+        else:
+            # escrituras continuas: se devuelve el documento completo
+            return self._full_conversation(session_id)
+        if revision != known_revision:
+            delta["states"] = store.get_states(session_id) or {}
+        return delta
+
+    def _full_conversation(self, session_id: str) -> Optional[Dict[str, Any]]:
+        doc = self.conversation_module.get_conversation(session_id)
+        if doc:
+            doc["version"] = conversation_version(doc)
+            doc["delta"] = False
+        return doc
+
     # ----------------- manejo de estados (states) -----------------
     def add_or_replace_state(self, session_id: str, new_state: Dict[str, Any]) -> bool:
         """
@@ -120,6 +562,9 @@ class CoreBot:
             return False
         name = new_state['name']
         value = new_state.get('value')
+        if self.conversation_module.state_mode == STATE_MODE_KEYED:
+            # modo keyed: upsert en una única escritura
+            return self.conversation_module.set_states(session_id, {name: value})
         # intentar sobrescribir
         try:
             replaced = self.conversation_module.overwrite_state(session_id, name, value)
@@ -134,8 +579,66 @@ class CoreBot:
         """Elimina un estado por nombre del documento de conversación."""
         if not session_id or not state_name:
             return False
-        try:
-            res = self.conversation_module.collection.update_one({"session_id": session_id}, {"$pull": {"state": {"name": state_name}}})
-            return res.modified_count > 0
-        except Exception:
+        return self.conversation_module.remove_state(session_id, state_name)
+
+    def set_states(self, session_id: str, states: Any) -> bool:
+        """
+        Inserta o reemplaza varios estados. `states` puede ser una lista de {'name', 'value'}
+        o un dict {name: value}.
+        """
+        if not session_id:
             return False
+        if isinstance(states, list):
+            if not all(isinstance(st, dict) and 'name' in st for st in states):
+                return False
+            states = {st['name']: st.get('value') for st in states}
+        if not isinstance(states, dict) or not states:
+            return False
+        return self.conversation_module.set_states(session_id, states)
+
+    def get_states(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Estados de la sesión como dict {name: value}, o None si no existe."""
+        if not session_id:
+            return None
+        return self.conversation_module.get_states(session_id)
+
+    # ----------------- consumo de tokens -----------------
+    def get_usage(self, transmitter: Optional[str] = None, start_day: Optional[str] = None, end_day: Optional[str] = None, limit: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Consumo de tokens desde los acumulados diarios (no recorre los mensajes):
+        - con `transmitter`: {"transmitter", "days": [{day, prompt_tokens, ..., messages, sessions}], "total"}
+        - sin él: {"contacts": [{transmitter, ...}] (mayor total_tokens primero), "total"}
+        `start_day` / `end_day` ("YYYY-MM-DD", UTC, inclusive) acotan el rango.
+        """
+        if transmitter:
+            rows = self.conversation_module.usage_by_day(transmitter, start_day, end_day)
+            result: Dict[str, Any] = {"transmitter": transmitter, "days": rows}
+        else:
+            rows = self.conversation_module.usage_by_contact(start_day, end_day, limit)
+            result = {"contacts": rows}
+        result["total"] = {field: sum(row.get(field, 0) for row in rows) for field in USAGE_FIELDS + ("sessions",)}
+        return result
+
+    def get_session_usage(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Totales de tokens de una sesión, o None si no existe."""
+        if not session_id:
+            return None
+        return self.conversation_module.get_session_usage(session_id)
+
+    def search(self, query: str, transmitter: Optional[str] = None, start_day: Optional[str] = None, end_day: Optional[str] = None, limit: int = 20, offset: int = 0) -> Dict[str, Any]:
+        """
+        Busca mensajes que contienen todas las palabras de `query` (normalizadas como al indexar,
+        ver modules.search), opcionalmente de un contacto y escritos entre `start_day` y `end_day`
+        ("YYYY-MM-DD", UTC, inclusive). Se puntúan las SEARCH_MAX_CANDIDATES coincidencias más
+        recientes (`truncated` indica que había más) y se devuelve la página [offset, offset + limit):
+        {"terms", "results": [{message_id, session_id, transmitter, created_at, role, snippet, score}], "next_offset", "truncated"}
+        """
+        terms = query_terms(query)
+        if not terms:
+            return {"terms": [], "results": [], "next_offset": None, "truncated": False}
+        since = datetime.fromisoformat(start_day).replace(tzinfo=timezone.utc) if start_day else None
+        until = datetime.fromisoformat(end_day).replace(tzinfo=timezone.utc) + timedelta(days=1) if end_day else None
+        candidates = self.conversation_module.search_candidates(terms, transmitter, since, until, SEARCH_MAX_CANDIDATES)
+        results = rank(candidates, terms, offset, limit)
+        next_offset = offset + limit if offset + limit < len(candidates) else None
+        return {"terms": terms, "results": results, "next_offset": next_offset, "truncated": len(candidates) >= SEARCH_MAX_CANDIDATES}
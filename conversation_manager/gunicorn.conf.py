@@ -0,0 +1,67 @@
+# Configuración de gunicorn para producción:
+#   gunicorn -c gunicorn.conf.py
+# Todos los valores pueden ajustarse por variables de entorno.
+import multiprocessing
+import os
+
+bind = os.getenv("GUNICORN_BIND", f"0.0.0.0:{os.getenv('PORT', '5000')}")
+workers = int(os.getenv("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+# la app lo lee para saber si comparte el tráfico con otros workers (ver modules.live_updates)
+os.environ["GUNICORN_WORKERS"] = str(workers)
+# gthread: varios hilos por worker, útil porque las peticiones esperan sobre todo a Mongo
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", 4))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 5))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 30))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", 30))
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 0))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", 0))
+# Con preload la app se importa en el master sin crear el CoreBot (sus stores quedarían atados al
+# cliente Mongo del master): cada worker descarta lo heredado en post_fork y hace el warm-up en
+# post_worker_init
+preload_app = os.getenv("GUNICORN_PRELOAD", "0") == "1"
+wsgi_app = "app:create_app(warm_up=False)" if preload_app else "app:create_app()"
+accesslog = os.getenv("GUNICORN_ACCESSLOG", "-")
+errorlog = "-"
+loglevel = os.getenv("GUNICORN_LOGLEVEL", "info")
+
+
+def on_starting(server):
+    # el directorio de métricas multiproceso debe empezar vacío: se descartan valores de ejecuciones previas
+    multiproc_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if multiproc_dir:
+        os.makedirs(multiproc_dir, exist_ok=True)
+        for name in os.listdir(multiproc_dir):
+            if name.endswith(".db"):
+                os.remove(os.path.join(multiproc_dir, name))
+
+
+def post_fork(server, worker):
+    # Cada worker debe crear su propio pool de conexiones a MongoDB y su propio CoreBot
+    from configs.config import reset_mongo_client
+    reset_mongo_client()
+    if preload_app:
+        from routes.core_bot_routes import reset_bot
+        reset_bot()
+
+
+def post_worker_init(worker):
+    # con preload create_app no hizo el warm-up (corrió en el master): se hace en cada worker
+    if preload_app:
+        from app import warm_up_on_start, warm_up_bot
+        if warm_up_on_start():
+            warm_up_bot()
+
+
+def worker_exit(server, worker):
+    # primero escribir los mensajes pendientes de la cola diferida, luego cerrar el cliente
+    from modules.write_behind import drain_all
+    from configs.config import close_mongo_client
+    drain_all(timeout=graceful_timeout)
+    close_mongo_client()
+
+
+def child_exit(server, worker):
+    # métricas en modo multiproceso (PROMETHEUS_MULTIPROC_DIR): descartar las del worker terminado
+    from modules.metrics import mark_process_dead
+    mark_process_dead(worker.pid)
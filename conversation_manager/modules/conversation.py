@@ -1,71 +1,223 @@
-import nltk
-from nltk.tokenize import word_tokenize
 from pymongo.collection import Collection
-from pymongo.errors import PyMongoError
+from pymongo.errors import PyMongoError, DuplicateKeyError, OperationFailure, CollectionInvalid, BulkWriteError
+from pymongo import ReturnDocument, ASCENDING, DESCENDING, ReplaceOne, UpdateOne
 from bson.objectid import ObjectId
-from datetime import datetime, timezone
-import time
-import random
+from datetime import datetime, timezone, timedelta
+import heapq
+import itertools
+import logging
+import os
 import sys
 from pathlib import Path
 sys.path.append(str(Path(__file__).resolve().parent.parent))
 from configs.config import Database_conversation
-class Conversation:
+from modules.storage import ConversationStore, STATE_MODE_ARRAY, STATE_MODE_KEYED, USAGE_FIELDS, message_usage, usage_day, conversation_version, inbound_key_ttl
+from modules.search import search_document, index_enabled
+
+logger = logging.getLogger(__name__)
+
+# Formatos de almacenamiento de mensajes:
+# - embedded: un único documento por sesión con todo el array 'message' (formato original).
+# - bucketed: documento cabecera en 'conversation' (sin 'message', con 'message_count') más
+#   documentos de tamaño fijo en 'conversation_buckets' ({session_id, bucket, count, messages}).
+LAYOUT_EMBEDDED = "embedded"
+LAYOUT_BUCKETED = "bucketed"
+
+# Nivel frío: las conversaciones antiguas se mueven (ver archive_older_than) a una colección
+# aparte creada con compresión de bloques zstd. Se guardan en formato embedded con el mismo _id,
+# y las lecturas por session_id / transmitter la consultan cuando no encuentran la sesión en caliente.
+ARCHIVE_COLLECTION = "conversation_archive"
+
+# Acumulados de tokens por contacto y día ({transmitter, day, <USAGE_FIELDS>, sessions}), mantenidos
+# con $inc al escribir mensajes; junto con 'usage' de cada sesión evitan recorrer los arrays 'message'.
+USAGE_COLLECTION = "token_usage"
+
+# Índice invertido para la búsqueda de mensajes (ver modules.search): un documento por mensaje
+# ({_id: message_id, session_id, transmitter, created_at, role, snippet, terms, tf, length}) con
+# un índice multikey sobre 'terms'. Se escribe junto con cada mensaje; SEARCH_INDEX_ENABLED=0 lo desactiva.
+SEARCH_COLLECTION = "message_search"
+
+# Claves de idempotencia de mensajes entrantes ({_id: external_id, created_at}), con índice TTL de
+# INBOUND_KEY_TTL_SECONDS (ver modules.storage.inbound_key_ttl).
+INBOUND_COLLECTION = "inbound_keys"
+
+
+class Conversation(ConversationStore):
     def __init__(self):
         """
         Inicializa el gestor CRUD para la colección 'conversation'.
 
-        :param db_manager: Instancia de MongoDBConnectionManager para la conexión a MongoDB.
+        El formato de las sesiones nuevas se elige con CONVERSATION_STORAGE_LAYOUT
+        (embedded | bucketed) y CONVERSATION_BUCKET_SIZE (mensajes por bucket). La lectura y los
+        appends siguen el formato de cada documento, por lo que pueden convivir durante una migración.
+        CONVERSATION_STATE_MODE (array | keyed) elige cómo se guardan los estados.
+
+        No accede a la red: los índices y la colección de archivo se verifican en `warm_up`.
         """
         self.db_manager = Database_conversation()
         self.db_manager.connect() 
         self.collection: Collection = self.db_manager.get_collection("conversation")
+        self.buckets: Collection = self.db_manager.get_collection("conversation_buckets")
+        self.layout = os.getenv("CONVERSATION_STORAGE_LAYOUT", LAYOUT_EMBEDDED).strip().lower()
+        self.state_mode = os.getenv("CONVERSATION_STATE_MODE", STATE_MODE_ARRAY).strip().lower()
+        try:
+            self.bucket_size = max(1, int(os.getenv("CONVERSATION_BUCKET_SIZE", 200)))
+        except ValueError:
+            self.bucket_size = 200
+        # lo confirma ensure_indexes() en warm_up; en un despliegue existente el índice ya está creado
+        self.unique_session_id = True
+        self.archive: Collection = self.db_manager.get_collection(ARCHIVE_COLLECTION)
+        self.token_usage: Collection = self.db_manager.get_collection(USAGE_COLLECTION)
+        self.message_search: Collection = self.db_manager.get_collection(SEARCH_COLLECTION)
+        self.inbound_keys: Collection = self.db_manager.get_collection(INBOUND_COLLECTION)
+        self.search_enabled = index_enabled()
+
+    def ping(self, timeout: float = None) -> bool:
+        return self.db_manager.ping(timeout)
+
+    def warm_up(self) -> bool:
+        """
+        Crea (si faltan) los índices de 'conversation', de los buckets (formato bucketed), la
+        colección de archivo y el TTL de las claves de idempotencia. Retorna True si el índice
+        único sobre session_id existe y los demás índices quedaron creados.
+        """
+        self.unique_session_id = self.ensure_indexes()
+        if self.layout == LAYOUT_BUCKETED:
+            self.ensure_bucket_indexes()
+        self.archive = self.ensure_archive()
+        usage_indexes = self.ensure_usage_indexes()
+        search_indexes = self.ensure_search_indexes() if self.search_enabled else True
+        inbound_indexes = self.ensure_inbound_indexes()
+        return self.unique_session_id and usage_indexes and search_indexes and inbound_indexes
+
+    def ensure_indexes(self) -> bool:
+        """
+        Crea el índice único sobre session_id: garantiza un único documento por sesión aunque
+        varios workers escriban en paralelo (las escrituras de creación son upserts). También
+        el índice (transmitter, created_at, _id) usado por los listados paginados.
+        Retorna True si el índice único existe.
+        """
+        try:
+            self.collection.create_index([("session_id", ASCENDING)], unique=True, name="session_id_unique")
+            # listados paginados por contacto (CoreBot.iter_conversations_by_transmitter)
+            self.collection.create_index([("transmitter", ASCENDING), ("created_at", ASCENDING), ("_id", ASCENDING)], name="transmitter_created_at")
+            return True
+        except OperationFailure as e:
+            logger.error("[ERROR_CONVERSATION_INDEXES]: No se pudo crear el índice único sobre session_id (¿duplicados?): %s", e)
+            return False
+        except PyMongoError as e:
+            logger.error("[ERROR_CONVERSATION_INDEXES]: No se pudieron crear los índices: %s", e)
+            return False
+
+    def ensure_archive(self) -> Collection:
+        """
+        Devuelve la colección de archivo, creándola con block_compressor=zstd si no existe
+        (la compresión de WiredTiger sólo puede fijarse al crear la colección), y sus índices.
+        """
+        db = self.db_manager.db
+        try:
+            if ARCHIVE_COLLECTION not in db.list_collection_names(filter={"name": ARCHIVE_COLLECTION}):
+                db.create_collection(ARCHIVE_COLLECTION, storageEngine={"wiredTiger": {"configString": "block_compressor=zstd"}})
+        except CollectionInvalid:
+            # creada en paralelo por otro proceso
+            pass
+        except PyMongoError as e:
+            logger.error("[ERROR_CONVERSATION_ARCHIVE]: No se pudo crear la colección de archivo con zstd: %s", e)
+        archive = db[ARCHIVE_COLLECTION]
+        try:
+            archive.create_index([("session_id", ASCENDING)], unique=True, name="session_id_unique")
+            archive.create_index([("transmitter", ASCENDING), ("created_at", ASCENDING), ("_id", ASCENDING)], name="transmitter_created_at")
+        except PyMongoError as e:
+            logger.error("[ERROR_CONVERSATION_ARCHIVE]: No se pudieron crear los índices del archivo: %s", e)
+        return archive
+
+    def ensure_usage_indexes(self) -> bool:
+        """
+        Índice único (transmitter, day) de los acumulados, que hace seguros los upserts
+        concurrentes, y (day, transmitter) para los rangos de días de todos los contactos.
+        """
+        try:
+            self.token_usage.create_index([("transmitter", ASCENDING), ("day", ASCENDING)], unique=True, name="transmitter_day_unique")
+            self.token_usage.create_index([("day", ASCENDING), ("transmitter", ASCENDING)], name="day_transmitter")
+            return True
+        except PyMongoError as e:
+            logger.error("[ERROR_USAGE_INDEXES]: No se pudieron crear los índices de token_usage: %s", e)
+            return False
 
-    def new_conversation(self, content, tokens, send_data, transmitter: str = None):
+    def ensure_inbound_indexes(self) -> bool:
+        """Índice TTL sobre created_at de las claves de idempotencia; si cambió INBOUND_KEY_TTL_SECONDS se ajusta con collMod."""
+        ttl = inbound_key_ttl()
+        try:
+            self.inbound_keys.create_index([("created_at", ASCENDING)], name="created_at_ttl", expireAfterSeconds=ttl)
+            return True
+        except OperationFailure:
+            try:
+                self.db_manager.db.command("collMod", INBOUND_COLLECTION, index={"name": "created_at_ttl", "expireAfterSeconds": ttl})
+                return True
+            except PyMongoError as e:
+                logger.error("[ERROR_INBOUND_INDEXES]: No se pudo ajustar el TTL de inbound_keys: %s", e)
+                return False
+        except PyMongoError as e:
+            logger.error("[ERROR_INBOUND_INDEXES]: No se pudo crear el índice TTL de inbound_keys: %s", e)
+            return False
+
+    def ensure_search_indexes(self) -> bool:
+        """
+        Índices de 'message_search': (terms, created_at) y (transmitter, terms, created_at) para
+        las consultas con y sin contacto, y session_id para borrar los mensajes de una sesión.
+        """
+        try:
+            self.message_search.create_index([("terms", ASCENDING), ("created_at", DESCENDING)], name="terms_created_at")
+            self.message_search.create_index([("transmitter", ASCENDING), ("terms", ASCENDING), ("created_at", DESCENDING)], name="transmitter_terms_created_at")
+            self.message_search.create_index([("session_id", ASCENDING)], name="session_id")
+            return True
+        except PyMongoError as e:
+            logger.error("[ERROR_SEARCH_INDEXES]: No se pudieron crear los índices de message_search: %s", e)
+            return False
+
+    def ensure_bucket_indexes(self) -> bool:
+        """
+        Crea el índice único (session_id, bucket) de la colección de buckets.
+        """
+        try:
+            self.buckets.create_index([("session_id", ASCENDING), ("bucket", ASCENDING)], unique=True, name="session_bucket")
+            return True
+        except PyMongoError as e:
+            logger.error("[ERROR_CONVERSATION_INDEXES]: No se pudieron crear los índices de buckets: %s", e)
+            return False
+
+    def new_conversation(self, content, tokens, send_data, transmitter: str = None, session_id: str = None):
         """
         Crea un nuevo documento de conversación en la colección 'conversation'.
 
-        :param conversation_data: Diccionario con los datos de la conversación.
+        La creación es un upsert idempotente: si otro worker ya agregó mensajes a `session_id`
+        (p.ej. tras perder la carrera en `Transmitter.resolve_or_create_session`), el primer
+        mensaje se antepone y se completan los metadatos en lugar de duplicar el documento.
+
+        :param session_id: ID de sesión ya reservado (por defecto se genera uno nuevo).
         :return: Diccionario con session_id y inserted_id (ObjectId).
         """
         try:
-            # hora del mensaje y marca de creación de la sesión (ISO UTC)
-            hour = datetime.now(timezone.utc).strftime('%H:%M:%S')
-            created_at = datetime.now(timezone.utc).isoformat()
-            session_id = self.generate_id()
-            message_id = self.generate_id()
-            conversation_data = {
-                "session_id": session_id,
-                "state": [],
-                # opcional: desde donde vino el mensaje (p.ej. 'phone','chat','meta','bot')
-                "transmitter": transmitter,
-                # timestamp de creación de la sesión
-                "created_at": created_at,
-                "message": [{
-                    "message_id" : message_id,
-                    "role": content['role'],
-                    "tokens": {
-                        "prompt_tokens":tokens["prompt_tokens"],
-                        "completion_tokens":tokens["completion_tokens"],
-                        "total_tokens":tokens["total_tokens"]
-                    },
-                    "content": content['text'],
-                    "send": {
-                        "audio": send_data["audio"],
-                        "image": send_data["image"],
-                        "location": send_data["location"],
-                        "document": send_data["document"],
-                        "video": send_data["video"]
-                    },
-                    "hour": hour
-                }]
-            }
-            result = self.collection.insert_one(conversation_data)
-            print(f"[CREANDO_CONVERSACION]: {conversation_data}")
-            # Ahora devolvemos: session_id, inserted_id y metadatos
-            return {"session_id": session_id, "inserted_id": str(result.inserted_id), "transmitter": transmitter, "created_at": created_at}
+            session_id = session_id or self.generate_id()
+            conversation_data = self.build_conversation_doc(session_id, transmitter, [self._build_message_entry(content, tokens, send_data)])
+            created_at = conversation_data["created_at"]
+            if self.layout == LAYOUT_BUCKETED:
+                header, inserted_id = self._create_bucketed(conversation_data)
+                conversation_data = {**header, "message": conversation_data["message"]}
+            else:
+                filter_query, update = self._conversation_upsert(conversation_data)
+                doc = self.collection.find_one_and_update(filter_query, update, projection={"usage": 1}, upsert=True, return_document=ReturnDocument.AFTER)
+                # si un append concurrente se adelantó, el documento ya tenía mensajes: no lo insertamos nosotros
+                inserted_id = doc["_id"] if doc["usage"]["messages"] == len(conversation_data["message"]) else None
+                # lo acumulado antes de tener transmitter (appends adelantados) se atribuye ahora
+                self._record_usage([(transmitter, doc["usage"], True)])
+                self._messages_written([(session_id, transmitter, conversation_data["message"])], adopt=inserted_id is None)
+            logger.debug("[CREANDO_CONVERSACION]: session_id=%s transmitter=%s", session_id, transmitter)
+            # Ahora devolvemos: session_id, inserted_id, metadatos y el documento insertado
+            # (evita releer la conversación recién creada)
+            return {"session_id": session_id, "inserted_id": str(inserted_id) if inserted_id is not None else None, "transmitter": transmitter, "created_at": created_at, "conversation": conversation_data}
         except PyMongoError as e:
-            print(f"Error al crear la conversación: {e}")
+            logger.error("[ERROR_NEW_CONVERSATION]: Error al crear la conversación: %s", e)
             return None
         
     def add_message(self, session_id, content, tokens, send_data):
@@ -78,43 +230,499 @@ class Conversation:
         :param send_data: Datos adicionales a enviar.
         """
         try:
-            message_id = self.generate_id()
-            hour = datetime.now(timezone.utc).strftime('%H:%M:%S')
-            # Construir la estructura de la sesión
-            message_entry = {
-                    "message_id" : message_id,
-                    "role": content['role'],
-                    "tokens": {
-                        "prompt_tokens":tokens["prompt_tokens"],
-                        "completion_tokens":tokens["completion_tokens"],
-                        "total_tokens":tokens["total_tokens"]
-                    },
-                    "content": content['text'],
-                    "send": {
-                        "audio": send_data["audio"],
-                        "image": send_data["image"],
-                        "location": send_data["location"],
-                        "document": send_data["document"],
-                        "video": send_data["video"]
-                    },
-                    "hour": hour
-                }
-
-            # Actualizar o crear el documento (filtro simplificado)
+            message_entry = self._build_message_entry(content, tokens, send_data)
+            result, bucketed = self._append_message(session_id, message_entry, projection={"transmitter": 1})
+            if bucketed is not None:
+                return bucketed[1]
+            self._record_usage([(result.get("transmitter"), message_usage([message_entry]), False)])
+            self._messages_written([(session_id, result.get("transmitter"), [message_entry])])
+            return result
+        except PyMongoError as e:
+            logger.error("[ERROR_ADD_SESSION]: Error al agregar la nueva sesión: %s", e)
+            return False
+
+    def add_message_and_get(self, session_id, content, tokens, send_data, history_limit: int = None, since_message_id: str = None):
+        """
+        Agrega un mensaje a la conversación y devuelve el documento actualizado en un único
+        round trip (find_one_and_update con ReturnDocument.AFTER).
+
+        :param session_id: ID de la sesión.
+        :param content: Contenido del mensaje.
+        :param tokens: Tokens asociados al mensaje.
+        :param send_data: Datos adicionales a enviar.
+        :param history_limit: devolver sólo los últimos N mensajes (proyección $slice).
+        :param since_message_id: devolver sólo los mensajes posteriores a ese message_id
+                                 (requiere una lectura adicional con agregación).
+        :return: Documento de conversación actualizado o None en error.
+        """
+        try:
+            message_entry = self._build_message_entry(content, tokens, send_data)
+            if since_message_id:
+                projection = {"transmitter": 1}
+            else:
+                projection = {"message": {"$slice": -int(history_limit)}} if history_limit else None
+            doc, bucketed = self._append_message(session_id, message_entry, projection=projection, full_header=True)
+            if bucketed is not None:
+                return self._load_bucketed(bucketed[0], history_limit, since_message_id)
+            self._record_usage([(doc.get("transmitter"), message_usage([message_entry]), False)])
+            self._messages_written([(session_id, doc.get("transmitter"), [message_entry])])
+            if since_message_id:
+                return self.get_conversation(session_id, history_limit=history_limit, since_message_id=since_message_id)
+            return doc
+        except PyMongoError as e:
+            logger.error("[ERROR_ADD_SESSION]: Error al agregar el mensaje: %s", e)
+            return None
+
+    def _append_message(self, session_id, message_entry, projection=None, full_header: bool = False):
+        """
+        Agrega un mensaje en el formato de la sesión almacenada. CONVERSATION_STORAGE_LAYOUT sólo
+        decide el formato de las sesiones nuevas (y cuál se intenta primero): una sesión migrada
+        con scripts/migrate_conversation_buckets.py sigue recibiendo mensajes en sus buckets.
+
+        :return: (documento embedded actualizado, None) o (None, (cabecera, resultado del bucket));
+                 en el formato embedded el llamador registra el uso y el índice de búsqueda.
+        """
+        if self.layout == LAYOUT_BUCKETED:
+            header, result = self._append_bucketed(session_id, message_entry, full_header)
+            if header is not None:
+                return None, (header, result)
+        update = {"$push": {"message": message_entry}, "$inc": self._usage_inc([message_entry])}
+        # dos intentos: un upsert embedded puede chocar con la creación concurrente de la sesión
+        for _ in range(2):
+            doc = self._append_embedded(session_id, update, projection)
+            if doc is not None:
+                return doc, None
+            header, result = self._append_bucketed(session_id, message_entry, full_header)
+            if header is not None:
+                return None, (header, result)
+        raise OperationFailure(f"No se pudo agregar el mensaje a la sesión {session_id}")
+
+    def _append_embedded(self, session_id, update, projection=None):
+        """
+        find_one_and_update (con upsert) de un append en formato embedded, o None si la sesión es
+        una cabecera bucketed: un $push sobre ella dejaría el mensaje fuera de las lecturas.
+        """
+        if not self.unique_session_id and self.collection.find_one({"session_id": session_id, "layout": LAYOUT_BUCKETED}, {"_id": 1}):
+            # sin índice único el upsert crearía un segundo documento para la sesión
+            return None
+        try:
+            return self.collection.find_one_and_update(
+                {"session_id": session_id, "layout": {"$ne": LAYOUT_BUCKETED}},
+                update,
+                projection=projection,
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # el índice único de session_id rechazó el upsert: ya existe un documento de la sesión
+            return None
+
+    def bulk_write_messages(self, new_conversations, appends) -> bool:
+        """
+        Escribe en un único bulk_write varias conversaciones nuevas y mensajes agregados a sesiones existentes.
+
+        :param new_conversations: lista de documentos creados con `build_conversation_doc`.
+        :param appends: dict {session_id: [message_entry, ...]} en orden de llegada; cada sesión
+                        recibe un único $push con $each, lo que conserva el orden por sesión.
+        :return: True si la escritura fue confirmada.
+        """
+        if self.layout == LAYOUT_BUCKETED:
+            # el formato bucketed necesita conocer la posición de cada mensaje ($inc en la cabecera)
+            try:
+                for doc in new_conversations:
+                    self._create_bucketed(doc)
+                for session_id, entries in appends.items():
+                    for entry in entries:
+                        self._append_one_entry(session_id, entry)
+                return True
+            except PyMongoError as e:
+                logger.error("[ERROR_BULK_MESSAGES]: Error en la escritura en lote: %s", e)
+                return False
+        appended = [session_id for session_id, entries in appends.items() if entries]
+        try:
+            # sesiones migradas a buckets: sus mensajes van a los buckets, no al $push del lote
+            migrated = {d["session_id"] for d in self.collection.find({"session_id": {"$in": appended}, "layout": LAYOUT_BUCKETED}, {"session_id": 1})} if appended else set()
+            for session_id in migrated:
+                for entry in appends[session_id]:
+                    self._append_one_entry(session_id, entry)
+        except PyMongoError as e:
+            logger.error("[ERROR_BULK_MESSAGES]: Error en la escritura en lote: %s", e)
+            return False
+        appended = [session_id for session_id in appended if session_id not in migrated]
+        ops = [UpdateOne(*self._conversation_upsert(doc), upsert=True) for doc in new_conversations]
+        ops.extend(
+            UpdateOne({"session_id": session_id, "layout": {"$ne": LAYOUT_BUCKETED}}, {"$push": {"message": {"$each": appends[session_id]}}, "$inc": self._usage_inc(appends[session_id])}, upsert=True)
+            for session_id in appended
+        )
+        if not ops:
+            return True
+        try:
+            acknowledged = self.collection.bulk_write(ops, ordered=False).acknowledged
+        except BulkWriteError as bwe:
+            # un append que chocó con el índice único: la sesión se migró a buckets entretanto
+            errors = bwe.details.get("writeErrors", [])
+            offset = len(new_conversations)
+            if any(err.get("code") != 11000 or err["index"] < offset for err in errors):
+                logger.error("[ERROR_BULK_MESSAGES]: Error en la escritura en lote: %s", bwe)
+                return False
+            try:
+                for err in errors:
+                    session_id = appended[err["index"] - offset]
+                    for entry in appends[session_id]:
+                        self._append_one_entry(session_id, entry)
+            except PyMongoError as e:
+                logger.error("[ERROR_BULK_MESSAGES]: Error en la escritura en lote: %s", e)
+                return False
+            retried = {appended[err["index"] - offset] for err in errors}
+            appended = [session_id for session_id in appended if session_id not in retried]
+            acknowledged = True
+        except PyMongoError as e:
+            logger.error("[ERROR_BULK_MESSAGES]: Error en la escritura en lote: %s", e)
+            return False
+        rows = [(doc["transmitter"], message_usage(doc["message"]), True) for doc in new_conversations]
+        transmitters = {}
+        if appended:
+            # el bulk_write no devuelve documentos: una lectura para conocer el transmitter de cada sesión
+            try:
+                transmitters = {d["session_id"]: d.get("transmitter") for d in self.collection.find({"session_id": {"$in": appended}}, {"session_id": 1, "transmitter": 1})}
+            except PyMongoError as e:
+                logger.error("[ERROR_TOKEN_USAGE]: No se pudieron leer los transmitters del lote: %s", e)
+                transmitters = {}
+            rows.extend((transmitters.get(session_id), message_usage(appends[session_id]), False) for session_id in appended)
+        self._record_usage(rows)
+        self._messages_written(
+            [(doc["session_id"], doc["transmitter"], doc["message"]) for doc in new_conversations]
+            + [(session_id, transmitters.get(session_id), appends[session_id]) for session_id in appended]
+        )
+        return acknowledged
+
+    def _append_one_entry(self, session_id, entry):
+        """Agrega un mensaje de un lote fuera del bulk_write (ver `_append_message`)."""
+        doc, bucketed = self._append_message(session_id, entry, projection={"transmitter": 1})
+        if bucketed is None:
+            self._record_usage([(doc.get("transmitter"), message_usage([entry]), False)])
+            self._messages_written([(session_id, doc.get("transmitter"), [entry])])
+
+    @staticmethod
+    def _usage_inc(messages):
+        """$inc de 'usage' de la sesión para los mensajes agregados."""
+        return {f"usage.{field}": value for field, value in message_usage(messages).items()}
+
+    def _record_usage(self, rows) -> bool:
+        """
+        Suma al acumulado diario de cada contacto. `rows`: [(transmitter, totales de `message_usage`, sesión nueva)].
+        Las filas sin transmitter (appends que se adelantaron a la creación de la sesión) se omiten:
+        se atribuyen cuando la creación completa el documento. Un error no afecta a la escritura de
+        los mensajes (ya confirmada): se registra y retorna False.
+        """
+        day = usage_day()
+        merged: dict = {}
+        for transmitter, totals, new_session in rows:
+            if not transmitter or not totals.get("messages"):
+                continue
+            acc = merged.setdefault(transmitter, dict.fromkeys(USAGE_FIELDS + ("sessions",), 0))
+            for field in USAGE_FIELDS:
+                acc[field] += totals.get(field, 0)
+            acc["sessions"] += int(new_session)
+        if not merged:
+            return True
+        now = datetime.now(timezone.utc)
+        try:
+            # un único contacto (el caso de cada mensaje): un update_one; en lote, un bulk_write
+            if len(merged) == 1:
+                (transmitter, acc), = merged.items()
+                return self.token_usage.update_one({"transmitter": transmitter, "day": day}, {"$inc": acc, "$set": {"updated_at": now}}, upsert=True).acknowledged
+            ops = [
+                UpdateOne({"transmitter": transmitter, "day": day}, {"$inc": acc, "$set": {"updated_at": now}}, upsert=True)
+                for transmitter, acc in merged.items()
+            ]
+            return self.token_usage.bulk_write(ops, ordered=False).acknowledged
+        except PyMongoError as e:
+            logger.error("[ERROR_TOKEN_USAGE]: No se pudo actualizar token_usage: %s", e)
+            return False
+
+    def _messages_written(self, rows, adopt: bool = False):
+        """Tras confirmar la escritura de mensajes: los indexa para la búsqueda y los publica (event_hook)."""
+        self._index_messages(rows, adopt)
+        self._emit_messages(rows)
+
+    def _index_messages(self, rows, adopt: bool = False) -> bool:
+        """
+        Agrega los mensajes al índice de búsqueda. `rows`: [(session_id, transmitter, [message_entry, ...])].
+        Con `adopt` (creación de una sesión a la que ya se agregaron mensajes) también asigna el
+        transmitter a los mensajes de la sesión indexados antes sin él. Como el _id es el
+        message_id, un reintento no duplica documentos. Un error no afecta a la escritura de los
+        mensajes (ya confirmada): se registra y retorna False.
+        """
+        if not self.search_enabled:
+            return True
+        now = datetime.now(timezone.utc)
+        docs = [doc for session_id, transmitter, messages in rows for doc in (search_document(session_id, transmitter, m, now) for m in messages) if doc]
+        try:
+            if adopt:
+                for session_id, transmitter, _ in rows:
+                    if transmitter:
+                        self.message_search.update_many({"session_id": session_id, "transmitter": None}, {"$set": {"transmitter": transmitter}})
+            if docs:
+                self.message_search.insert_many(docs, ordered=False)
+            return True
+        except BulkWriteError as e:
+            if all(err.get("code") == 11000 for err in e.details.get("writeErrors", [])):
+                return True
+            logger.error("[ERROR_SEARCH_INDEX]: No se pudieron indexar los mensajes: %s", e)
+            return False
+        except PyMongoError as e:
+            logger.error("[ERROR_SEARCH_INDEX]: No se pudieron indexar los mensajes: %s", e)
+            return False
+
+    @staticmethod
+    def _conversation_upsert(conversation_data):
+        """
+        (filtro, update) que crea la sesión o, si ya existe por un append concurrente,
+        completa sus metadatos y antepone los mensajes iniciales.
+        """
+        return (
+            {"session_id": conversation_data["session_id"]},
+            {
+                "$set": {"transmitter": conversation_data["transmitter"], "created_at": conversation_data["created_at"]},
+                "$setOnInsert": {"state": conversation_data["state"]},
+                "$push": {"message": {"$each": conversation_data["message"], "$position": 0}},
+                "$inc": Conversation._usage_inc(conversation_data["message"])
+            }
+        )
+
+    def _create_bucketed(self, conversation_data):
+        """
+        Crea (o completa, si un append concurrente se adelantó) la cabecera bucketed de una sesión
+        nueva y guarda sus mensajes iniciales en los buckets reservados.
+        :return: (cabecera, upserted _id o None)
+        """
+        messages = conversation_data["message"]
+        session_id = conversation_data["session_id"]
+        header = self.collection.find_one_and_update(
+            {"session_id": session_id},
+            {
+                "$set": {"transmitter": conversation_data["transmitter"], "created_at": conversation_data["created_at"]},
+                "$setOnInsert": {"state": conversation_data["state"], "layout": LAYOUT_BUCKETED, "bucket_size": self.bucket_size},
+                "$inc": {"message_count": len(messages), **self._usage_inc(messages)}
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        self._record_usage([(conversation_data["transmitter"], header["usage"], True)])
+        # si un append se adelantó, sus mensajes quedaron indexados sin transmitter
+        self._messages_written([(session_id, conversation_data["transmitter"], messages)], adopt=header.get("message_count") != len(messages))
+        size = header.get("bucket_size") or self.bucket_size
+        first = header["message_count"] - len(messages)
+        by_bucket = {}
+        for n, entry in enumerate(messages):
+            by_bucket.setdefault((first + n) // size, []).append(entry)
+        for bucket, entries in by_bucket.items():
+            self._push_to_bucket(session_id, bucket, entries)
+        inserted_id = header["_id"] if header.get("message_count") == len(messages) else None
+        return header, inserted_id
+
+    def _append_bucketed(self, session_id, message_entry, full_header: bool = False):
+        """
+        Agrega un mensaje a una sesión en formato bucketed: reserva la posición incrementando
+        'message_count' en la cabecera y lo inserta en el bucket correspondiente.
+
+        Si la sesión no existe y session_id tiene índice único, se crea la cabecera (un worker
+        puede agregar mensajes antes de que quien creó la sesión escriba la cabecera completa).
+
+        :return: (cabecera actualizada, resultado del update del bucket) o (None, None) si la
+                 sesión existe en formato embedded (el llamador usa ese formato).
+        """
+        try:
+            header = self.collection.find_one_and_update(
+                {"session_id": session_id, "message": {"$exists": False}},
+                {"$inc": {"message_count": 1, **self._usage_inc([message_entry])}, "$setOnInsert": {"state": [], "layout": LAYOUT_BUCKETED, "bucket_size": self.bucket_size}},
+                projection=None if full_header else {"message_count": 1, "bucket_size": 1, "transmitter": 1},
+                upsert=self.unique_session_id,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # existe un documento embedded con ese session_id
+            return None, None
+        if header is None:
+            return None, None
+        self._record_usage([(header.get("transmitter"), message_usage([message_entry]), False)])
+        self._messages_written([(session_id, header.get("transmitter"), [message_entry])])
+        bucket = (header["message_count"] - 1) // (header.get("bucket_size") or self.bucket_size)
+        return header, self._push_to_bucket(session_id, bucket, [message_entry])
+
+    def _push_to_bucket(self, session_id, bucket, entries):
+        """
+        Agrega mensajes a un bucket creándolo si no existe. Dos upserts simultáneos sobre un
+        bucket nuevo pueden chocar en el índice único: el perdedor reintenta como update.
+        """
+        query = {"session_id": session_id, "bucket": bucket}
+        update = {"$push": {"messages": {"$each": entries}}, "$inc": {"count": len(entries)}}
+        try:
+            return self.buckets.update_one(query, update, upsert=True)
+        except DuplicateKeyError:
+            return self.buckets.update_one(query, update, upsert=True)
+
+    def _load_bucketed(self, header, history_limit: int = None, since_message_id: str = None):
+        """
+        Arma el documento de conversación (con 'message') a partir de la cabecera y sus buckets,
+        leyendo sólo los buckets necesarios para la ventana de historial pedida.
+        """
+        session_id = header.get("session_id")
+        size = header.get("bucket_size") or self.bucket_size
+        query = {"session_id": session_id}
+        if since_message_id:
+            hit = self.buckets.find_one({"session_id": session_id, "messages.message_id": since_message_id}, {"bucket": 1})
+            if hit:
+                query["bucket"] = {"$gte": hit["bucket"]}
+        elif history_limit:
+            query["bucket"] = {"$gte": max(0, header.get("message_count", 0) - int(history_limit)) // size}
+        messages = []
+        for bucket in self.buckets.find(query, {"_id": 0, "messages": 1}).sort("bucket", ASCENDING):
+            messages.extend(bucket.get("messages", []))
+        return self.window_messages({**header, "message": messages}, history_limit, since_message_id)
+
+    def load_messages(self, doc, history_limit: int = None, since_message_id: str = None):
+        """
+        Devuelve `doc` con su historial en 'message' sin importar el formato de almacenamiento (embedded o bucketed).
+        """
+        if doc and doc.get("layout") == LAYOUT_BUCKETED:
+            return self._load_bucketed(doc, history_limit, since_message_id)
+        return doc
+
+    def migrate_to_buckets(self, session_id) -> bool:
+        """
+        Convierte una conversación embedded al formato bucketed (copia los mensajes a buckets y
+        elimina 'message' de la cabecera). Si la sesión recibió mensajes durante la migración
+        no se modifica y retorna False para reintentar más tarde.
+        """
+        try:
+            doc = self.collection.find_one({"session_id": session_id, "layout": {"$ne": LAYOUT_BUCKETED}})
+            if not doc:
+                return False
+            messages = doc.get("message", [])
+            size = self.bucket_size
+            ops = [
+                ReplaceOne(
+                    {"session_id": session_id, "bucket": i // size},
+                    {"session_id": session_id, "bucket": i // size, "count": len(messages[i:i + size]), "messages": messages[i:i + size]},
+                    upsert=True
+                )
+                for i in range(0, len(messages), size)
+            ]
+            if ops:
+                self.buckets.bulk_write(ops, ordered=True)
             result = self.collection.update_one(
-                {"session_id": session_id},
-                {"$push": {"message": message_entry}},
-                upsert=True
+                {"_id": doc["_id"], "layout": {"$ne": LAYOUT_BUCKETED}, "message": {"$size": len(messages)}},
+                {"$set": {"layout": LAYOUT_BUCKETED, "bucket_size": size, "message_count": len(messages)}, "$unset": {"message": ""}}
             )
-            return result
+            return result.modified_count > 0
+        except PyMongoError as e:
+            logger.error("[ERROR_MIGRATE_BUCKETS]: Error al migrar la sesión %s: %s", session_id, e)
+            return False
+
+    def archive_session(self, session_id) -> bool:
+        """
+        Mueve una conversación al archivo: la copia (en formato embedded, con todo su historial)
+        y luego la elimina del nivel caliente sólo si no recibió mensajes mientras tanto.
+        Si cambió, la copia se sobrescribe en el próximo intento y retorna False.
+        """
+        try:
+            doc = self.collection.find_one({"session_id": session_id})
+            if not doc:
+                return False
+            bucketed = doc.get("layout") == LAYOUT_BUCKETED
+            archived = self.load_messages(doc)
+            for field in ("layout", "bucket_size", "message_count"):
+                archived.pop(field, None)
+            archived["archived_at"] = datetime.now(timezone.utc)
+            self.archive.replace_one({"session_id": session_id}, archived, upsert=True)
+            if bucketed:
+                guard = {"_id": doc["_id"], "message_count": doc.get("message_count", 0)}
+            else:
+                guard = {"_id": doc["_id"], "message": {"$size": len(doc.get("message", []))}}
+            if self.collection.delete_one(guard).deleted_count == 0:
+                return False
+            if bucketed:
+                self.buckets.delete_many({"session_id": session_id})
+            return True
         except PyMongoError as e:
-            print(f"[ERROR_ADD_SESSION]: Error al agregar la nueva sesión: {e}")
+            logger.error("[ERROR_CONVERSATION_ARCHIVE]: Error al archivar la sesión %s: %s", session_id, e)
             return False
 
-    def generate_id(self):
-        timestamp = int(time.time() * 1000) 
-        random_suffix = random.randint(1000, 9999)
-        return f"{timestamp}{random_suffix}"
+    def archivable_query(self, older_than: timedelta):
+        """Filtro de las conversaciones en caliente creadas antes de `older_than` (fechas BSON o strings ISO)."""
+        cutoff = datetime.now(timezone.utc) - older_than
+        return {"$or": [{"created_at": {"$lt": cutoff}}, {"created_at": {"$lt": cutoff.isoformat()}}]}
+
+    def archive_older_than(self, older_than: timedelta, limit: int = 0):
+        """
+        Archiva las conversaciones creadas antes de `older_than`.
+        :return: (archivadas, pendientes de reintento)
+        """
+        cursor = self.collection.find(self.archivable_query(older_than), {"session_id": 1})
+        if limit:
+            cursor = cursor.limit(int(limit))
+        archived, retry = 0, 0
+        for doc in cursor:
+            if self.archive_session(doc["session_id"]):
+                archived += 1
+            else:
+                retry += 1
+        return archived, retry
+
+    def find_by_transmitter(self, transmitter_value, limit: int = None, after=None, summary: bool = False):
+        """
+        Itera las conversaciones de un transmitter ordenadas por (created_at, _id), combinando
+        el nivel caliente y el archivo (ambos cursores ordenados; se mezclan sin cargarlos).
+
+        :param limit: máximo de documentos (None = sin límite).
+        :param after: (created_at, _id) del último documento de la página anterior.
+        :param summary: excluir el historial ('message') del resultado.
+        """
+        query = {"transmitter": transmitter_value}
+        if after is not None:
+            created_at, last_id = after
+            if created_at is None:
+                query["$or"] = [{"created_at": {"$ne": None}}, {"created_at": None, "_id": {"$gt": last_id}}]
+            else:
+                query["$or"] = [{"created_at": {"$gt": created_at}}, {"created_at": created_at, "_id": {"$gt": last_id}}]
+                if isinstance(created_at, str):
+                    # created_at en formato anterior: las fechas BSON se ordenan después de los strings
+                    query["$or"].append({"created_at": {"$type": "date"}})
+        cursors = []
+        for collection in (self.collection, self.archive):
+            cursor = collection.find(query, {"message": 0} if summary else None).sort([("created_at", ASCENDING), ("_id", ASCENDING)])
+            if limit:
+                cursor = cursor.limit(int(limit))
+            cursors.append(cursor)
+        merged = self._dedupe_by_id(heapq.merge(*cursors, key=self._listing_key))
+        return itertools.islice(merged, int(limit)) if limit else merged
+
+    @staticmethod
+    def _listing_key(doc):
+        # mismo orden que Mongo: null < string (formato anterior) < date, y luego _id
+        created_at = doc.get("created_at")
+        rank = 0 if created_at is None else 1 if isinstance(created_at, str) else 2
+        return rank, created_at if rank else 0, doc.get("_id")
+
+    @staticmethod
+    def _dedupe_by_id(docs):
+        # una sesión puede estar en ambos niveles si su archivado quedó a medias: se devuelve una vez
+        last_id = object()
+        for doc in docs:
+            if doc.get("_id") != last_id:
+                last_id = doc.get("_id")
+                yield doc
+
+    def _find_archived(self, session_id, transmitter: str = None):
+        query = {"session_id": session_id}
+        if transmitter is not None:
+            query["transmitter"] = transmitter
+        try:
+            return self.archive.find_one(query)
+        except PyMongoError:
+            return None
 
     def get_conversation_by_session_id(self, session_id, transmitter: str = None):
         """
@@ -128,20 +736,64 @@ class Conversation:
             if transmitter is not None:
                 query["transmitter"] = transmitter
             conversations = list(self.collection.find(query))
-            return conversations
+            if not conversations:
+                archived = self._find_archived(session_id, transmitter)
+                return [archived] if archived else []
+            return [self.load_messages(c) for c in conversations]
         except PyMongoError as e:
             return []
 
-    def get_conversation(self, session_id, transmitter: str = None):
+    def get_conversation(self, session_id, transmitter: str = None, history_limit: int = None, since_message_id: str = None):
         """
         Devuelve un único documento de conversación por session_id (opcionalmente filtrando por transmitter).
+        Si la sesión ya no está en el nivel caliente se busca en el archivo.
+
+        El historial puede acotarse en el servidor para no transferir el array 'message' completo:
+        :param history_limit: devolver sólo los últimos N mensajes (proyección $slice).
+        :param since_message_id: devolver sólo los mensajes posteriores a ese message_id
+                                 (si no se encuentra, se devuelve el historial completo).
         """
         try:
+            query = {"session_id": session_id}
+            if transmitter is not None:
+                query["transmitter"] = transmitter
+            if since_message_id:
+                pipeline = [
+                    {"$match": query},
+                    {"$limit": 1},
+                    {"$addFields": {"message": self._history_window_expr(history_limit, since_message_id)}}
+                ]
+                docs = list(self.collection.aggregate(pipeline))
+                if docs:
+                    return self.load_messages(docs[0], history_limit, since_message_id)
+                return self.window_messages(self._find_archived(session_id, transmitter), history_limit, since_message_id)
+            if history_limit:
+                doc = self.collection.find_one(query, {"message": {"$slice": -int(history_limit)}})
+                if doc is None:
+                    return self.window_messages(self._find_archived(session_id, transmitter), history_limit)
+                return self.load_messages(doc, history_limit)
+            # sin ventana: get_conversation_by_session_id ya recurre al archivo
             docs = self.get_conversation_by_session_id(session_id, transmitter=transmitter)
             return docs[0] if docs else None
         except PyMongoError:
             return None
 
+    @staticmethod
+    def _history_window_expr(history_limit: int = None, since_message_id: str = None):
+        """
+        Expresión de agregación que recorta 'message' a los mensajes posteriores a `since_message_id`
+        y, opcionalmente, a los últimos `history_limit`.
+        """
+        # las cabeceras bucketed no tienen 'message': se tratan como array vacío
+        messages = {"$ifNull": ["$message", []]}
+        if since_message_id:
+            # $indexOfArray devuelve -1 si no existe: +1 => desde el inicio (historial completo)
+            start = {"$add": [{"$indexOfArray": [{"$ifNull": ["$message.message_id", []]}, since_message_id]}, 1]}
+            messages = {"$slice": [messages, start, {"$max": [{"$size": messages}, 1]}]}
+        if history_limit:
+            messages = {"$slice": [messages, -int(history_limit)]}
+        return messages
+
     def add_state(self, session_id, new_state):
         """
         Actualiza el array 'state' en un documento de conversación agregando nuevos estados.
@@ -149,15 +801,16 @@ class Conversation:
         :param new_state: El nuevo estado a agregar.
         :return: True si la actualización fue exitosa, False en caso contrario.
         """
+        if self.state_mode == STATE_MODE_KEYED:
+            return self.set_states(session_id, {new_state.get('name'): new_state.get('value')})
         try:
             # Agregar el nuevo estado al array 'state' sin sobrescribir los existentes
-            # SUGERENCIA: Para acceso rápido, podrías mantener un diccionario adicional 'states' en el documento:
-            # self.collection.update_one({"session_id": session_id}, {"$set": {f"states.{new_state['name']}": new_state['value']}})
             result = self.collection.update_one(
                 {"session_id": session_id},
-                {"$push": {"state": new_state}}
+                {"$push": {"state": new_state}, "$inc": {"revision": 1}}
             )
             if result.matched_count > 0:
+                self._emit_states(session_id, {new_state.get('name'): new_state.get('value')})
                 return True
             else:
                 return False
@@ -173,18 +826,200 @@ class Conversation:
         :return: True si la actualización fue exitosa, False en caso contrario.
         """
         try:
+            if self.state_mode == STATE_MODE_KEYED:
+                if not self._valid_state_name(state_name):
+                    return False
+                result = self.collection.update_one(
+                    {"session_id": session_id, f"states.{state_name}": {"$exists": True}},
+                    {"$set": {f"states.{state_name}": state_value}, "$inc": {"revision": 1}}
+                )
+                if result.matched_count > 0:
+                    self._emit_states(session_id, {state_name: state_value})
+                return result.matched_count > 0
             # Sobrescribe el valor del estado en el array 'state'
             result = self.collection.update_one(
                 {"session_id": session_id, "state.name": state_name},
-                {"$set": {"state.$.value": state_value}}  # Sobrescribe el valor del estado
+                {"$set": {"state.$.value": state_value}, "$inc": {"revision": 1}}  # Sobrescribe el valor del estado
             )
             if result.matched_count > 0:
+                self._emit_states(session_id, {state_name: state_value})
                 return True
             else:
                 return False
         except PyMongoError as e:
             return False
 
+    def set_states(self, session_id, states):
+        """
+        Inserta o reemplaza varios estados a la vez.
+
+        :param states: dict {name: value}.
+        :return: True si la sesión existe y se actualizó, False en caso contrario.
+        """
+        if not states or not all(self._valid_state_name(n) for n in states):
+            return False
+        try:
+            if self.state_mode == STATE_MODE_KEYED:
+                # una única escritura, sin importar cuántos estados ni si ya existían
+                result = self.collection.update_one(
+                    {"session_id": session_id},
+                    {"$set": {f"states.{name}": value for name, value in states.items()}, "$inc": {"revision": 1}}
+                )
+                if result.matched_count > 0:
+                    self._emit_states(session_id, states)
+                return result.matched_count > 0
+            ok = True
+            for name, value in states.items():
+                if not self.overwrite_state(session_id, name, value):
+                    ok = self.add_state(session_id, {"name": name, "value": value}) and ok
+            return ok
+        except PyMongoError:
+            return False
+
+    def remove_state(self, session_id, state_name):
+        """
+        Elimina un estado por nombre, sin importar el modo en que se guardó.
+        :return: True si se eliminó algo.
+        """
+        update = {"$pull": {"state": {"name": state_name}}, "$inc": {"revision": 1}}
+        exists = [{"state.name": state_name}]
+        if self._valid_state_name(state_name):
+            update["$unset"] = {f"states.{state_name}": ""}
+            exists.append({f"states.{state_name}": {"$exists": True}})
+        try:
+            # sólo si el estado existe: un borrado sin efecto no cambia la versión
+            result = self.collection.update_one({"session_id": session_id, "$or": exists}, update)
+            if result.matched_count > 0:
+                self._emit_states(session_id, removed=state_name)
+            return result.matched_count > 0
+        except PyMongoError:
+            return False
+
+    def get_states(self, session_id):
+        """
+        Devuelve los estados de la sesión como dict {name: value} (sólo proyecta los estados).
+        Combina ambos formatos; el mapa 'states' tiene prioridad. None si la sesión no existe.
+        """
+        try:
+            doc = self.collection.find_one({"session_id": session_id}, {"_id": 0, "state": 1, "states": 1})
+        except PyMongoError:
+            return None
+        if doc is None:
+            return None
+        states = {s.get("name"): s.get("value") for s in doc.get("state") or [] if isinstance(s, dict)}
+        states.update(doc.get("states") or {})
+        return states
+
+    def get_version(self, session_id):
+        """Versión de la conversación leyendo sólo sus contadores (índice session_id_unique); también busca en el archivo."""
+        projection = {"_id": 0, "usage.messages": 1, "revision": 1}
+        try:
+            doc = self.collection.find_one({"session_id": session_id}, projection) or self.archive.find_one({"session_id": session_id}, projection)
+        except PyMongoError as e:
+            logger.error("[ERROR_CONVERSATION_VERSION]: Error al leer la versión: %s", e)
+            return None
+        return conversation_version(doc) if doc is not None else None
+
+    # ----------------- consumo de tokens -----------------
+    def get_session_usage(self, session_id):
+        """
+        Totales de tokens de la sesión leídos de su campo 'usage' (sin proyectar los mensajes).
+        Sesiones anteriores a la contabilidad incremental devuelven ceros hasta correr
+        scripts/backfill_token_usage.py. También busca en el archivo.
+        """
+        projection = {"_id": 0, "session_id": 1, "transmitter": 1, "usage": 1}
+        try:
+            doc = self.collection.find_one({"session_id": session_id}, projection) or self.archive.find_one({"session_id": session_id}, projection)
+        except PyMongoError as e:
+            logger.error("[ERROR_TOKEN_USAGE]: Error al leer el consumo de la sesión: %s", e)
+            return None
+        if doc is None:
+            return None
+        usage = doc.get("usage") or {}
+        return {"session_id": doc["session_id"], "transmitter": doc.get("transmitter"), "usage": {field: usage.get(field, 0) for field in USAGE_FIELDS}}
+
+    @staticmethod
+    def _day_range(start_day: str = None, end_day: str = None):
+        days = {}
+        if start_day:
+            days["$gte"] = start_day
+        if end_day:
+            days["$lte"] = end_day
+        return days
+
+    def usage_by_day(self, transmitter, start_day: str = None, end_day: str = None):
+        """Acumulados diarios del contacto (índice transmitter_day_unique), ordenados por día."""
+        query = {"transmitter": transmitter}
+        days = self._day_range(start_day, end_day)
+        if days:
+            query["day"] = days
+        try:
+            return list(self.token_usage.find(query, {"_id": 0, "updated_at": 0}).sort("day", ASCENDING))
+        except PyMongoError as e:
+            logger.error("[ERROR_TOKEN_USAGE]: Error al leer token_usage: %s", e)
+            return []
+
+    def usage_by_contact(self, start_day: str = None, end_day: str = None, limit: int = None):
+        """Suma por contacto de los acumulados diarios del rango (sólo lee token_usage, no 'conversation')."""
+        pipeline = []
+        days = self._day_range(start_day, end_day)
+        if days:
+            pipeline.append({"$match": {"day": days}})
+        pipeline.append({"$group": {"_id": "$transmitter", **{field: {"$sum": f"${field}"} for field in USAGE_FIELDS + ("sessions",)}}})
+        pipeline.append({"$sort": {"total_tokens": -1, "_id": 1}})
+        if limit:
+            pipeline.append({"$limit": int(limit)})
+        pipeline.append({"$project": {"_id": 0, "transmitter": "$_id", **{field: 1 for field in USAGE_FIELDS + ("sessions",)}}})
+        try:
+            return list(self.token_usage.aggregate(pipeline))
+        except PyMongoError as e:
+            logger.error("[ERROR_TOKEN_USAGE]: Error al agregar token_usage: %s", e)
+            return []
+
+    # ----------------- búsqueda -----------------
+    def search_candidates(self, terms, transmitter: str = None, since: datetime = None, until: datetime = None, limit: int = 1000):
+        """
+        Mensajes que contienen todos los `terms` ($all sobre el índice multikey), filtrados por
+        contacto y fecha, los más recientes primero. Sólo se proyectan las frecuencias de los términos buscados.
+        """
+        if not terms:
+            return []
+        query = {"terms": {"$all": list(terms)}}
+        if transmitter:
+            query["transmitter"] = transmitter
+        created = {}
+        if since:
+            created["$gte"] = since
+        if until:
+            created["$lt"] = until
+        if created:
+            query["created_at"] = created
+        projection = {"session_id": 1, "transmitter": 1, "created_at": 1, "role": 1, "snippet": 1, "length": 1, **{f"tf.{term}": 1 for term in terms}}
+        try:
+            return list(self.message_search.find(query, projection).sort("created_at", DESCENDING).limit(int(limit)))
+        except PyMongoError as e:
+            logger.error("[ERROR_SEARCH]: Error al consultar message_search: %s", e)
+            return []
+
+    # ----------------- idempotencia de mensajes entrantes -----------------
+    def claim_inbound(self, key: str) -> bool:
+        """La reserva es el insert con _id = key: DuplicateKeyError indica un mensaje ya recibido."""
+        try:
+            self.inbound_keys.insert_one({"_id": key, "created_at": datetime.now(timezone.utc)})
+            return True
+        except DuplicateKeyError:
+            return False
+        except PyMongoError as e:
+            # ante un error se escribe igual: es preferible un duplicado a perder el mensaje
+            logger.error("[ERROR_INBOUND_KEY]: No se pudo reservar la clave %s: %s", key, e)
+            return True
+
+    def release_inbound(self, key: str):
+        try:
+            self.inbound_keys.delete_one({"_id": key})
+        except PyMongoError as e:
+            logger.error("[ERROR_INBOUND_KEY]: No se pudo liberar la clave %s: %s", key, e)
+
     def update_conversation(self, session_id, update_data):
         """
         Actualiza un documento de conversación por su ID.
@@ -196,7 +1031,7 @@ class Conversation:
         try:
             result = self.collection.update_one(
                 {"session_id": session_id},
-                {"$set": update_data}
+                {"$set": update_data, "$inc": {"revision": 1}}
             )
             if result.matched_count > 0:
                 return True
@@ -213,10 +1048,15 @@ class Conversation:
         :return: True si la eliminación fue exitosa, False en caso contrario.
         """
         try:
-            result = self.collection.delete_one({"_id": ObjectId(conversation_id)})
-            if result.deleted_count > 0:
-                return True
-            else:
+            doc = self.collection.find_one_and_delete({"_id": ObjectId(conversation_id)}, projection={"session_id": 1, "layout": 1})
+            if doc is None:
+                doc = self.archive.find_one_and_delete({"_id": ObjectId(conversation_id)}, projection={"session_id": 1})
+            if doc is None:
                 return False
+            if doc.get("layout") == LAYOUT_BUCKETED:
+                self.buckets.delete_many({"session_id": doc.get("session_id")})
+            if self.search_enabled:
+                self.message_search.delete_many({"session_id": doc.get("session_id")})
+            return True
         except PyMongoError as e:
             return False
\ No newline at end of file
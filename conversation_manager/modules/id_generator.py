@@ -0,0 +1,95 @@
+import base64
+import os
+import random
+import threading
+import time
+
+# Identificadores de 24 caracteres en base32 de Crockford, ordenables lexicográficamente:
+#
+#   | timestamp ms (48 bits) | nodo (32 bits) | secuencia (40 bits) |
+#
+# - timestamp: milisegundos desde epoch; nunca retrocede dentro del proceso (si el reloj
+#   vuelve atrás se sigue usando el último valor visto).
+# - nodo: componente aleatorio por proceso, regenerado tras un fork, para que dos workers
+#   no compartan el mismo espacio de IDs.
+# - secuencia: contador que se reinicia en cada milisegundo nuevo; dentro del mismo
+#   milisegundo (o con el reloj detenido) se incrementa, por lo que un proceso nunca repite un ID.
+#
+# El alfabeto de Crockford está en orden ASCII, así que el orden de los strings coincide con
+# el orden numérico (y por tanto temporal) de los IDs.
+
+_RFC4648 = b"ABCDEFGHIJKLMNOPQRSTUVWXYZ234567"
+_CROCKFORD = b"0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+_FROM_CROCKFORD = bytes.maketrans(_CROCKFORD, _RFC4648)
+# pares de caracteres para cada valor de 10 bits: la secuencia se codifica con 4 búsquedas
+_PAIRS = [chr(_CROCKFORD[i >> 5]) + chr(_CROCKFORD[i & 31]) for i in range(1024)]
+
+ID_LENGTH = 24
+_SEQUENCE_BITS = 40
+_NODE_BITS = 32
+_MAX_SEQUENCE = (1 << _SEQUENCE_BITS) - 1
+
+
+class IdGenerator:
+    """
+    Generador de IDs monótono y sin colisiones dentro del proceso (seguro entre hilos).
+    """
+
+    def __init__(self, node: int = None):
+        self._lock = threading.Lock()
+        self.node = (node if node is not None else random.getrandbits(_NODE_BITS)) & ((1 << _NODE_BITS) - 1)
+        self._last_ms = 0
+        self._sequence = 0
+        self._prefix = ""
+
+    def _encode_prefix(self, ms: int) -> str:
+        # timestamp + nodo = 80 bits = 16 caracteres; se calcula una vez por milisegundo
+        value = (ms << _NODE_BITS) | self.node
+        return "".join(_PAIRS[(value >> shift) & 1023] for shift in range(70, -1, -10))
+
+    def new_id(self) -> str:
+        now = time.time_ns() // 1_000_000
+        with self._lock:
+            if now > self._last_ms:
+                self._last_ms = now
+                self._sequence = 0
+                self._prefix = self._encode_prefix(now)
+            else:
+                self._sequence += 1
+                if self._sequence > _MAX_SEQUENCE:
+                    # secuencia agotada en este milisegundo: se toma prestado el siguiente
+                    self._last_ms += 1
+                    self._sequence = 0
+                    self._prefix = self._encode_prefix(self._last_ms)
+            seq = self._sequence
+            prefix = self._prefix
+        return prefix + _PAIRS[seq >> 30] + _PAIRS[(seq >> 20) & 1023] + _PAIRS[(seq >> 10) & 1023] + _PAIRS[seq & 1023]
+
+    def reseed(self, node: int = None):
+        """Cambia el nodo y reinicia el estado (se usa en el hijo tras un fork)."""
+        self.__init__(node)
+
+
+_generator = IdGenerator()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_generator.reseed)
+
+
+def new_id() -> str:
+    """Devuelve un ID nuevo del generador del proceso."""
+    return _generator.new_id()
+
+
+def id_timestamp_ms(value: str):
+    """
+    Milisegundos desde epoch codificados en un ID generado por este módulo,
+    o None si `value` no tiene ese formato (p.ej. IDs numéricos antiguos).
+    """
+    if not isinstance(value, str) or len(value) != ID_LENGTH:
+        return None
+    try:
+        raw = base64.b32decode(value.upper().encode("ascii").translate(_FROM_CROCKFORD))
+    except (ValueError, UnicodeEncodeError):
+        return None
+    return int.from_bytes(raw, "big") >> (_NODE_BITS + _SEQUENCE_BITS)
@@ -0,0 +1,474 @@
+from collections import OrderedDict, deque
+from typing import Any, Dict, List, Optional
+import json
+import logging
+import os
+import threading
+import uuid
+
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# Origen de los eventos en vivo (mensajes y estados escritos), ver build_live_updates:
+# - local: los publica el propio proceso desde el hook de escritura del store (ConversationStore.event_hook).
+#   Con varios workers, un suscriptor sólo vería lo escrito por su worker: se rechaza si GUNICORN_WORKERS > 1.
+# - redis: el hook de cada proceso publica en un canal de Redis pub/sub y cada proceso reparte lo
+#   recibido a sus suscriptores, por lo que se ven las escrituras de todos los workers y del consumidor.
+# - change_stream: cada proceso sigue el change stream de Mongo (requiere replica set: en un servidor
+#   standalone falla y se reintenta sin entregar eventos), por lo que ve las escrituras de todos los
+#   workers y servicios, incluso las que no pasan por conversation_manager.
+SOURCE_LOCAL = "local"
+SOURCE_REDIS = "redis"
+SOURCE_CHANGE_STREAM = "change_stream"
+SOURCES = (SOURCE_LOCAL, SOURCE_REDIS, SOURCE_CHANGE_STREAM)
+
+EVENT_MESSAGE = "message"
+EVENT_STATE = "state"
+EVENT_STATE_REMOVED = "state_removed"
+# el suscriptor perdió eventos (buffer lleno o Last-Event-ID fuera del historial): debe releer la conversación
+EVENT_RESYNC = "resync"
+
+
+class Subscription:
+    """
+    Suscripción a los eventos de una sesión o de un contacto, con un buffer acotado.
+
+    `offer` nunca bloquea a quien escribe: si el buffer está lleno se descartan los eventos
+    pendientes y se deja un único evento "resync" (el cliente relee la conversación), de modo que
+    un consumidor lento no retiene memoria ni frena las escrituras.
+    """
+
+    def __init__(self, session_id: Optional[str], transmitter: Optional[str], max_buffer: int):
+        self.session_id = session_id
+        self.transmitter = transmitter
+        self.max_buffer = max(1, max_buffer)
+        self.dropped = 0
+        self.closed = False
+        self._events: deque = deque()
+        self._cond = threading.Condition()
+
+    def matches(self, event: Dict[str, Any]) -> bool:
+        if self.session_id is not None:
+            return event.get("session_id") == self.session_id
+        return event.get("transmitter") == self.transmitter
+
+    def offer(self, event: Dict[str, Any]):
+        with self._cond:
+            if self.closed:
+                return
+            if len(self._events) >= self.max_buffer:
+                self.dropped += len(self._events)
+                self._events.clear()
+                self._events.append({"id": event["id"], "type": EVENT_RESYNC, "session_id": self.session_id, "transmitter": self.transmitter})
+            elif not self._events or self._events[-1]["type"] != EVENT_RESYNC:
+                self._events.append(event)
+            else:
+                # ya se pidió releer: los eventos siguientes quedan cubiertos por esa lectura
+                self.dropped += 1
+            self._cond.notify()
+
+    def get(self, timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """Próximo evento, o None si no llegó ninguno en `timeout` segundos o la suscripción se cerró."""
+        with self._cond:
+            if not self._events and not self.closed:
+                self._cond.wait(timeout)
+            return self._events.popleft() if self._events else None
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class LiveUpdates:
+    """
+    Distribuye en el proceso los eventos de mensajes y estados escritos a los suscriptores
+    (endpoint SSE /api/stream), indexados por session_id y por transmitter.
+
+    Cada evento recibe un id "<época>.<secuencia>" y se guarda en un historial acotado
+    (`replay_size`) para que un cliente que se reconecta con Last-Event-ID reciba lo que se perdió;
+    si el id es de otro proceso o ya salió del historial recibe "resync".
+    """
+
+    def __init__(self, source: str = SOURCE_LOCAL, max_buffer: int = 256, max_subscribers: int = 2, replay_size: int = 1000):
+        self.source = source
+        self.max_buffer = max_buffer
+        self.max_subscribers = max_subscribers
+        self._lock = threading.Lock()
+        self._by_session: Dict[str, List[Subscription]] = {}
+        self._by_transmitter: Dict[str, List[Subscription]] = {}
+        self._replay: deque = deque(maxlen=max(1, replay_size))
+        # session_id -> transmitter aprendido de los eventos de mensajes (los de estados no lo traen)
+        self._transmitters: "OrderedDict[str, str]" = OrderedDict()
+        self._epoch = uuid.uuid4().hex[:8]
+        self._seq = 0
+        self._feed = None
+        self.published = 0
+        # eventos descartados por suscriptores ya desconectados
+        self._dropped = 0
+
+    # ----------------- publicación -----------------
+    def publish(self, event: Dict[str, Any]):
+        """Asigna id al evento y lo entrega a los suscriptores de su sesión y de su contacto."""
+        with self._lock:
+            session_id = event.get("session_id")
+            if event.get("transmitter"):
+                self._transmitters[session_id] = event["transmitter"]
+                self._transmitters.move_to_end(session_id)
+                if len(self._transmitters) > 10000:
+                    self._transmitters.popitem(last=False)
+            else:
+                event["transmitter"] = self._transmitters.get(session_id)
+            self._seq += 1
+            event["id"] = f"{self._epoch}.{self._seq}"
+            self._replay.append(event)
+            self.published += 1
+            targets = list(self._by_session.get(session_id, ()))
+            if event["transmitter"]:
+                targets.extend(self._by_transmitter.get(event["transmitter"], ()))
+        for subscription in targets:
+            subscription.offer(event)
+
+    # ----------------- suscripción -----------------
+    def subscribe(self, session_id: Optional[str] = None, transmitter: Optional[str] = None, last_event_id: Optional[str] = None) -> Optional[Subscription]:
+        """
+        Suscribe a una sesión o (sin session_id) a un contacto. Con `last_event_id` se entregan
+        primero los eventos posteriores que sigan en el historial. None si se alcanzó `max_subscribers`.
+        """
+        if self._feed is not None:
+            self._feed.ensure_running()
+        subscription = Subscription(session_id, None if session_id else transmitter, self.max_buffer)
+        with self._lock:
+            if self.subscribers() >= self.max_subscribers:
+                return None
+            index, key = (self._by_session, session_id) if session_id else (self._by_transmitter, transmitter)
+            index.setdefault(key, []).append(subscription)
+            if last_event_id:
+                for event in self._missed(last_event_id, subscription):
+                    subscription.offer(event)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscription.close()
+        index, key = (self._by_session, subscription.session_id) if subscription.session_id else (self._by_transmitter, subscription.transmitter)
+        with self._lock:
+            subscriptions = index.get(key, [])
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+                self._dropped += subscription.dropped
+            if not subscriptions:
+                index.pop(key, None)
+
+    def _missed(self, last_event_id: str, subscription: Subscription) -> List[Dict[str, Any]]:
+        epoch, _, seq = last_event_id.partition(".")
+        oldest = self._seq - len(self._replay) + 1
+        if epoch != self._epoch or not seq.isdigit() or int(seq) + 1 < oldest:
+            return [{"id": f"{self._epoch}.{self._seq}", "type": EVENT_RESYNC, "session_id": subscription.session_id, "transmitter": subscription.transmitter}]
+        return [event for event in self._replay if int(event["id"].rpartition(".")[2]) > int(seq) and subscription.matches(event)]
+
+    def resync_all(self):
+        """Pide releer a todos los suscriptores: el origen perdió eventos (p.ej. al reconectar con Redis)."""
+        with self._lock:
+            self._seq += 1
+            event_id = f"{self._epoch}.{self._seq}"
+            # lo anterior del historial ya no alcanza para reconstruir lo perdido con Last-Event-ID
+            self._replay.clear()
+            subscriptions = [s for group in list(self._by_session.values()) + list(self._by_transmitter.values()) for s in group]
+        for subscription in subscriptions:
+            subscription.offer({"id": event_id, "type": EVENT_RESYNC, "session_id": subscription.session_id, "transmitter": subscription.transmitter})
+
+    def subscribers(self) -> int:
+        return sum(len(s) for s in self._by_session.values()) + sum(len(s) for s in self._by_transmitter.values())
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            subscriptions = [s for group in list(self._by_session.values()) + list(self._by_transmitter.values()) for s in group]
+        return {
+            "source": self.source, "subscribers": len(subscriptions), "max_subscribers": self.max_subscribers,
+            "published": self.published, "dropped": self._dropped + sum(s.dropped for s in subscriptions),
+            "max_buffer": self.max_buffer, "feed": self._feed.stats() if self._feed is not None else None,
+        }
+
+    def close(self):
+        if self._feed is not None:
+            self._feed.stop()
+        with self._lock:
+            subscriptions = [s for group in list(self._by_session.values()) + list(self._by_transmitter.values()) for s in group]
+        for subscription in subscriptions:
+            subscription.close()
+
+
+class RedisFeed:
+    """
+    Reparte los eventos entre procesos por Redis pub/sub. `publish` es el hook de escritura del
+    store: envía el evento al canal en lugar de entregarlo localmente, y un hilo por proceso
+    (iniciado con la primera suscripción) entrega al hub todo lo recibido del canal, incluido lo
+    escrito por el propio proceso. Pub/sub no guarda lo publicado mientras el hilo está
+    desconectado: al reconectar se envía "resync" a los suscriptores.
+    """
+
+    def __init__(self, client, hub: LiveUpdates, channel: str):
+        self.client = client
+        self.hub = hub
+        self.channel = channel
+        self._thread: Optional[threading.Thread] = None
+        self._pid = None
+        self._stop = threading.Event()
+        self._subscribed = threading.Event()
+        self.errors = 0
+
+    def publish(self, event: Dict[str, Any]):
+        try:
+            self.client.publish(self.channel, json.dumps(event, ensure_ascii=False, separators=(",", ":"), default=str))
+        except Exception as e:
+            self.errors += 1
+            logger.error("[ERROR_LIVE_UPDATES]: No se pudo publicar el evento en Redis: %s", e)
+
+    def ensure_running(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self.hub._lock:
+            if self._thread is None or self._pid != os.getpid():
+                # un hilo no sobrevive a un fork: cada worker tiene su propia suscripción
+                self._pid = os.getpid()
+                self._subscribed.clear()
+                self._thread = threading.Thread(target=self._run, name="live-updates-redis", daemon=True)
+                self._thread.start()
+        # lo escrito antes de que el hilo se suscriba no llegaría a la primera suscripción
+        self._subscribed.wait(2.0)
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"running": self._thread is not None and self._thread.is_alive(), "channel": self.channel, "errors": self.errors}
+
+    def _run(self):
+        backoff, reconnect = 1.0, False
+        while not self._stop.is_set():
+            pubsub = None
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                self._subscribed.set()
+                if reconnect:
+                    self.hub.resync_all()
+                reconnect, backoff = True, 1.0
+                while not self._stop.is_set():
+                    item = pubsub.get_message(timeout=1.0)
+                    if item is None:
+                        continue
+                    try:
+                        event = json.loads(item["data"])
+                    except (TypeError, ValueError):
+                        continue
+                    self.hub.publish(event)
+            except Exception as e:
+                self.errors += 1
+                logger.error("[ERROR_LIVE_UPDATES]: Error en la suscripción a Redis, se reintenta en %.0f s: %s", backoff, e)
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 60.0)
+            finally:
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+
+
+class ChangeStreamFeed:
+    """
+    Publica en el hub los mensajes y estados escritos en 'conversation' y 'conversation_buckets'
+    leyendo el change stream de la base (un hilo por proceso, iniciado con la primera suscripción).
+
+    Los updates se leen con fullDocument=updateLookup pero sólo se proyectan session_id y
+    transmitter (los documentos completos no salen del servidor); los mensajes y estados se
+    toman de updatedFields ("message.N", "messages.N", "states.<name>", "state.N").
+    Tras un error se reanuda desde el último resume token.
+    """
+
+    def __init__(self, store, hub: LiveUpdates):
+        self.store = store
+        self.hub = hub
+        self._thread: Optional[threading.Thread] = None
+        self._pid = None
+        self._stop = threading.Event()
+        self._resume_token = None
+        self.errors = 0
+
+    def ensure_running(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self.hub._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            # un hilo no sobrevive a un fork: cada worker sigue su propio change stream
+            self._pid, self._resume_token = os.getpid(), None
+            self._thread = threading.Thread(target=self._run, name="live-updates-change-stream", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"running": self._thread is not None and self._thread.is_alive(), "errors": self.errors}
+
+    def _pipeline(self):
+        collections = [self.store.collection.name, self.store.buckets.name]
+        inserted = {"$eq": ["$operationType", "insert"]}
+        return [
+            {"$match": {"ns.coll": {"$in": collections}, "operationType": {"$in": ["insert", "update"]}}},
+            {"$project": {
+                "ns": 1, "operationType": 1, "updateDescription": 1,
+                "fullDocument.session_id": 1, "fullDocument.transmitter": 1,
+                "fullDocument.message": {"$cond": [inserted, "$fullDocument.message", "$$REMOVE"]},
+                "fullDocument.messages": {"$cond": [inserted, "$fullDocument.messages", "$$REMOVE"]},
+                "fullDocument.states": {"$cond": [inserted, "$fullDocument.states", "$$REMOVE"]},
+            }},
+        ]
+
+    def _run(self):
+        backoff = 1.0
+        while not self._stop.is_set():
+            try:
+                with self.store.db_manager.db.watch(self._pipeline(), full_document="updateLookup", resume_after=self._resume_token, max_await_time_ms=1000) as stream:
+                    while not self._stop.is_set():
+                        change = stream.try_next()
+                        if change is None:
+                            continue
+                        self._resume_token = stream.resume_token
+                        backoff = 1.0
+                        for event in self.events(change):
+                            self.hub.publish(event)
+            except PyMongoError as e:
+                # p.ej. un servidor sin replica set: reintentos cada vez más espaciados (hasta 60 s)
+                self.errors += 1
+                logger.error("[ERROR_LIVE_UPDATES]: Error en el change stream, se reintenta en %.0f s: %s", backoff, e)
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 60.0)
+
+    @staticmethod
+    def events(change: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Eventos del hub para un cambio del change stream."""
+        doc = change.get("fullDocument") or {}
+        session_id = doc.get("session_id")
+        if not session_id:
+            return []
+        base = {"session_id": session_id, "transmitter": doc.get("transmitter")}
+        if change.get("operationType") == "insert":
+            messages = doc.get("message") or doc.get("messages") or []
+            events = [{**base, "type": EVENT_MESSAGE, "message": m} for m in messages]
+            if doc.get("states"):
+                events.append({**base, "type": EVENT_STATE, "states": doc["states"]})
+            return events
+        description = change.get("updateDescription") or {}
+        messages, states, events = [], {}, []
+        for path, value in (description.get("updatedFields") or {}).items():
+            field, _, rest = path.partition(".")
+            if field in ("message", "messages"):
+                if rest.isdigit():
+                    messages.append((int(rest), [value]))
+                elif not rest and isinstance(value, list):
+                    # array reescrito completo ($position 0 al crear una sesión con appends adelantados)
+                    messages.append((-1, value))
+            elif field == "states" and rest:
+                states[rest] = value
+            elif field == "state" and rest.isdigit() and isinstance(value, dict):
+                states[value.get("name")] = value.get("value")
+        for _, values in sorted(messages, key=lambda item: item[0]):
+            events.extend({**base, "type": EVENT_MESSAGE, "message": m} for m in values)
+        if states:
+            events.append({**base, "type": EVENT_STATE, "states": states})
+        for path in description.get("removedFields") or []:
+            field, _, name = path.partition(".")
+            if field == "states" and name:
+                events.append({**base, "type": EVENT_STATE_REMOVED, "name": name})
+        return events
+
+
+def default_max_subscribers() -> int:
+    """
+    Streams simultáneos por proceso si no se indica LIVE_UPDATES_MAX_SUBSCRIBERS. Con workers de
+    hilos (gthread, ver gunicorn.conf.py) cada stream ocupa uno de los GUNICORN_THREADS (4) durante
+    toda su duración: se admite la mitad, para que el resto siga atendiendo process_message. Con
+    workers asíncronos (gevent / eventlet) un stream no bloquea un hilo y el límite es 64.
+    """
+    worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread").strip().lower()
+    if worker_class in ("gevent", "eventlet"):
+        return 64
+    try:
+        threads = int(os.getenv("GUNICORN_THREADS", 4))
+    except ValueError:
+        threads = 4
+    return max(0, threads // 2)
+
+
+def worker_count() -> int:
+    """Workers de gunicorn que atienden la app (gunicorn.conf.py exporta GUNICORN_WORKERS; 1 fuera de gunicorn)."""
+    try:
+        return int(os.getenv("GUNICORN_WORKERS", 1))
+    except ValueError:
+        return 1
+
+
+def _redis_client():
+    """Cliente Redis de REDIS_HOST, REDIS_PORT y REDIS_PASSWORD, o None si el paquete `redis` no está instalado."""
+    try:
+        import redis
+    except ImportError:
+        return None
+    return redis.Redis(
+        host=os.getenv("REDIS_HOST", "localhost"),
+        port=int(os.getenv("REDIS_PORT", 6379)),
+        password=os.getenv("REDIS_PASSWORD") or None
+    )
+
+
+def build_live_updates(store) -> Optional[LiveUpdates]:
+    """
+    Crea el hub de eventos en vivo según el entorno (None si está desactivado):
+
+    - LIVE_UPDATES_SOURCE (local | redis | change_stream | off): origen de los eventos.
+      local sólo con un worker (con varios se desactiva: cada suscriptor perdería lo escrito por
+      los demás); redis reparte los eventos por LIVE_UPDATES_REDIS_CHANNEL
+      (conversation_manager:live_updates) con REDIS_HOST/REDIS_PORT/REDIS_PASSWORD; change_stream
+      sólo con el backend mongo desplegado como replica set. redis y change_stream no entregan
+      localmente desde el hook (evita eventos duplicados).
+    - LIVE_UPDATES_BUFFER (256): eventos pendientes por suscriptor antes de pedirle "resync".
+    - LIVE_UPDATES_MAX_SUBSCRIBERS (ver `default_max_subscribers`: la mitad de GUNICORN_THREADS):
+      streams simultáneos por proceso.
+    - LIVE_UPDATES_REPLAY (1000): eventos recientes disponibles para reconexiones con Last-Event-ID.
+    """
+    source = os.getenv("LIVE_UPDATES_SOURCE", SOURCE_LOCAL).strip().lower()
+    if source not in SOURCES:
+        if source not in ("", "off", "none", "false", "0"):
+            logger.warning("[LIVE_UPDATES]: LIVE_UPDATES_SOURCE desconocido %r, se desactiva", source)
+        return None
+    if source == SOURCE_CHANGE_STREAM and not hasattr(store, "db_manager"):
+        logger.warning("[LIVE_UPDATES]: change_stream requiere el backend mongo, se usa el hook local")
+        source = SOURCE_LOCAL
+    client = _redis_client() if source == SOURCE_REDIS else None
+    if source == SOURCE_REDIS and client is None:
+        logger.warning("[LIVE_UPDATES]: paquete 'redis' no instalado; se usa el hook local")
+        source = SOURCE_LOCAL
+    if source == SOURCE_LOCAL and worker_count() > 1:
+        logger.error(
+            "[LIVE_UPDATES]: LIVE_UPDATES_SOURCE=local con %d workers: cada stream sólo vería lo escrito por su worker; "
+            "se desactivan los eventos en vivo (usar redis o change_stream)", worker_count()
+        )
+        return None
+    hub = LiveUpdates(
+        source,
+        max_buffer=int(os.getenv("LIVE_UPDATES_BUFFER", 256)),
+        max_subscribers=int(os.getenv("LIVE_UPDATES_MAX_SUBSCRIBERS") or default_max_subscribers()),
+        replay_size=int(os.getenv("LIVE_UPDATES_REPLAY", 1000)),
+    )
+    if source == SOURCE_CHANGE_STREAM:
+        hub._feed = ChangeStreamFeed(store, hub)
+    elif source == SOURCE_REDIS:
+        hub._feed = RedisFeed(client, hub, os.getenv("LIVE_UPDATES_REDIS_CHANNEL", "conversation_manager:live_updates"))
+        store.event_hook = hub._feed.publish
+    else:
+        store.event_hook = hub.publish
+    return hub
@@ -0,0 +1,108 @@
+from typing import List
+import os
+
+# Métricas Prometheus del servicio. `prometheus_client` es opcional: si no está instalado (o con
+# METRICS_ENABLED=false) las métricas son objetos vacíos y /metrics responde 404.
+#
+# Con varios workers de gunicorn, PROMETHEUS_MULTIPROC_DIR debe apuntar a un directorio
+# compartido (vacío al arrancar) para que /metrics agregue los valores de todos los procesos.
+try:
+    import prometheus_client
+    from prometheus_client import Counter, Histogram
+except ImportError:
+    prometheus_client = None
+
+ENABLED = prometheus_client is not None and os.getenv("METRICS_ENABLED", "true").strip().lower() in ("1", "true", "yes", "on")
+# medir el tamaño de comandos/respuestas de Mongo requiere serializarlos otra vez (BSON)
+MONGO_DOC_SIZES = os.getenv("METRICS_MONGO_DOC_SIZES", "true").strip().lower() in ("1", "true", "yes", "on")
+
+_SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+class _NoopMetric:
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount: float = 1):
+        pass
+
+    def observe(self, value: float):
+        pass
+
+
+if ENABLED:
+    HTTP_REQUEST_DURATION = Histogram(
+        "conversation_manager_http_request_duration_seconds", "Duración de las peticiones HTTP por ruta.",
+        ["method", "route", "status"]
+    )
+    SESSIONS = Counter(
+        "conversation_manager_sessions_total", "Mensajes procesados según si crearon una sesión o usaron una existente.",
+        ["outcome"]
+    )
+    SESSION_CACHE = Counter(
+        "conversation_manager_session_cache_total", "Consultas a la cache de sesiones activas.",
+        ["result"]
+    )
+    MONGO_COMMAND_DURATION = Histogram(
+        "conversation_manager_mongo_command_duration_seconds", "Duración de los comandos de MongoDB.",
+        ["command", "outcome"]
+    )
+    MONGO_COMMAND_BYTES = Histogram(
+        "conversation_manager_mongo_command_bytes", "Tamaño (BSON) de los comandos enviados a MongoDB.",
+        ["command"], buckets=_SIZE_BUCKETS
+    )
+    MONGO_REPLY_BYTES = Histogram(
+        "conversation_manager_mongo_reply_bytes", "Tamaño (BSON) de las respuestas de MongoDB.",
+        ["command"], buckets=_SIZE_BUCKETS
+    )
+    WRITE_BEHIND_BATCH = Histogram(
+        "conversation_manager_write_behind_batch_messages", "Mensajes por lote de la cola de escritura diferida.",
+        ["outcome"], buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+    )
+else:
+    HTTP_REQUEST_DURATION = SESSIONS = SESSION_CACHE = _NoopMetric()
+    MONGO_COMMAND_DURATION = MONGO_COMMAND_BYTES = MONGO_REPLY_BYTES = _NoopMetric()
+    WRITE_BEHIND_BATCH = _NoopMetric()
+
+
+def mongo_event_listeners() -> List:
+    """Listeners de pymongo a registrar en el MongoClient (vacío si las métricas están desactivadas)."""
+    if not ENABLED:
+        return []
+    from pymongo import monitoring
+    import bson
+
+    class MongoCommandMetrics(monitoring.CommandListener):
+        """Registra la duración de cada comando y, opcionalmente, el tamaño de comando y respuesta."""
+
+        def started(self, event):
+            if MONGO_DOC_SIZES:
+                MONGO_COMMAND_BYTES.labels(event.command_name).observe(len(bson.encode(event.command)))
+
+        def succeeded(self, event):
+            MONGO_COMMAND_DURATION.labels(event.command_name, "succeeded").observe(event.duration_micros / 1e6)
+            if MONGO_DOC_SIZES:
+                MONGO_REPLY_BYTES.labels(event.command_name).observe(len(bson.encode(event.reply)))
+
+        def failed(self, event):
+            MONGO_COMMAND_DURATION.labels(event.command_name, "failed").observe(event.duration_micros / 1e6)
+
+    return [MongoCommandMetrics()]
+
+
+def render():
+    """Exposición en formato texto de Prometheus: (body, content_type)."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import CollectorRegistry, multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid: int):
+    """Limpia los archivos de métricas de un worker terminado (modo multiproceso)."""
+    if ENABLED and os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,130 @@
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional
+import os
+import re
+import unicodedata
+
+from modules.storage import as_utc_datetime
+
+# Búsqueda por palabras sobre el contenido de los mensajes.
+#
+# Al escribir cada mensaje se normaliza su texto (minúsculas, sin tildes, sin stopwords del
+# español, plural simple -> singular) y se guarda un documento de búsqueda por mensaje con sus
+# términos (índice invertido sobre un campo multikey, ver Conversation.search_candidates) y la
+# frecuencia de cada uno. Una consulta toma las coincidencias más recientes que contienen todos
+# los términos y las ordena con BM25 (sin idf: todas contienen todos los términos).
+
+SPANISH_STOPWORDS = frozenset("""
+a al algo algun alguna algunas alguno algunos ante antes aqui asi aun bien cada como con contra cual
+cuando de del desde donde dos el ella ellas ello ellos en entre era eran es esa esas ese eso esos esta
+estaba estado estan estar este esto estos fue fueron ha hace hasta hay la las le les lo los mas me mi
+mis mucho muy nada ni no nos nosotros o os otra otro para pero poco por porque que quien se sea segun
+ser si sin sobre solo su sus tambien tan te tiene tienen todo todos tu tus un una uno unos usted
+ustedes y ya yo
+""".split())
+
+_TOKEN = re.compile(r"[^\W_]+")
+MAX_SNIPPET = 280
+# BM25: saturación de frecuencia y normalización por longitud (en términos) de un mensaje típico
+BM25_K1 = 1.2
+BM25_B = 0.75
+AVG_MESSAGE_TERMS = 12
+
+
+def index_enabled() -> bool:
+    """SEARCH_INDEX_ENABLED (1 por defecto): indexar los mensajes al escribirlos."""
+    return os.getenv("SEARCH_INDEX_ENABLED", "1").strip().lower() not in ("0", "false", "no", "off")
+
+
+def _fold(text: str) -> str:
+    """Minúsculas sin diacríticos ("Pedído" -> "pedido"); la ñ se conserva."""
+    decomposed = unicodedata.normalize("NFD", text.lower().replace("ñ", "\0"))
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).replace("\0", "ñ")
+
+
+def _stem(token: str) -> str:
+    # plural regular: "pedidos" -> "pedido", "envios" -> "envio", "direcciones" -> "direccion"
+    if token.isdigit():
+        return token
+    if len(token) > 5 and token.endswith("es") and token[-3] in "nrld":
+        return token[:-2]
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+
+def tokenize(text: Any) -> List[str]:
+    """Términos normalizados del texto, en orden (con repeticiones)."""
+    if text is None:
+        return []
+    if not isinstance(text, str):
+        text = str(text)
+    return [_stem(t) for t in _TOKEN.findall(_fold(text)) if t not in SPANISH_STOPWORDS and (len(t) > 1 or t.isdigit())]
+
+
+def query_terms(query: str) -> List[str]:
+    """Términos distintos de una consulta, normalizados igual que los mensajes."""
+    return list(dict.fromkeys(tokenize(query)))
+
+
+def search_document(session_id: str, transmitter: Optional[str], message: Dict[str, Any], created_at: Optional[datetime] = None) -> Optional[Dict[str, Any]]:
+    """
+    Documento de búsqueda de un mensaje (ver `build_message_entry`), o None si no tiene términos.
+    `_id` es el message_id, de modo que reindexar un mensaje es idempotente.
+    """
+    terms = tokenize(message.get("content"))
+    if not terms or not message.get("message_id"):
+        return None
+    content = message.get("content")
+    snippet = content if isinstance(content, str) else str(content)
+    return {
+        "_id": message["message_id"],
+        "session_id": session_id,
+        "transmitter": transmitter,
+        "created_at": created_at or datetime.now(timezone.utc),
+        "role": message.get("role"),
+        "snippet": snippet[:MAX_SNIPPET],
+        "terms": sorted(set(terms)),
+        "tf": dict(Counter(terms)),
+        "length": len(terms),
+    }
+
+
+def score(doc: Dict[str, Any], terms: Iterable[str]) -> float:
+    """BM25 de un documento de búsqueda para los términos de la consulta."""
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * doc.get("length", 0) / AVG_MESSAGE_TERMS)
+    total = 0.0
+    tf = doc.get("tf") or {}
+    for term in terms:
+        f = tf.get(term, 0)
+        total += f * (BM25_K1 + 1) / (f + norm)
+    return total
+
+
+def rank(candidates: List[Dict[str, Any]], terms: List[str], offset: int = 0, limit: int = 20) -> List[Dict[str, Any]]:
+    """
+    Ordena las coincidencias por puntaje (y por recencia a igual puntaje) y devuelve la página
+    pedida, sin los campos internos del índice.
+    """
+    scored = sorted(
+        ((round(score(doc, terms), 4), doc) for doc in candidates),
+        key=lambda item: (-item[0], -_timestamp(item[1].get("created_at")), str(item[1].get("_id")))
+    )
+    page = []
+    for value, doc in scored[offset:offset + limit]:
+        page.append({
+            "message_id": doc.get("_id"),
+            "session_id": doc.get("session_id"),
+            "transmitter": doc.get("transmitter"),
+            "created_at": doc.get("created_at"),
+            "role": doc.get("role"),
+            "snippet": doc.get("snippet"),
+            "score": value,
+        })
+    return page
+
+
+def _timestamp(value) -> float:
+    value = as_utc_datetime(value)
+    return value.timestamp() if value else 0.0
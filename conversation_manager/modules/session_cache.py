@@ -0,0 +1,143 @@
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Optional, Dict, Any
+import os
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SessionCache:
+    """
+    Cache LRU en memoria (por proceso) de identificador de transmitter -> session_id activo.
+
+    Cada entrada expira cuando se cierra la ventana de 24h de la sesión, de modo que CoreBot
+    no necesita consultar `transmitter_sessions` para los mensajes de una sesión ya conocida.
+    """
+
+    backend = "memory"
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max(1, max_entries)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[str]:
+        """Devuelve el session_id activo para `key` o None si no está o ya expiró."""
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key: str, session_id: str, expires_at: datetime):
+        """Registra `session_id` como sesión activa de `key` hasta `expires_at` (UTC)."""
+        with self._lock:
+            self._entries[key] = (session_id, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            size = len(self._entries)
+        return {"backend": self.backend, "hits": self.hits, "misses": self.misses, "size": size, "max_entries": self.max_entries}
+
+
+class RedisSessionCache:
+    """
+    Variante compartida entre workers/procesos: guarda identificador -> session_id en Redis
+    con expiración absoluta (EXAT) al cierre de la ventana de 24h.
+    Los contadores de hits/misses son del proceso actual.
+    """
+
+    backend = "redis"
+
+    def __init__(self, client, prefix: str = "conversation_manager:session:"):
+        self.client = client
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[str]:
+        try:
+            value = self.client.get(self.prefix + key)
+        except Exception as e:
+            logger.error("[ERROR_SESSION_CACHE]: Error al leer de Redis: %s", e)
+            value = None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return value.decode() if isinstance(value, bytes) else value
+
+    def set(self, key: str, session_id: str, expires_at: datetime):
+        try:
+            if expires_at > datetime.now(timezone.utc):
+                self.client.set(self.prefix + key, session_id, exat=int(expires_at.timestamp()))
+        except Exception as e:
+            logger.error("[ERROR_SESSION_CACHE]: Error al escribir en Redis: %s", e)
+
+    def invalidate(self, key: str):
+        try:
+            self.client.delete(self.prefix + key)
+        except Exception as e:
+            logger.error("[ERROR_SESSION_CACHE]: Error al invalidar en Redis: %s", e)
+
+    def clear(self):
+        try:
+            for k in self.client.scan_iter(match=self.prefix + "*"):
+                self.client.delete(k)
+        except Exception as e:
+            logger.error("[ERROR_SESSION_CACHE]: Error al limpiar Redis: %s", e)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.backend, "hits": self.hits, "misses": self.misses}
+
+
+def build_session_cache():
+    """
+    Crea la cache según SESSION_CACHE_BACKEND: memory (por defecto), redis o none.
+
+    - SESSION_CACHE_MAX_ENTRIES: tamaño máximo de la cache en memoria (10000).
+    - REDIS_HOST, REDIS_PORT, REDIS_PASSWORD: conexión para el backend redis (requiere el paquete `redis`).
+    """
+    backend = os.getenv("SESSION_CACHE_BACKEND", "memory").strip().lower()
+    if backend in ("none", "off", ""):
+        return None
+    if backend == "redis":
+        try:
+            import redis
+        except ImportError:
+            logger.warning("[SESSION_CACHE]: paquete 'redis' no instalado; se usa la cache en memoria.")
+        else:
+            client = redis.Redis(
+                host=os.getenv("REDIS_HOST", "localhost"),
+                port=int(os.getenv("REDIS_PORT", 6379)),
+                password=os.getenv("REDIS_PASSWORD") or None
+            )
+            return RedisSessionCache(client)
+    try:
+        max_entries = int(os.getenv("SESSION_CACHE_MAX_ENTRIES", 10000))
+    except ValueError:
+        max_entries = 10000
+    return SessionCache(max_entries=max_entries)
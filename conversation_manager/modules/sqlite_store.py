@@ -0,0 +1,749 @@
+from contextlib import contextmanager
+from datetime import datetime, timezone, timedelta
+from typing import Optional, List, Dict, Any
+import json
+import logging
+import os
+import sqlite3
+import threading
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from modules.storage import ConversationStore, TransmitterStore, as_utc_datetime, STATE_MODE_ARRAY, STATE_MODE_KEYED, USAGE_FIELDS, message_usage, usage_day, conversation_version, inbound_key_ttl
+from modules.search import search_document, index_enabled
+
+logger = logging.getLogger(__name__)
+
+# Backend embebido (STORAGE_BACKEND=sqlite | memory) con las mismas operaciones que usa CoreBot.
+#
+# - conversations: una fila por sesión; los estados en JSON ({name: value}).
+# - messages: una fila por mensaje, clave (session_id, seq); agregar un mensaje es un INSERT y
+#   las ventanas de historial (últimos N / desde message_id) se resuelven con el índice.
+# - transmitters / transmitter_sessions: contacto con índices únicos parciales por identificador
+#   (como en Mongo) y su historial de sesiones; latest_* evita ordenar el historial.
+# - session_usage / token_usage: totales de tokens por sesión y por contacto y día, sumados en la
+#   misma transacción que escribe los mensajes.
+# - message_search / message_terms: índice invertido de la búsqueda (ver modules.search), una fila
+#   por mensaje y una por (término, mensaje), escrito en la misma transacción que el mensaje.
+# - inbound_keys: claves de idempotencia de mensajes entrantes (ver modules.storage.inbound_key_ttl);
+#   las vencidas se borran al reservar una nueva.
+#
+# Los timestamps se guardan como ISO UTC de ancho fijo, por lo que el orden de texto es el temporal.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL UNIQUE,
+    transmitter TEXT,
+    created_at TEXT,
+    states TEXT NOT NULL DEFAULT '{}',
+    revision INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS conversations_transmitter_created_at ON conversations (transmitter, created_at, id);
+
+CREATE TABLE IF NOT EXISTS messages (
+    session_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    message_id TEXT NOT NULL,
+    body TEXT NOT NULL,
+    PRIMARY KEY (session_id, seq)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS messages_message_id ON messages (session_id, message_id);
+
+CREATE TABLE IF NOT EXISTS transmitters (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    phone TEXT NOT NULL DEFAULT '',
+    email TEXT NOT NULL DEFAULT '',
+    chat_id TEXT NOT NULL DEFAULT '',
+    meta_id TEXT NOT NULL DEFAULT '',
+    latest_session_id TEXT,
+    latest_timestamp TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS transmitters_phone_unique ON transmitters (phone) WHERE phone <> '';
+CREATE UNIQUE INDEX IF NOT EXISTS transmitters_email_unique ON transmitters (email) WHERE email <> '';
+CREATE UNIQUE INDEX IF NOT EXISTS transmitters_chat_id_unique ON transmitters (chat_id) WHERE chat_id <> '';
+CREATE UNIQUE INDEX IF NOT EXISTS transmitters_meta_id_unique ON transmitters (meta_id) WHERE meta_id <> '';
+
+CREATE TABLE IF NOT EXISTS transmitter_sessions (
+    transmitter_id INTEGER NOT NULL REFERENCES transmitters (id),
+    session_id TEXT NOT NULL,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transmitter_sessions_by_time ON transmitter_sessions (transmitter_id, timestamp);
+
+CREATE TABLE IF NOT EXISTS session_usage (
+    session_id TEXT PRIMARY KEY,
+    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+    completion_tokens INTEGER NOT NULL DEFAULT 0,
+    total_tokens INTEGER NOT NULL DEFAULT 0,
+    messages INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS token_usage (
+    transmitter TEXT NOT NULL,
+    day TEXT NOT NULL,
+    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+    completion_tokens INTEGER NOT NULL DEFAULT 0,
+    total_tokens INTEGER NOT NULL DEFAULT 0,
+    messages INTEGER NOT NULL DEFAULT 0,
+    sessions INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (transmitter, day)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS token_usage_day ON token_usage (day, transmitter);
+
+CREATE TABLE IF NOT EXISTS message_search (
+    message_id TEXT PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    transmitter TEXT,
+    created_at TEXT NOT NULL,
+    role TEXT,
+    snippet TEXT,
+    length INTEGER NOT NULL,
+    tf TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS message_search_session ON message_search (session_id);
+
+CREATE TABLE IF NOT EXISTS message_terms (
+    term TEXT NOT NULL,
+    message_id TEXT NOT NULL,
+    PRIMARY KEY (term, message_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS inbound_keys (
+    key TEXT PRIMARY KEY,
+    created_at TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS inbound_keys_created_at ON inbound_keys (created_at);
+"""
+
+# conversaciones con sus totales de tokens (NULL si la sesión no tiene fila en session_usage)
+_SELECT_CONVERSATIONS = (
+    "SELECT c.*, u.prompt_tokens, u.completion_tokens, u.total_tokens, u.messages "
+    "FROM conversations c LEFT JOIN session_usage u ON u.session_id = c.session_id"
+)
+
+
+def _ts(value: datetime) -> str:
+    # precisión de milisegundos, como las fechas BSON (los cursores de paginación la usan)
+    return value.astimezone(timezone.utc).isoformat(timespec="milliseconds")
+
+
+def _dumps(value) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+class SqliteDatabase:
+    """
+    Conexión SQLite compartida por SqliteConversation y SqliteTransmitter.
+
+    Una conexión por proceso (se reabre tras un fork) usada por todos los hilos bajo un lock:
+    las escrituras van en transacciones BEGIN IMMEDIATE, lo que las serializa también entre
+    procesos que comparten el archivo (modo WAL, con busy_timeout). ":memory:" es por proceso.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        self._pid = None
+        self._lock = threading.RLock()
+        self._connect_lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is not None and self._pid == os.getpid():
+            return self._conn
+        # hilos concurrentes en la primera petición no deben abrir cada uno su conexión (con
+        # ":memory:" cada una es una base distinta y lo escrito en las descartadas se pierde)
+        with self._connect_lock:
+            if self._conn is None or self._pid != os.getpid():
+                self._open()
+        return self._conn
+
+    def _open(self):
+        self._lock = threading.RLock()
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        if self.path != ":memory:":
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.executescript(SCHEMA)
+        # archivos creados antes de la columna 'revision' (versión de la conversación)
+        if "revision" not in {row["name"] for row in conn.execute("PRAGMA table_info(conversations)")}:
+            conn.execute("ALTER TABLE conversations ADD COLUMN revision INTEGER NOT NULL DEFAULT 0")
+        self._conn, self._pid = conn, os.getpid()
+
+    @contextmanager
+    def read(self):
+        conn = self._connection()
+        with self._lock:
+            yield conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self._connection()
+        with self._lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def close(self):
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+
+class SqliteConversation(ConversationStore):
+    """
+    Conversaciones en SQLite. Devuelve documentos con la misma forma que el backend Mongo
+    (formato embedded); `_id` es el id entero de la fila.
+    """
+
+    layout = "sqlite"
+
+    def __init__(self, database: SqliteDatabase):
+        self.database = database
+        self.state_mode = os.getenv("CONVERSATION_STATE_MODE", STATE_MODE_ARRAY).strip().lower()
+        self.search_enabled = index_enabled()
+
+    # ----------------- utilitarios -----------------
+    def _insert_messages(self, conn, session_id, messages, prepend: bool = False):
+        """Agrega `messages` al final (o al inicio, si `prepend`) del historial de la sesión."""
+        if not messages:
+            return
+        low, high = conn.execute("SELECT MIN(seq), MAX(seq) FROM messages WHERE session_id = ?", (session_id,)).fetchone()
+        if high is None:
+            start = 0
+        elif prepend:
+            start = low - len(messages)
+        else:
+            start = high + 1
+        conn.executemany(
+            "INSERT INTO messages (session_id, seq, message_id, body) VALUES (?, ?, ?, ?)",
+            [(session_id, start + n, m["message_id"], _dumps(m)) for n, m in enumerate(messages)]
+        )
+
+    def _add_usage(self, conn, session_id, messages) -> Dict[str, int]:
+        """Suma los tokens de `messages` a la sesión; devuelve los totales resultantes."""
+        totals = message_usage(messages)
+        conn.execute(
+            "INSERT INTO session_usage (session_id, prompt_tokens, completion_tokens, total_tokens, messages) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (session_id) DO UPDATE SET prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+            "completion_tokens = completion_tokens + excluded.completion_tokens, total_tokens = total_tokens + excluded.total_tokens, "
+            "messages = messages + excluded.messages",
+            (session_id, *(totals[f] for f in USAGE_FIELDS))
+        )
+        row = conn.execute("SELECT * FROM session_usage WHERE session_id = ?", (session_id,)).fetchone()
+        return {f: row[f] for f in USAGE_FIELDS}
+
+    def _record_usage(self, conn, transmitter, totals, new_session: bool):
+        """Suma al acumulado diario del contacto (sin transmitter se omite, como en Mongo)."""
+        if not transmitter or not totals.get("messages"):
+            return
+        conn.execute(
+            "INSERT INTO token_usage (transmitter, day, prompt_tokens, completion_tokens, total_tokens, messages, sessions) VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (transmitter, day) DO UPDATE SET prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+            "completion_tokens = completion_tokens + excluded.completion_tokens, total_tokens = total_tokens + excluded.total_tokens, "
+            "messages = messages + excluded.messages, sessions = sessions + excluded.sessions",
+            (transmitter, usage_day(), *(totals[f] for f in USAGE_FIELDS), int(new_session))
+        )
+
+    def _index_messages(self, conn, session_id, transmitter, messages):
+        """Agrega los mensajes al índice de búsqueda (un reintento con el mismo message_id se ignora)."""
+        if not self.search_enabled:
+            return
+        now = datetime.now(timezone.utc)
+        for doc in filter(None, (search_document(session_id, transmitter, m, now) for m in messages)):
+            inserted = conn.execute(
+                "INSERT OR IGNORE INTO message_search (message_id, session_id, transmitter, created_at, role, snippet, length, tf) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (doc["_id"], session_id, transmitter, _ts(doc["created_at"]), doc["role"], doc["snippet"], doc["length"], _dumps(doc["tf"]))
+            ).rowcount
+            if inserted:
+                conn.executemany("INSERT OR IGNORE INTO message_terms (term, message_id) VALUES (?, ?)", [(term, doc["_id"]) for term in doc["terms"]])
+
+    def _create(self, conn, doc):
+        """Crea la sesión o, si un append concurrente se adelantó, completa sus metadatos y antepone los mensajes."""
+        conn.execute(
+            "INSERT INTO conversations (session_id, transmitter, created_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (session_id) DO UPDATE SET transmitter = excluded.transmitter, created_at = excluded.created_at",
+            (doc["session_id"], doc["transmitter"], _ts(doc["created_at"]))
+        )
+        existed = conn.execute("SELECT 1 FROM messages WHERE session_id = ? LIMIT 1", (doc["session_id"],)).fetchone() is not None
+        self._insert_messages(conn, doc["session_id"], doc["message"], prepend=existed)
+        # lo acumulado antes de tener transmitter (appends adelantados) se atribuye ahora
+        self._record_usage(conn, doc["transmitter"], self._add_usage(conn, doc["session_id"], doc["message"]), True)
+        if existed and self.search_enabled:
+            conn.execute("UPDATE message_search SET transmitter = ? WHERE session_id = ? AND transmitter IS NULL", (doc["transmitter"], doc["session_id"]))
+        self._index_messages(conn, doc["session_id"], doc["transmitter"], doc["message"])
+        if existed:
+            return None
+        return conn.execute("SELECT id FROM conversations WHERE session_id = ?", (doc["session_id"],)).fetchone()["id"]
+
+    def _append(self, conn, session_id, messages):
+        conn.execute("INSERT OR IGNORE INTO conversations (session_id) VALUES (?)", (session_id,))
+        self._insert_messages(conn, session_id, messages)
+        self._add_usage(conn, session_id, messages)
+        transmitter = conn.execute("SELECT transmitter FROM conversations WHERE session_id = ?", (session_id,)).fetchone()["transmitter"]
+        self._record_usage(conn, transmitter, message_usage(messages), False)
+        self._index_messages(conn, session_id, transmitter, messages)
+        # fila para _emit_messages, que se llama tras confirmar la transacción
+        return session_id, transmitter, messages
+
+    def _load_window(self, conn, session_id, history_limit: int = None, since_message_id: str = None):
+        query, params = "SELECT body FROM messages WHERE session_id = ?", [session_id]
+        if since_message_id:
+            # si no se encuentra, se devuelve el historial completo (como en Mongo)
+            query += " AND seq > COALESCE((SELECT seq FROM messages WHERE session_id = ? AND message_id = ?), -9223372036854775808)"
+            params += [session_id, since_message_id]
+        if history_limit:
+            rows = conn.execute(query + " ORDER BY seq DESC LIMIT ?", params + [int(history_limit)]).fetchall()
+            rows.reverse()
+        else:
+            rows = conn.execute(query + " ORDER BY seq", params).fetchall()
+        return [json.loads(r["body"]) for r in rows]
+
+    def _doc(self, row, messages=None):
+        states = json.loads(row["states"] or "{}")
+        doc = {
+            "_id": row["id"],
+            "session_id": row["session_id"],
+            "state": [] if self.state_mode == STATE_MODE_KEYED else [{"name": k, "value": v} for k, v in states.items()],
+            "transmitter": row["transmitter"],
+            "created_at": as_utc_datetime(row["created_at"]),
+            "revision": row["revision"],
+        }
+        if self.state_mode == STATE_MODE_KEYED:
+            doc["states"] = states
+        if row["messages"] is not None:
+            doc["usage"] = {f: row[f] for f in USAGE_FIELDS}
+        if messages is not None:
+            doc["message"] = messages
+        return doc
+
+    def _get(self, conn, session_id, transmitter: str = None, history_limit: int = None, since_message_id: str = None):
+        query, params = _SELECT_CONVERSATIONS + " WHERE c.session_id = ?", [session_id]
+        if transmitter is not None:
+            query += " AND transmitter = ?"
+            params.append(transmitter)
+        row = conn.execute(query, params).fetchone()
+        if row is None:
+            return None
+        return self._doc(row, self._load_window(conn, session_id, history_limit, since_message_id))
+
+    # ----------------- escritura -----------------
+    def new_conversation(self, content, tokens, send_data, transmitter: str = None, session_id: str = None):
+        try:
+            session_id = session_id or self.generate_id()
+            doc = self.build_conversation_doc(session_id, transmitter, [self._build_message_entry(content, tokens, send_data)])
+            with self.database.transaction() as conn:
+                inserted_id = self._create(conn, doc)
+            self._emit_messages([(session_id, transmitter, doc["message"])])
+            if inserted_id is not None:
+                doc["_id"] = inserted_id
+            return {"session_id": session_id, "inserted_id": str(inserted_id) if inserted_id is not None else None, "transmitter": transmitter, "created_at": doc["created_at"], "conversation": doc}
+        except sqlite3.Error as e:
+            logger.error("[ERROR_NEW_CONVERSATION]: Error al crear la conversación: %s", e)
+            return None
+
+    def add_message(self, session_id, content, tokens, send_data):
+        try:
+            with self.database.transaction() as conn:
+                row = self._append(conn, session_id, [self._build_message_entry(content, tokens, send_data)])
+            self._emit_messages([row])
+            return True
+        except sqlite3.Error as e:
+            logger.error("[ERROR_ADD_SESSION]: Error al agregar la nueva sesión: %s", e)
+            return False
+
+    def add_message_and_get(self, session_id, content, tokens, send_data, history_limit: int = None, since_message_id: str = None):
+        try:
+            with self.database.transaction() as conn:
+                row = self._append(conn, session_id, [self._build_message_entry(content, tokens, send_data)])
+                doc = self._get(conn, session_id, history_limit=history_limit, since_message_id=since_message_id)
+            self._emit_messages([row])
+            return doc
+        except sqlite3.Error as e:
+            logger.error("[ERROR_ADD_SESSION]: Error al agregar el mensaje: %s", e)
+            return None
+
+    def bulk_write_messages(self, new_conversations, appends) -> bool:
+        if not new_conversations and not appends:
+            return True
+        try:
+            rows = [(doc["session_id"], doc["transmitter"], doc["message"]) for doc in new_conversations]
+            with self.database.transaction() as conn:
+                for doc in new_conversations:
+                    self._create(conn, doc)
+                for session_id, entries in appends.items():
+                    rows.append(self._append(conn, session_id, entries))
+            self._emit_messages(rows)
+            return True
+        except sqlite3.Error as e:
+            logger.error("[ERROR_BULK_WRITE]: Error en la escritura en lote: %s", e)
+            return False
+
+    def delete_conversation(self, conversation_id) -> bool:
+        try:
+            with self.database.transaction() as conn:
+                row = conn.execute("SELECT session_id FROM conversations WHERE id = ?", (int(conversation_id),)).fetchone()
+                if row is None:
+                    return False
+                conn.execute("DELETE FROM messages WHERE session_id = ?", (row["session_id"],))
+                conn.execute("DELETE FROM message_terms WHERE message_id IN (SELECT message_id FROM message_search WHERE session_id = ?)", (row["session_id"],))
+                conn.execute("DELETE FROM message_search WHERE session_id = ?", (row["session_id"],))
+                conn.execute("DELETE FROM conversations WHERE id = ?", (int(conversation_id),))
+                return True
+        except (sqlite3.Error, ValueError):
+            return False
+
+    # ----------------- lectura -----------------
+    def get_conversation(self, session_id, transmitter: str = None, history_limit: int = None, since_message_id: str = None):
+        try:
+            with self.database.read() as conn:
+                return self._get(conn, session_id, transmitter, history_limit, since_message_id)
+        except sqlite3.Error:
+            return None
+
+    def get_conversation_by_session_id(self, session_id, transmitter: str = None):
+        doc = self.get_conversation(session_id, transmitter)
+        return [doc] if doc else []
+
+    def find_by_transmitter(self, transmitter_value, limit: int = None, after=None, summary: bool = False):
+        query, params = _SELECT_CONVERSATIONS + " WHERE transmitter = ?", [transmitter_value]
+        if after is not None:
+            created_at, last_id = after
+            created_at = as_utc_datetime(created_at)
+            if created_at is None:
+                query += " AND (created_at IS NOT NULL OR id > ?)"
+                params.append(last_id)
+            else:
+                query += " AND (created_at > ? OR (created_at = ? AND id > ?))"
+                params += [_ts(created_at), _ts(created_at), last_id]
+        query += " ORDER BY created_at, id"
+        if limit:
+            query += " LIMIT ?"
+            params.append(int(limit))
+        with self.database.read() as conn:
+            rows = conn.execute(query, params).fetchall()
+        for row in rows:
+            if summary:
+                yield self._doc(row)
+                continue
+            # el lock no se retiene mientras el consumidor procesa cada documento
+            with self.database.read() as conn:
+                doc = self._doc(row, self._load_window(conn, row["session_id"]))
+            yield doc
+
+    # ----------------- estados -----------------
+    def _update_states(self, session_id, fn) -> bool:
+        """Aplica `fn(states) -> bool` (True si modificó) sobre los estados de la sesión en una transacción."""
+        try:
+            with self.database.transaction() as conn:
+                row = conn.execute("SELECT states FROM conversations WHERE session_id = ?", (session_id,)).fetchone()
+                if row is None:
+                    return False
+                states = json.loads(row["states"] or "{}")
+                if not fn(states):
+                    return False
+                conn.execute("UPDATE conversations SET states = ?, revision = revision + 1 WHERE session_id = ?", (_dumps(states), session_id))
+                return True
+        except sqlite3.Error:
+            return False
+
+    def add_state(self, session_id, new_state):
+        return self.set_states(session_id, {new_state.get('name'): new_state.get('value')})
+
+    def overwrite_state(self, session_id, state_name, state_value):
+        def fn(states):
+            if state_name not in states:
+                return False
+            states[state_name] = state_value
+            return True
+        if not self._update_states(session_id, fn):
+            return False
+        self._emit_states(session_id, {state_name: state_value})
+        return True
+
+    def set_states(self, session_id, states):
+        if not states or not all(self._valid_state_name(n) for n in states):
+            return False
+
+        def fn(current):
+            current.update(states)
+            return True
+        if not self._update_states(session_id, fn):
+            return False
+        self._emit_states(session_id, states)
+        return True
+
+    def remove_state(self, session_id, state_name):
+        def fn(states):
+            if state_name not in states:
+                return False
+            del states[state_name]
+            return True
+        if not self._update_states(session_id, fn):
+            return False
+        self._emit_states(session_id, removed=state_name)
+        return True
+
+    def get_states(self, session_id):
+        try:
+            with self.database.read() as conn:
+                row = conn.execute("SELECT states FROM conversations WHERE session_id = ?", (session_id,)).fetchone()
+        except sqlite3.Error:
+            return None
+        return json.loads(row["states"] or "{}") if row else None
+
+    def get_version(self, session_id):
+        try:
+            with self.database.read() as conn:
+                row = conn.execute(
+                    "SELECT c.revision, u.messages FROM conversations c LEFT JOIN session_usage u ON u.session_id = c.session_id WHERE c.session_id = ?",
+                    (session_id,)
+                ).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        return conversation_version({"usage": {"messages": row["messages"]}, "revision": row["revision"]})
+
+    # ----------------- consumo de tokens -----------------
+    def get_session_usage(self, session_id):
+        try:
+            with self.database.read() as conn:
+                row = conn.execute(_SELECT_CONVERSATIONS + " WHERE c.session_id = ?", (session_id,)).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        return {"session_id": row["session_id"], "transmitter": row["transmitter"], "usage": {f: row[f] or 0 for f in USAGE_FIELDS}}
+
+    @staticmethod
+    def _day_range(query, params, start_day: str = None, end_day: str = None):
+        if start_day:
+            query += " AND day >= ?"
+            params.append(start_day)
+        if end_day:
+            query += " AND day <= ?"
+            params.append(end_day)
+        return query, params
+
+    def usage_by_day(self, transmitter, start_day: str = None, end_day: str = None):
+        query, params = self._day_range("SELECT * FROM token_usage WHERE transmitter = ?", [transmitter], start_day, end_day)
+        try:
+            with self.database.read() as conn:
+                return [dict(row) for row in conn.execute(query + " ORDER BY day", params).fetchall()]
+        except sqlite3.Error:
+            return []
+
+    def usage_by_contact(self, start_day: str = None, end_day: str = None, limit: int = None):
+        sums = ", ".join(f"SUM({f}) AS {f}" for f in USAGE_FIELDS + ("sessions",))
+        query, params = self._day_range(f"SELECT transmitter, {sums} FROM token_usage WHERE 1 = 1", [], start_day, end_day)
+        query += " GROUP BY transmitter ORDER BY total_tokens DESC, transmitter"
+        if limit:
+            query += " LIMIT ?"
+            params.append(int(limit))
+        try:
+            with self.database.read() as conn:
+                return [dict(row) for row in conn.execute(query, params).fetchall()]
+        except sqlite3.Error:
+            return []
+
+    # ----------------- búsqueda -----------------
+    def search_candidates(self, terms, transmitter: str = None, since: datetime = None, until: datetime = None, limit: int = 1000):
+        if not terms:
+            return []
+        terms = list(terms)
+        query = (
+            "SELECT * FROM message_search WHERE message_id IN ("
+            f"SELECT message_id FROM message_terms WHERE term IN ({', '.join('?' * len(terms))}) GROUP BY message_id HAVING COUNT(*) = ?)"
+        )
+        params: list = [*terms, len(terms)]
+        if transmitter:
+            query += " AND transmitter = ?"
+            params.append(transmitter)
+        if since:
+            query += " AND created_at >= ?"
+            params.append(_ts(since))
+        if until:
+            query += " AND created_at < ?"
+            params.append(_ts(until))
+        query += " ORDER BY created_at DESC LIMIT ?"
+        params.append(int(limit))
+        try:
+            with self.database.read() as conn:
+                rows = conn.execute(query, params).fetchall()
+        except sqlite3.Error:
+            return []
+        results = []
+        for row in rows:
+            tf = json.loads(row["tf"])
+            results.append({
+                "_id": row["message_id"], "session_id": row["session_id"], "transmitter": row["transmitter"],
+                "created_at": as_utc_datetime(row["created_at"]), "role": row["role"], "snippet": row["snippet"],
+                "length": row["length"], "tf": {term: tf.get(term, 0) for term in terms},
+            })
+        return results
+
+    # ----------------- idempotencia de mensajes entrantes -----------------
+    def claim_inbound(self, key: str) -> bool:
+        now = datetime.now(timezone.utc)
+        try:
+            with self.database.transaction() as conn:
+                conn.execute("DELETE FROM inbound_keys WHERE created_at < ?", (_ts(now - timedelta(seconds=inbound_key_ttl())),))
+                return conn.execute("INSERT OR IGNORE INTO inbound_keys (key, created_at) VALUES (?, ?)", (key, _ts(now))).rowcount == 1
+        except sqlite3.Error as e:
+            # ante un error se escribe igual: es preferible un duplicado a perder el mensaje
+            logger.error("[ERROR_INBOUND_KEY]: No se pudo reservar la clave %s: %s", key, e)
+            return True
+
+    def release_inbound(self, key: str):
+        try:
+            with self.database.transaction() as conn:
+                conn.execute("DELETE FROM inbound_keys WHERE key = ?", (key,))
+        except sqlite3.Error as e:
+            logger.error("[ERROR_INBOUND_KEY]: No se pudo liberar la clave %s: %s", key, e)
+
+
+class SqliteTransmitter(TransmitterStore):
+    """
+    Contactos y sesiones en SQLite, con las mismas garantías que el backend Mongo: a lo sumo un
+    contacto por identificador (índices únicos parciales) y `resolve_or_create_session` atómico
+    (la consulta y el registro ocurren en la misma transacción).
+    """
+
+    def __init__(self, database: SqliteDatabase):
+        self.database = database
+
+    @staticmethod
+    def _session(session_id, timestamp) -> Optional[Dict[str, Any]]:
+        if not session_id:
+            return None
+        return {"session_id": session_id, "timestamp": as_utc_datetime(timestamp)}
+
+    def _find_row(self, conn, ids: Dict[str, Optional[str]]):
+        clauses = [(f, v) for f, v in ids.items() if f in self.IDENTIFIER_FIELDS and v and v.strip()]
+        if not clauses:
+            return None
+        where = " OR ".join(f"{f} = ?" for f, _ in clauses)
+        return conn.execute(f"SELECT * FROM transmitters WHERE {where} ORDER BY id LIMIT 1", [v for _, v in clauses]).fetchone()
+
+    def _register(self, conn, session_id: str, ids: Dict[str, Optional[str]], row=None) -> Dict[str, Any]:
+        """Registra `session_id` como última sesión del contacto (creándolo si `row` es None)."""
+        now = datetime.now(timezone.utc)
+        if row is None:
+            values = {f: ids.get(f) if ids.get(f) and ids.get(f).strip() else "" for f in self.IDENTIFIER_FIELDS}
+            transmitter_id = conn.execute(
+                "INSERT INTO transmitters (phone, email, chat_id, meta_id, latest_session_id, latest_timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                (values["phone"], values["email"], values["chat_id"], values["meta_id"], session_id, _ts(now))
+            ).lastrowid
+        else:
+            transmitter_id = row["id"]
+            conn.execute("UPDATE transmitters SET latest_session_id = ?, latest_timestamp = ? WHERE id = ?", (session_id, _ts(now), transmitter_id))
+        conn.execute("INSERT INTO transmitter_sessions (transmitter_id, session_id, timestamp) VALUES (?, ?, ?)", (transmitter_id, session_id, _ts(now)))
+        return {"session_id": session_id, "timestamp": now}
+
+    def add_session(self, session_id: str, phone: Optional[str] = None, email: Optional[str] = None, chat_id: Optional[str] = None, meta_id: Optional[str] = None) -> bool:
+        if not session_id or not self._has_any_identifier(phone, email, chat_id, meta_id):
+            return False
+        ids = {"phone": phone, "email": email, "chat_id": chat_id, "meta_id": meta_id}
+        try:
+            with self.database.transaction() as conn:
+                self._register(conn, session_id, ids, self._find_row(conn, ids))
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _resolve_or_create(self, conn, session_id: str, id_field: str, window: timedelta, ids: Dict[str, Optional[str]]):
+        row = conn.execute(f"SELECT * FROM transmitters WHERE {id_field} = ?", (ids[id_field],)).fetchone()
+        cutoff = _ts(datetime.now(timezone.utc) - window)
+        if row is not None and row["latest_session_id"] and row["latest_timestamp"] >= cutoff:
+            return self._session(row["latest_session_id"], row["latest_timestamp"]), False
+        if row is None:
+            # los identificadores secundarios que ya pertenecen a otro transmitter no se guardan
+            # (chocarían con su índice único); el contacto queda identificado por `id_field`
+            ids = {f: v for f, v in ids.items()
+                   if f == id_field or not (v and v.strip()) or conn.execute(f"SELECT 1 FROM transmitters WHERE {f} = ?", (v,)).fetchone() is None}
+        return self._register(conn, session_id, ids, row), True
+
+    def resolve_or_create_session(self, session_id: str, id_field: str, window: timedelta, phone: Optional[str] = None, email: Optional[str] = None, chat_id: Optional[str] = None, meta_id: Optional[str] = None):
+        ids = {"phone": phone, "email": email, "chat_id": chat_id, "meta_id": meta_id}
+        if not session_id or id_field not in self.IDENTIFIER_FIELDS or not ids.get(id_field):
+            return None, False
+        try:
+            with self.database.transaction() as conn:
+                return self._resolve_or_create(conn, session_id, id_field, window, ids)
+        except sqlite3.Error:
+            return None, False
+
+    def resolve_or_create_sessions_bulk(self, entries: List[Dict[str, Any]], window: timedelta) -> List[tuple]:
+        if not entries:
+            return []
+        results = []
+        try:
+            with self.database.transaction() as conn:
+                for e in entries:
+                    ids = {f: e.get(f) for f in self.IDENTIFIER_FIELDS}
+                    if e.get("id_field") not in self.IDENTIFIER_FIELDS or not ids.get(e.get("id_field")):
+                        results.append((None, False))
+                        continue
+                    results.append(self._resolve_or_create(conn, e["session_id"], e["id_field"], window, ids))
+            return results
+        except sqlite3.Error:
+            return [(None, False)] * len(entries)
+
+    def get_latest_session(self, id_field: str, value: str, window: Optional[timedelta] = None) -> Optional[Dict[str, Any]]:
+        if id_field not in self.IDENTIFIER_FIELDS or not value:
+            return None
+        query, params = f"SELECT latest_session_id, latest_timestamp FROM transmitters WHERE {id_field} = ?", [value]
+        if window is not None:
+            query += " AND latest_timestamp >= ?"
+            params.append(_ts(datetime.now(timezone.utc) - window))
+        try:
+            with self.database.read() as conn:
+                row = conn.execute(query, params).fetchone()
+        except sqlite3.Error:
+            return None
+        return self._session(row["latest_session_id"], row["latest_timestamp"]) if row else None
+
+    def get_latest_sessions(self, identifiers: List[tuple], window: Optional[timedelta] = None) -> Dict[tuple, Dict[str, Any]]:
+        found: Dict[tuple, Dict[str, Any]] = {}
+        cutoff = _ts(datetime.now(timezone.utc) - window) if window is not None else None
+        try:
+            with self.database.read() as conn:
+                for field in self.IDENTIFIER_FIELDS:
+                    values = list({v for f, v in identifiers if f == field and v})
+                    if not values:
+                        continue
+                    query = f"SELECT {field} AS value, latest_session_id, latest_timestamp FROM transmitters WHERE {field} IN ({','.join('?' * len(values))})"
+                    params = list(values)
+                    if cutoff is not None:
+                        query += " AND latest_timestamp >= ?"
+                        params.append(cutoff)
+                    for row in conn.execute(query, params):
+                        session = self._session(row["latest_session_id"], row["latest_timestamp"])
+                        if session:
+                            found[(field, row["value"])] = session
+        except sqlite3.Error:
+            return {}
+        return found
+
+    def _get_sessions_by(self, id_field: str, value: str, limit: Optional[int] = None, newest_first: bool = True) -> List[Dict[str, Any]]:
+        if id_field not in self.IDENTIFIER_FIELDS or not value:
+            return []
+        query = (
+            "SELECT s.session_id, s.timestamp FROM transmitter_sessions s JOIN transmitters t ON t.id = s.transmitter_id "
+            f"WHERE t.{id_field} = ? ORDER BY s.timestamp {'DESC' if newest_first else 'ASC'}"
+        )
+        params: List[Any] = [value]
+        if limit:
+            query += " LIMIT ?"
+            params.append(int(limit))
+        try:
+            with self.database.read() as conn:
+                return [self._session(r["session_id"], r["timestamp"]) for r in conn.execute(query, params)]
+        except sqlite3.Error:
+            return []
@@ -0,0 +1,384 @@
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone, timedelta
+from typing import Callable, Optional, List, Dict, Any, Iterable
+import os
+import logging
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from modules.id_generator import new_id
+
+logger = logging.getLogger(__name__)
+
+# Interfaz de almacenamiento de conversaciones y transmitters. CoreBot sólo usa estos métodos,
+# de modo que el motor se elige con STORAGE_BACKEND:
+# - mongo (por defecto): modules.conversation.Conversation / modules.transmitter.Transmitter.
+# - sqlite: archivo SQLite en modo WAL (SQLITE_PATH), ver modules.sqlite_store.
+# - memory: SQLite en memoria (por proceso; pensado para desarrollo, pruebas y benchmarks).
+# Las funciones propias de Mongo (formato bucketed, archivo, TTL, migraciones) sólo existen en mongo.
+STORAGE_MONGO = "mongo"
+STORAGE_SQLITE = "sqlite"
+STORAGE_MEMORY = "memory"
+
+# Almacenamiento de estados:
+# - array: lista 'state' de {"name", "value"} (formato original).
+# - keyed: mapa 'states.<name>' -> value; upsert en un único $set y borrado con $unset.
+STATE_MODE_ARRAY = "array"
+STATE_MODE_KEYED = "keyed"
+
+# Contabilidad de tokens mantenida al escribir: cada sesión acumula 'usage' ({<TOKEN_FIELDS>, messages})
+# y cada contacto (campo transmitter) un acumulado por día UTC ("YYYY-MM-DD") que además cuenta sesiones.
+TOKEN_FIELDS = ("prompt_tokens", "completion_tokens", "total_tokens")
+USAGE_FIELDS = TOKEN_FIELDS + ("messages",)
+
+
+# Versión de una conversación: entero monótono que cambia con cada escritura, derivado de dos
+# contadores que cada escritura incrementa de forma atómica junto con el cambio: usage.messages
+# (mensajes agregados) y 'revision' (cambios de estados y update_conversation).
+# version = messages * VERSION_MESSAGES_FACTOR + revision, de modo que una versión anterior indica
+# cuántos mensajes tenía el cliente y si los estados cambiaron (lecturas delta, ETag).
+VERSION_MESSAGES_FACTOR = 1 << 24
+
+# Idempotencia de mensajes entrantes: el mismo mensaje de WhatsApp puede llegar por n8n
+# (/api/process_message) y por workers/whatsapp_consumer.py. Quien lo persiste primero reserva su
+# 'external_id' (id del mensaje en el canal) y el otro camino no lo vuelve a escribir. Las claves se
+# olvidan tras INBOUND_KEY_TTL_SECONDS (por defecto 24h).
+INBOUND_KEY_TTL_DEFAULT = 86400
+
+
+def inbound_key_ttl() -> int:
+    """Segundos durante los que se recuerda una clave de idempotencia (INBOUND_KEY_TTL_SECONDS)."""
+    try:
+        return max(1, int(os.getenv("INBOUND_KEY_TTL_SECONDS", INBOUND_KEY_TTL_DEFAULT)))
+    except ValueError:
+        return INBOUND_KEY_TTL_DEFAULT
+
+
+def conversation_version(doc) -> int:
+    """Versión de un documento de conversación (0 si aún no tiene contadores)."""
+    messages = (doc.get("usage") or {}).get("messages") or 0
+    return int(messages) * VERSION_MESSAGES_FACTOR + int(doc.get("revision") or 0)
+
+
+def split_version(version: int):
+    """(mensajes, revision) de una versión."""
+    return divmod(int(version), VERSION_MESSAGES_FACTOR)
+
+
+def as_utc_datetime(value) -> Optional[datetime]:
+    """
+    Normaliza un timestamp de sesión a datetime UTC (tz-aware).
+    Acepta BSON date (datetime, naive = UTC) y el formato anterior (string ISO); None si no es válido.
+    """
+    if isinstance(value, datetime):
+        return value if value.tzinfo is not None else value.replace(tzinfo=timezone.utc)
+    if isinstance(value, str) and value:
+        try:
+            return as_utc_datetime(datetime.fromisoformat(value))
+        except ValueError:
+            return None
+    return None
+
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _token_count(value) -> int:
+    # los tokens pueden llegar como string desde integraciones (n8n); lo no numérico cuenta 0
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return 0
+
+
+def message_usage(messages) -> Dict[str, int]:
+    """Totales de tokens y cantidad de mensajes de una lista de mensajes (ver `build_message_entry`)."""
+    totals = dict.fromkeys(USAGE_FIELDS, 0)
+    for message in messages:
+        tokens = message.get("tokens") or {}
+        for field in TOKEN_FIELDS:
+            totals[field] += _token_count(tokens.get(field))
+        totals["messages"] += 1
+    return totals
+
+
+def usage_day(value: Optional[datetime] = None) -> str:
+    """Día UTC ("YYYY-MM-DD") bajo el que se acumula el consumo (por defecto, hoy)."""
+    return (as_utc_datetime(value) or datetime.now(timezone.utc)).astimezone(timezone.utc).date().isoformat()
+
+
+class ConversationStore(ABC):
+    """
+    Operaciones sobre conversaciones que usa CoreBot. Los documentos devueltos tienen la forma
+    del documento embedded de Mongo: {"_id", "session_id", "state", "transmitter", "created_at", "message": [...]}.
+    """
+
+    layout: str
+    state_mode: str
+    # hook de escritura: recibe un evento por mensaje y por cambio de estado ya confirmado
+    # (ver modules.live_updates); None si nadie escucha
+    event_hook: Optional[Callable[[Dict[str, Any]], None]] = None
+
+    def ping(self, timeout: Optional[float] = None) -> bool:
+        """True si la base responde (los motores embebidos siempre están disponibles)."""
+        return True
+
+    def warm_up(self) -> bool:
+        """Verifica/crea índices y estructuras auxiliares. Retorna True si quedaron completos."""
+        return True
+
+    def _emit_messages(self, rows):
+        """Publica los mensajes escritos. `rows`: [(session_id, transmitter, [message_entry, ...])]."""
+        if self.event_hook is None:
+            return
+        for session_id, transmitter, messages in rows:
+            for message in messages:
+                self._emit({"type": "message", "session_id": session_id, "transmitter": transmitter, "message": message})
+
+    def _emit_states(self, session_id, states=None, removed: str = None):
+        """Publica estados insertados/reemplazados ({name: value}) o el nombre de uno eliminado."""
+        if self.event_hook is None:
+            return
+        if removed is not None:
+            self._emit({"type": "state_removed", "session_id": session_id, "name": removed})
+        else:
+            self._emit({"type": "state", "session_id": session_id, "states": dict(states)})
+
+    def _emit(self, event):
+        # un error de un suscriptor no debe afectar a la escritura, ya confirmada
+        try:
+            self.event_hook(event)
+        except Exception as e:
+            logger.error("[ERROR_EVENT_HOOK]: Error al publicar el evento: %s", e)
+
+    def build_conversation_doc(self, session_id, transmitter, messages):
+        """
+        Documento de una sesión nueva (formato embedded) con los mensajes ya construidos.
+        """
+        return {
+            "session_id": session_id,
+            "state": [],
+            # opcional: desde donde vino el mensaje (p.ej. 'phone','chat','meta','bot')
+            "transmitter": transmitter,
+            # timestamp de creación de la sesión (datetime UTC; documentos antiguos de Mongo: string ISO)
+            "created_at": datetime.now(timezone.utc),
+            "message": messages
+        }
+
+    def build_message_entry(self, content, tokens, send_data):
+        """Construye un mensaje con message_id propio, listo para `bulk_write_messages`."""
+        return self._build_message_entry(content, tokens, send_data)
+
+    def _build_message_entry(self, content, tokens, send_data, hour: str = None):
+        """
+        Construye la estructura de un mensaje tal como se guarda en el array 'message'.
+        """
+        return {
+            "message_id": self.generate_id(),
+            "role": content['role'],
+            "tokens": {
+                "prompt_tokens": tokens["prompt_tokens"],
+                "completion_tokens": tokens["completion_tokens"],
+                "total_tokens": tokens["total_tokens"]
+            },
+            "content": content['text'],
+            "send": {
+                "audio": send_data["audio"],
+                "image": send_data["image"],
+                "location": send_data["location"],
+                "document": send_data["document"],
+                "video": send_data["video"]
+            },
+            "hour": hour or datetime.now(timezone.utc).strftime('%H:%M:%S')
+        }
+
+    def generate_id(self):
+        """
+        ID monótono, ordenable por tiempo y sin colisiones dentro del proceso (ver modules.id_generator).
+        El índice único sobre 'session_id' impide duplicados entre procesos.
+        """
+        return new_id()
+
+    @staticmethod
+    def window_messages(doc, history_limit: int = None, since_message_id: str = None):
+        """
+        Aplica en memoria la misma ventana de historial que `get_conversation` sobre un documento ya cargado.
+        """
+        if not doc or (not history_limit and not since_message_id):
+            return doc
+        messages = doc.get("message", [])
+        if since_message_id:
+            ids = [m.get("message_id") for m in messages]
+            if since_message_id in ids:
+                messages = messages[ids.index(since_message_id) + 1:]
+        if history_limit:
+            messages = messages[-int(history_limit):]
+        return {**doc, "message": messages}
+
+    @staticmethod
+    def _valid_state_name(name) -> bool:
+        """Un nombre de estado se usa como clave de 'states': no puede estar vacío, contener '.' ni empezar con '$'."""
+        return isinstance(name, str) and bool(name) and '.' not in name and not name.startswith('$')
+
+
+    def load_messages(self, doc, history_limit: int = None, since_message_id: str = None):
+        """Devuelve `doc` con su historial en 'message' (los motores que lo guardan embebido no hacen nada)."""
+        return doc
+
+    @abstractmethod
+    def new_conversation(self, content, tokens, send_data, transmitter: str = None, session_id: str = None):
+        """Crea la sesión con su primer mensaje. :return: {"session_id", "inserted_id", "transmitter", "created_at", "conversation"} o None."""
+
+    @abstractmethod
+    def add_message(self, session_id, content, tokens, send_data):
+        """Agrega un mensaje (creando la sesión si no existe). Valor verdadero si tuvo éxito."""
+
+    @abstractmethod
+    def add_message_and_get(self, session_id, content, tokens, send_data, history_limit: int = None, since_message_id: str = None):
+        """Agrega un mensaje y devuelve el documento con la ventana de historial pedida, o None en error."""
+
+    @abstractmethod
+    def bulk_write_messages(self, new_conversations, appends) -> bool:
+        """Crea `new_conversations` (de `build_conversation_doc`) y agrega `appends` {session_id: [mensajes]} en lote."""
+
+    @abstractmethod
+    def get_conversation(self, session_id, transmitter: str = None, history_limit: int = None, since_message_id: str = None):
+        """Documento de la sesión (con la ventana de historial pedida) o None."""
+
+    @abstractmethod
+    def get_conversation_by_session_id(self, session_id, transmitter: str = None):
+        """Lista de documentos de la sesión (vacía si no existe)."""
+
+    @abstractmethod
+    def find_by_transmitter(self, transmitter_value, limit: int = None, after=None, summary: bool = False) -> Iterable[Dict[str, Any]]:
+        """Conversaciones del transmitter ordenadas por (created_at, _id); `after` es el par del último documento leído."""
+
+    @abstractmethod
+    def add_state(self, session_id, new_state):
+        """Agrega el estado {"name", "value"}."""
+
+    @abstractmethod
+    def overwrite_state(self, session_id, state_name, state_value):
+        """Reemplaza el valor de un estado existente. False si no existe."""
+
+    @abstractmethod
+    def set_states(self, session_id, states):
+        """Inserta o reemplaza los estados de `states` ({name: value})."""
+
+    @abstractmethod
+    def remove_state(self, session_id, state_name):
+        """Elimina un estado por nombre."""
+
+    @abstractmethod
+    def get_states(self, session_id):
+        """Estados de la sesión como {name: value}, o None si no existe."""
+
+    @abstractmethod
+    def get_version(self, session_id) -> Optional[int]:
+        """Versión actual de la conversación (ver `conversation_version`) sin leer mensajes, o None si no existe."""
+
+    @abstractmethod
+    def get_session_usage(self, session_id) -> Optional[Dict[str, Any]]:
+        """{"session_id", "transmitter", "usage": {<USAGE_FIELDS>}} de la sesión, o None si no existe."""
+
+    @abstractmethod
+    def usage_by_day(self, transmitter, start_day: str = None, end_day: str = None) -> List[Dict[str, Any]]:
+        """Acumulados diarios del contacto entre `start_day` y `end_day` (inclusive), ordenados por día."""
+
+    @abstractmethod
+    def usage_by_contact(self, start_day: str = None, end_day: str = None, limit: int = None) -> List[Dict[str, Any]]:
+        """Acumulados por contacto en el rango de días, de mayor a menor total_tokens."""
+
+    @abstractmethod
+    def search_candidates(self, terms: List[str], transmitter: str = None, since: datetime = None, until: datetime = None, limit: int = 1000) -> List[Dict[str, Any]]:
+        """
+        Documentos de búsqueda (ver modules.search.search_document) que contienen todos los
+        `terms`, filtrados por contacto y por fecha de escritura [since, until), los más recientes primero.
+        """
+
+    @abstractmethod
+    def claim_inbound(self, key: str) -> bool:
+        """Reserva la clave de idempotencia de un mensaje entrante. False si ya estaba reservada (mensaje repetido)."""
+
+    @abstractmethod
+    def release_inbound(self, key: str):
+        """Libera una clave cuya escritura falló, para que el reintento pueda reservarla de nuevo."""
+
+
+class TransmitterStore(ABC):
+    """
+    Operaciones sobre contactos (phone/email/chat_id/meta_id) y sus sesiones que usa CoreBot.
+    Las sesiones se devuelven como {"session_id", "timestamp": datetime UTC}.
+    """
+
+    IDENTIFIER_FIELDS = ("phone", "email", "chat_id", "meta_id")
+    # False si los índices únicos por identificador no existen (p.ej. hay contactos duplicados):
+    # `resolve_or_create_session` deja de ser atómico y CoreBot no se declara listo (ver /readyz)
+    unique_identifiers = True
+
+    def warm_up(self) -> bool:
+        """Verifica/crea índices. Retorna True si quedaron completos."""
+        return True
+
+    @staticmethod
+    def _has_any_identifier(phone: Optional[str], email: Optional[str], chat_id: Optional[str], meta_id: Optional[str]) -> bool:
+        return bool((phone and phone.strip()) or (email and email.strip()) or (chat_id and chat_id.strip()) or (meta_id and meta_id.strip()))
+
+    @staticmethod
+    def _session_sort_key(session: Dict[str, Any]) -> datetime:
+        return as_utc_datetime(session.get("timestamp")) or _EPOCH
+
+    @abstractmethod
+    def add_session(self, session_id: str, phone: Optional[str] = None, email: Optional[str] = None, chat_id: Optional[str] = None, meta_id: Optional[str] = None) -> bool:
+        """Registra `session_id` como última sesión del contacto (creándolo si no existe)."""
+
+    @abstractmethod
+    def resolve_or_create_session(self, session_id: str, id_field: str, window: timedelta, phone: Optional[str] = None, email: Optional[str] = None, chat_id: Optional[str] = None, meta_id: Optional[str] = None):
+        """Registra `session_id` sólo si el contacto no tiene una sesión activa. :return: (sesión, registrada)."""
+
+    @abstractmethod
+    def resolve_or_create_sessions_bulk(self, entries: List[Dict[str, Any]], window: timedelta) -> List[tuple]:
+        """Versión en lote de `resolve_or_create_session`."""
+
+    @abstractmethod
+    def get_latest_session(self, id_field: str, value: str, window: Optional[timedelta] = None) -> Optional[Dict[str, Any]]:
+        """Última sesión del contacto (sólo si está activa cuando se indica `window`)."""
+
+    @abstractmethod
+    def get_latest_sessions(self, identifiers: List[tuple], window: Optional[timedelta] = None) -> Dict[tuple, Dict[str, Any]]:
+        """Versión en lote de `get_latest_session` para pares (id_field, value)."""
+
+    @abstractmethod
+    def _get_sessions_by(self, id_field: str, value: str, limit: Optional[int] = None, newest_first: bool = True) -> List[Dict[str, Any]]:
+        """Sesiones del contacto ordenadas por timestamp."""
+
+    def get_sessions_by_phone(self, phone: str, limit: Optional[int] = None, newest_first: bool = True) -> List[Dict[str, Any]]:
+        return self._get_sessions_by("phone", phone, limit=limit, newest_first=newest_first)
+
+    def get_sessions_by_email(self, email: str, limit: Optional[int] = None, newest_first: bool = True) -> List[Dict[str, Any]]:
+        return self._get_sessions_by("email", email, limit=limit, newest_first=newest_first)
+
+    def get_sessions_by_chat_id(self, chat_id: str, limit: Optional[int] = None, newest_first: bool = True) -> List[Dict[str, Any]]:
+        return self._get_sessions_by("chat_id", chat_id, limit=limit, newest_first=newest_first)
+
+    def get_sessions_by_meta_id(self, meta_id: str, limit: Optional[int] = None, newest_first: bool = True) -> List[Dict[str, Any]]:
+        return self._get_sessions_by("meta_id", meta_id, limit=limit, newest_first=newest_first)
+
+
+def build_storage():
+    """
+    Crea (conversation_module, transmitter_module) según STORAGE_BACKEND (mongo | sqlite | memory).
+    SQLITE_PATH indica el archivo del backend sqlite (por defecto conversation_manager.db).
+    """
+    backend = os.getenv("STORAGE_BACKEND", STORAGE_MONGO).strip().lower()
+    if backend in (STORAGE_SQLITE, STORAGE_MEMORY):
+        from modules.sqlite_store import SqliteDatabase, SqliteConversation, SqliteTransmitter
+        path = ":memory:" if backend == STORAGE_MEMORY else os.getenv("SQLITE_PATH", "conversation_manager.db")
+        database = SqliteDatabase(path)
+        return SqliteConversation(database), SqliteTransmitter(database)
+    if backend != STORAGE_MONGO:
+        logger.warning("[STORAGE]: STORAGE_BACKEND desconocido '%s'; se usa mongo.", backend)
+    from modules.conversation import Conversation
+    from modules.transmitter import Transmitter
+    conversation = Conversation()
+    return conversation, Transmitter(conversation.db_manager)
@@ -1,15 +1,21 @@
+from pymongo import ASCENDING, DESCENDING, UpdateOne, ReturnDocument
 from pymongo.collection import Collection
-from pymongo.errors import PyMongoError
-from datetime import datetime, timezone
+from pymongo.errors import PyMongoError, DuplicateKeyError, OperationFailure, BulkWriteError
+from datetime import datetime, timezone, timedelta
 from typing import Optional, List, Dict, Any
+import os
+import logging
 import sys
 from pathlib import Path
 
 sys.path.append(str(Path(__file__).resolve().parent.parent))
 from configs.config import Database_conversation
+from modules.storage import TransmitterStore
 
+logger = logging.getLogger(__name__)
 
-class Transmitter:
+
+class Transmitter(TransmitterStore):
     """
     Gestiona documentos que agrupan identificadores de transmitter
     y una lista ordenada de sesiones asociadas a ese transmitter.
@@ -21,10 +27,16 @@ class Transmitter:
             "email": "",
             "chat_id": "",
             "meta_id": "",
-            "sessions": [ {"session_id": "", "timestamp": "ISO"}, ... ]
+            "sessions": [ {"session_id": "", "timestamp": Date}, ... ],
+            "latest_session": {"session_id": "", "timestamp": Date}
         }
     }
 
+    `latest_session` se mantiene en cada `add_session` para que la consulta de la sesión
+    vigente sea una lectura indexada con proyección, sin cargar ni ordenar `sessions`.
+    Los timestamps son BSON dates (documentos antiguos pueden tener strings ISO; ver
+    scripts/migrate_timestamps.py), de modo que la ventana de 24h se filtra en la consulta.
+
     Reglas principales:
     - Al crear/actualizar debe haber al menos un identificador no vacío
       entre phone, email, chat_id y meta_id.
@@ -37,14 +49,107 @@ class Transmitter:
         self.db_manager.connect()
         self.collection: Collection = self.db_manager.get_collection("transmitter_sessions")
 
+    def warm_up(self) -> bool:
+        """Crea (si faltan) los índices únicos por identificador y el TTL opcional."""
+        return self.ensure_indexes()
+
+    def ensure_indexes(self) -> bool:
+        """
+        Crea (si no existen) los índices sobre cada identificador del transmitter.
+
+        Son únicos (parciales: sólo identificadores no vacíos) para que dos workers no puedan
+        crear documentos duplicados para el mismo contacto; es lo que hace atómico
+        `resolve_or_create_session`. Si la colección ya tiene duplicados el índice único no puede
+        crearse: se crea uno no único para no degradar las lecturas, `unique_identifiers` queda
+        en False (CoreBot no se declara listo) y hay que deduplicar con
+        scripts/dedupe_transmitters.py, que luego reemplaza ese índice por el único.
+        Retorna True si se crearon los índices únicos.
+        """
+        unique = True
+        for field in self.IDENTIFIER_FIELDS:
+            path = f"transmitter.{field}"
+            try:
+                self.collection.create_index(
+                    [(path, ASCENDING)],
+                    name=f"transmitter_{field}_unique",
+                    unique=True,
+                    partialFilterExpression={path: {"$type": "string", "$gt": ""}}
+                )
+            except OperationFailure as e:
+                unique = False
+                logger.error(
+                    "[ERROR_TRANSMITTER_INDEXES]: No se pudo crear el índice único sobre %s (¿duplicados? ejecutar "
+                    "scripts/dedupe_transmitters.py); /readyz responderá 503: %s", path, e
+                )
+                try:
+                    self.collection.create_index([(path, ASCENDING)], name=f"transmitter_{field}")
+                except PyMongoError:
+                    pass
+            except PyMongoError as e:
+                logger.error("[ERROR_TRANSMITTER_INDEXES]: No se pudieron crear los índices: %s", e)
+                return False
+        self.unique_identifiers = unique
+        self.ensure_ttl_index()
+        return unique
+
+    def drop_fallback_indexes(self):
+        """Elimina los índices no únicos creados por `ensure_indexes` ante duplicados (ya deduplicada la colección)."""
+        existing = self.collection.index_information()
+        for field in self.IDENTIFIER_FIELDS:
+            if f"transmitter_{field}" in existing:
+                self.collection.drop_index(f"transmitter_{field}")
+
+    def ensure_ttl_index(self) -> bool:
+        """
+        Índice TTL opcional (TRANSMITTER_SESSION_TTL_SECONDS > 0, desactivado por defecto) sobre
+        `latest_session.timestamp`: Mongo elimina el documento COMPLETO del contacto cuando su
+        última sesión supera esa antigüedad, es decir sus identificadores y todo su historial
+        `sessions` (lo que devuelven `get_sessions_by_*` y /api/transmitter/sessions). Las
+        conversaciones se conservan en `conversation` y siguen disponibles por su campo
+        `transmitter`; el próximo mensaje del contacto crea un documento nuevo.
+        Sólo aplica a timestamps BSON date (los strings ISO nunca expiran).
+        """
+        try:
+            ttl = int(os.getenv("TRANSMITTER_SESSION_TTL_SECONDS", 0))
+        except ValueError:
+            ttl = 0
+        if ttl <= 0:
+            return False
+        logger.warning(
+            "[TRANSMITTER_TTL]: TRANSMITTER_SESSION_TTL_SECONDS=%d: los contactos sin sesiones en ese lapso se eliminan "
+            "junto con su historial de sesiones (las conversaciones se conservan)", ttl
+        )
+        try:
+            self.collection.create_index(
+                [("transmitter.latest_session.timestamp", ASCENDING)],
+                name="latest_session_ttl",
+                expireAfterSeconds=ttl
+            )
+            return True
+        except PyMongoError as e:
+            # p.ej. el índice ya existe con otro expireAfterSeconds: se cambia con collMod
+            logger.error("[ERROR_TRANSMITTER_INDEXES]: No se pudo crear el índice TTL: %s", e)
+            return False
+
     # ----------------- utilitarios -----------------
     @staticmethod
-    def _now_iso() -> str:
-        return datetime.now(timezone.utc).isoformat()
+    def _now() -> datetime:
+        return datetime.now(timezone.utc)
 
     @staticmethod
-    def _has_any_identifier(phone: Optional[str], email: Optional[str], chat_id: Optional[str], meta_id: Optional[str]) -> bool:
-        return bool((phone and phone.strip()) or (email and email.strip()) or (chat_id and chat_id.strip()) or (meta_id and meta_id.strip()))
+    def _active_clause(window: timedelta) -> Dict[str, Any]:
+        """
+        Condición "última sesión iniciada hace menos de `window`", evaluada por el servidor.
+        Incluye los timestamps en formato anterior (string ISO, comparables lexicográficamente) y
+        los documentos sin `latest_session` cuya última entrada de `sessions` está en la ventana.
+        """
+        cutoff = datetime.now(timezone.utc) - window
+        return {"$or": [
+            {"transmitter.latest_session.timestamp": {"$gte": cutoff}},
+            {"transmitter.latest_session.timestamp": {"$gte": cutoff.isoformat()}},
+            {"transmitter.latest_session": None, "transmitter.sessions.timestamp": {"$gte": cutoff}},
+            {"transmitter.latest_session": None, "transmitter.sessions.timestamp": {"$gte": cutoff.isoformat()}},
+        ]}
 
     def _build_transmitter_doc(self, phone: Optional[str], email: Optional[str], chat_id: Optional[str], meta_id: Optional[str]) -> Dict[str, Any]:
         return {
@@ -81,11 +186,12 @@ class Transmitter:
 
         try:
             # Si existe, retornarlo; si no existe, insertarlo con upsert
-            update = {
-                "$setOnInsert": self._build_transmitter_doc(phone, email, chat_id, meta_id)["transmitter"]
-            }
-            # upsert and return the document
-            result = self.collection.find_one_and_update(filter_query, {"$setOnInsert": update["$setOnInsert"]}, upsert=True, return_document=True)
+            set_on_insert = {f"transmitter.{k}": v for k, v in self._build_transmitter_doc(phone, email, chat_id, meta_id)["transmitter"].items()}
+            try:
+                result = self.collection.find_one_and_update(filter_query, {"$setOnInsert": set_on_insert}, upsert=True, return_document=ReturnDocument.AFTER)
+            except DuplicateKeyError:
+                # otro worker lo insertó en paralelo (índice único): basta con leerlo
+                result = None
             # find_one_and_update puede retornar None según driver; buscar luego si es None
             if result is None:
                 result = self.collection.find_one(filter_query)
@@ -104,7 +210,19 @@ class Transmitter:
         if not self._has_any_identifier(phone, email, chat_id, meta_id):
             return False
 
-        ts = self._now_iso()
+        filter_query, update = self._session_update(session_id, phone, email, chat_id, meta_id)
+
+        try:
+            res = self.collection.update_one(filter_query, update, upsert=True)
+            return res.acknowledged
+        except PyMongoError:
+            return False
+
+    def _session_update(self, session_id: str, phone: Optional[str], email: Optional[str], chat_id: Optional[str], meta_id: Optional[str]):
+        """
+        Construye (filtro, update) para registrar `session_id` como última sesión del transmitter.
+        """
+        ts = self._now()
         session_entry = {"session_id": session_id, "timestamp": ts}
 
         # preparar filtro similar a ensure_transmitter
@@ -131,69 +249,196 @@ class Transmitter:
         if meta_id and meta_id.strip():
             set_on_insert["transmitter.meta_id"] = meta_id
 
-        update = {"$push": {"transmitter.sessions": session_entry}}
+        update = {
+            "$push": {"transmitter.sessions": session_entry},
+            "$set": {"transmitter.latest_session": session_entry}
+        }
         if set_on_insert:
             update["$setOnInsert"] = set_on_insert
+        return filter_query, update
+
+    def resolve_or_create_session(self, session_id: str, id_field: str, window: timedelta, phone: Optional[str] = None, email: Optional[str] = None, chat_id: Optional[str] = None, meta_id: Optional[str] = None):
+        """
+        Registra atómicamente `session_id` como nueva sesión del contacto identificado por
+        `id_field` sólo si no tiene una sesión activa (iniciada hace menos de `window`).
+
+        Una única operación upsert condicionada a que `latest_session` no exista o esté vencida:
+        si otro worker registró una sesión activa antes, la condición no se cumple, el upsert choca
+        con el índice único del identificador y se devuelve esa sesión en su lugar.
 
+        El choque también puede venir de un identificador secundario (p. ej. un phone nuevo con un
+        email que ya pertenece a otro transmitter): en ese caso no hay sesión para `id_field` y se
+        reintenta creando el documento sólo con `id_field` (ver `_create_with_primary_only`).
+
+        :return: (sesión {"session_id", "timestamp"}, True si se registró `session_id`) o (None, False) en error.
+        """
+        ids = {"phone": phone, "email": email, "chat_id": chat_id, "meta_id": meta_id}
+        value = ids.get(id_field)
+        if not session_id or id_field not in self.IDENTIFIER_FIELDS or not value:
+            return None, False
+        filter_query, update = self._resolve_or_create_update(session_id, id_field, window, ids)
         try:
-            res = self.collection.update_one(filter_query, update, upsert=True)
-            return res.acknowledged
+            self.collection.update_one(filter_query, update, upsert=True)
+            return update["$set"]["transmitter.latest_session"], True
+        except DuplicateKeyError:
+            latest = self.get_latest_session(id_field, value)
+            if latest:
+                return latest, False
+            return self._create_with_primary_only(session_id, id_field, window, value)
         except PyMongoError:
-            return False
+            return None, False
 
-    # ----------------- consultas específicas -----------------
-    def get_sessions_by_phone(self, phone: str, limit: Optional[int] = None, newest_first: bool = True) -> List[Dict[str, str]]:
-        if not phone:
+    def _create_with_primary_only(self, session_id: str, id_field: str, window: timedelta, value: str):
+        """
+        Reintento de `resolve_or_create_session` cuando el upsert chocó con el índice único de un
+        identificador secundario que ya pertenece a otro transmitter: se registra la sesión
+        guardando sólo `id_field`, de modo que las siguientes resoluciones por ese identificador
+        la encuentren. Si esta vez el choque es con `id_field` (otro worker ganó la carrera) se
+        devuelve la sesión de ese worker.
+        """
+        ids = {f: (value if f == id_field else None) for f in self.IDENTIFIER_FIELDS}
+        filter_query, update = self._resolve_or_create_update(session_id, id_field, window, ids)
+        try:
+            self.collection.update_one(filter_query, update, upsert=True)
+            return update["$set"]["transmitter.latest_session"], True
+        except DuplicateKeyError:
+            return self.get_latest_session(id_field, value), False
+        except PyMongoError as e:
+            logger.error("[ERROR_TRANSMITTER_SESSION]: No se pudo registrar la sesión para %s: %s", id_field, e)
+            return None, False
+
+    def _resolve_or_create_update(self, session_id: str, id_field: str, window: timedelta, ids: Dict[str, Optional[str]]):
+        _, update = self._session_update(session_id, **ids)
+        cutoff = datetime.now(timezone.utc) - window
+        filter_query = {
+            f"transmitter.{id_field}": ids[id_field],
+            "$or": [
+                {"transmitter.latest_session": None},
+                {"transmitter.latest_session.timestamp": {"$lt": cutoff}},
+                {"transmitter.latest_session.timestamp": {"$lt": cutoff.isoformat()}}
+            ]
+        }
+        return filter_query, update
+
+    def resolve_or_create_sessions_bulk(self, entries: List[Dict[str, Any]], window: timedelta) -> List[tuple]:
+        """
+        Versión en lote de `resolve_or_create_session` (un único bulk_write no ordenado).
+        Cada entrada: {"session_id", "id_field", "phone", "email", "chat_id", "meta_id"}.
+
+        :return: lista (mismo orden) de (sesión, creada) como en `resolve_or_create_session`.
+        """
+        ops, results = [], []
+        for e in entries:
+            ids = {f: e.get(f) for f in self.IDENTIFIER_FIELDS}
+            filter_query, update = self._resolve_or_create_update(e["session_id"], e["id_field"], window, ids)
+            ops.append(UpdateOne(filter_query, update, upsert=True))
+            results.append((update["$set"]["transmitter.latest_session"], True))
+        if not ops:
             return []
         try:
-            docs = list(self.collection.find({"transmitter.phone": phone}))
-            sessions: List[Dict[str, str]] = []
-            for d in docs:
-                s = d.get("transmitter", {}).get("sessions", [])
-                sessions.extend(s)
-            sessions_sorted = sorted(sessions, key=lambda x: x.get("timestamp", ""), reverse=newest_first)
-            return sessions_sorted[:limit] if limit else sessions_sorted
+            self.collection.bulk_write(ops, ordered=False)
+            return results
+        except BulkWriteError as bwe:
+            lost = []
+            for err in bwe.details.get("writeErrors", []):
+                if err.get("code") == 11000:
+                    lost.append(err["index"])
+                else:
+                    results[err["index"]] = (None, False)
+            if lost:
+                pairs = [(entries[i]["id_field"], entries[i].get(entries[i]["id_field"])) for i in lost]
+                latest = self.get_latest_sessions(pairs)
+                for i, pair in zip(lost, pairs):
+                    if pair in latest:
+                        results[i] = (latest[pair], False)
+                    else:
+                        # el choque fue con un identificador secundario de otro transmitter
+                        results[i] = self._create_with_primary_only(entries[i]["session_id"], pair[0], window, pair[1])
+            return results
         except PyMongoError:
-            return []
+            return [(None, False)] * len(entries)
 
-    def get_sessions_by_email(self, email: str, limit: Optional[int] = None, newest_first: bool = True) -> List[Dict[str, str]]:
-        if not email:
-            return []
+    # ----------------- consultas específicas -----------------
+    def get_latest_sessions(self, identifiers: List[tuple], window: Optional[timedelta] = None) -> Dict[tuple, Dict[str, Any]]:
+        """
+        Versión en lote de `get_latest_session`: recibe pares (id_field, value) y devuelve
+        {(id_field, value): {"session_id", "timestamp"}} con una única consulta.
+        Con `window` sólo se devuelven sesiones activas (filtrado en el servidor).
+        """
+        by_field: Dict[str, set] = {}
+        for field, value in identifiers:
+            if field in self.IDENTIFIER_FIELDS and value:
+                by_field.setdefault(field, set()).add(value)
+        if not by_field:
+            return {}
+        or_clauses = [{f"transmitter.{f}": {"$in": list(values)}} for f, values in by_field.items()]
+        projection = {"_id": 0, "transmitter.sessions": {"$slice": -1}, "transmitter.latest_session": 1}
+        for f in by_field:
+            projection[f"transmitter.{f}"] = 1
         try:
-            docs = list(self.collection.find({"transmitter.email": email}))
-            sessions: List[Dict[str, str]] = []
+            query = {"$or": or_clauses} if len(or_clauses) > 1 else or_clauses[0]
+            if window is not None:
+                query = {"$and": [query, self._active_clause(window)]}
+            docs = self.collection.find(query, projection)
+            found: Dict[tuple, Dict[str, Any]] = {}
             for d in docs:
-                s = d.get("transmitter", {}).get("sessions", [])
-                sessions.extend(s)
-            sessions_sorted = sorted(sessions, key=lambda x: x.get("timestamp", ""), reverse=newest_first)
-            return sessions_sorted[:limit] if limit else sessions_sorted
+                transmitter = d.get("transmitter", {})
+                sessions = transmitter.get("sessions", [])
+                latest = transmitter.get("latest_session") or (sessions[-1] if sessions else None)
+                if not latest:
+                    continue
+                for f, values in by_field.items():
+                    key = (f, transmitter.get(f))
+                    if key[1] in values and (key not in found or self._session_sort_key(latest) > self._session_sort_key(found[key])):
+                        found[key] = latest
+            return found
         except PyMongoError:
-            return []
+            return {}
 
-    def get_sessions_by_chat_id(self, chat_id: str, limit: Optional[int] = None, newest_first: bool = True) -> List[Dict[str, str]]:
-        if not chat_id:
-            return []
+    def get_latest_session(self, id_field: str, value: str, window: Optional[timedelta] = None) -> Optional[Dict[str, Any]]:
+        """
+        Devuelve la última sesión ({"session_id", "timestamp"}) registrada para el identificador
+        `id_field` (phone/email/chat_id/meta_id) o None si no hay ninguna.
+        Con `window` sólo la devuelve si sigue activa (iniciada hace menos de `window`); el
+        filtro lo resuelve el servidor sobre el índice del identificador.
+
+        Es una única lectura indexada que sólo trae `latest_session`; para documentos antiguos
+        sin ese campo se recurre al último elemento de `sessions` (proyección $slice).
+        """
+        if id_field not in self.IDENTIFIER_FIELDS or not value:
+            return None
+        query = {f"transmitter.{id_field}": value}
+        if window is not None:
+            query.update(self._active_clause(window))
         try:
-            docs = list(self.collection.find({"transmitter.chat_id": chat_id}))
-            sessions: List[Dict[str, str]] = []
-            for d in docs:
-                s = d.get("transmitter", {}).get("sessions", [])
-                sessions.extend(s)
-            sessions_sorted = sorted(sessions, key=lambda x: x.get("timestamp", ""), reverse=newest_first)
-            return sessions_sorted[:limit] if limit else sessions_sorted
+            docs = list(self.collection.find(
+                query,
+                {"_id": 0, "transmitter.latest_session": 1, "transmitter.sessions": {"$slice": -1}}
+            ).sort("transmitter.latest_session.timestamp", DESCENDING).limit(1))
+            if not docs:
+                return None
+            transmitter = docs[0].get("transmitter", {})
+            latest = transmitter.get("latest_session")
+            if latest:
+                return latest
+            sessions = transmitter.get("sessions", [])
+            return sessions[-1] if sessions else None
         except PyMongoError:
-            return []
+            return None
 
-    def get_sessions_by_meta_id(self, meta_id: str, limit: Optional[int] = None, newest_first: bool = True) -> List[Dict[str, str]]:
-        if not meta_id:
+    def _get_sessions_by(self, id_field: str, value: str, limit: Optional[int] = None, newest_first: bool = True) -> List[Dict[str, Any]]:
+        if not value:
             return []
         try:
-            docs = list(self.collection.find({"transmitter.meta_id": meta_id}))
-            sessions: List[Dict[str, str]] = []
+            # las sesiones se agregan en orden cronológico: si sólo se piden las más recientes
+            # basta con traer la cola del array desde el servidor
+            projection = {"transmitter.sessions": {"$slice": -limit}} if (limit and newest_first) else {"transmitter.sessions": 1}
+            docs = list(self.collection.find({f"transmitter.{id_field}": value}, projection))
+            sessions: List[Dict[str, Any]] = []
             for d in docs:
                 s = d.get("transmitter", {}).get("sessions", [])
                 sessions.extend(s)
-            sessions_sorted = sorted(sessions, key=lambda x: x.get("timestamp", ""), reverse=newest_first)
+            sessions_sorted = sorted(sessions, key=self._session_sort_key, reverse=newest_first)
             return sessions_sorted[:limit] if limit else sessions_sorted
         except PyMongoError:
             return []
@@ -0,0 +1,201 @@
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional
+import atexit
+import logging
+import os
+import threading
+import time
+import weakref
+
+from modules import metrics
+
+logger = logging.getLogger(__name__)
+
+# Modos de confirmación de un mensaje encolado
+ACK_PROVISIONAL = "provisional"  # se responde al encolar; el mensaje se escribe en el próximo lote
+ACK_DURABLE = "durable"          # se espera a que el lote que lo contiene sea confirmado por la base
+ACK_MODES = (ACK_PROVISIONAL, ACK_DURABLE)
+
+# colas vivas del proceso, para drenarlas al terminar (atexit / worker_exit de gunicorn)
+_queues: "weakref.WeakSet[WriteBehindQueue]" = weakref.WeakSet()
+_drain_registered = False
+_drain_lock = threading.Lock()
+
+
+class WriteBehindQueue:
+    """
+    Cola de escritura diferida (group commit) para mensajes agregados a sesiones existentes.
+
+    `submit` encola el mensaje y devuelve un Future; un único hilo de fondo agrupa lo encolado
+    en un `bulk_write_messages` (un $push con $each por sesión) cuando se juntan `max_batch`
+    mensajes o el más antiguo cumple `max_delay_ms`. Como los lotes se escriben de a uno y en
+    orden de llegada, se conserva el orden de los mensajes de cada sesión.
+
+    El Future se resuelve con True cuando la escritura fue confirmada y con False si falló.
+    Con confirmación provisional un fallo (o la caída del proceso) pierde los mensajes aún no escritos.
+    """
+
+    def __init__(self, store, max_batch: int = 500, max_delay_ms: float = 5.0, ack: str = ACK_PROVISIONAL, durable_timeout: float = 10.0):
+        self.store = store
+        self.max_batch = max(1, max_batch)
+        self.max_delay = max(0.0, max_delay_ms) / 1000
+        self.ack = ack if ack in ACK_MODES else ACK_PROVISIONAL
+        self.durable_timeout = durable_timeout
+        self._cond = threading.Condition()
+        # (session_id, message_entry, future, encolado_en)
+        self._pending: List[tuple] = []
+        self._inflight: List[tuple] = []
+        self._closed = False
+        self._thread: Optional[threading.Thread] = None
+        self._pid = None
+        self.batches = 0
+        self.messages = 0
+        self.failed = 0
+        _queues.add(self)
+        _register_drain()
+
+    def submit(self, session_id: str, message_entry: Dict[str, Any]) -> Future:
+        """Encola `message_entry` (ver `build_message_entry`) para la sesión `session_id`."""
+        future: Future = Future()
+        with self._cond:
+            if self._closed and (self._thread is None or self._pid != os.getpid()):
+                # cola cerrada y ya drenada: se escribe de forma directa
+                future.set_result(self._write({session_id: [message_entry]}, 1))
+                return future
+            if not self._closed:
+                self._ensure_thread()
+            self._pending.append((session_id, message_entry, future, time.monotonic()))
+            if len(self._pending) == 1 or len(self._pending) >= self.max_batch:
+                self._cond.notify()
+        return future
+
+    def cancel(self, future: Future) -> bool:
+        """
+        Retira de la cola el mensaje de `future` si todavía no salió en un lote (el Future queda
+        cancelado). False si ya se está escribiendo o se escribió: su resultado llegará igual.
+        """
+        with self._cond:
+            for n, item in enumerate(self._pending):
+                if item[2] is future:
+                    del self._pending[n]
+                    future.cancel()
+                    return True
+        return False
+
+    def pending(self, session_id: str) -> List[Dict[str, Any]]:
+        """Mensajes de `session_id` encolados o en escritura, todavía no confirmados (en orden)."""
+        with self._cond:
+            return [entry for sid, entry, _, _ in self._inflight + self._pending if sid == session_id]
+
+    def close(self, timeout: Optional[float] = None):
+        """Deja de aceptar mensajes en la cola y espera a que se escriba todo lo pendiente."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+            thread = self._thread if self._pid == os.getpid() else None
+        if thread is not None:
+            thread.join(timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            queued = len(self._pending) + len(self._inflight)
+        return {"ack": self.ack, "max_batch": self.max_batch, "max_delay_ms": self.max_delay * 1000, "queued": queued, "batches": self.batches, "messages": self.messages, "failed": self.failed}
+
+    # ----------------- internos -----------------
+    def _ensure_thread(self):
+        # un hilo no sobrevive a un fork: lo heredado pertenece al proceso padre, que lo escribirá
+        if self._pid != os.getpid():
+            self._pending, self._inflight = [], []
+            self._thread = None
+            self._pid = os.getpid()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+            self._thread.start()
+
+    def _next_batch(self) -> Optional[List[tuple]]:
+        """Espera hasta que haya un lote listo (por tamaño o antigüedad); None si la cola se cerró vacía."""
+        with self._cond:
+            while not self._pending:
+                if self._closed:
+                    self._thread = None
+                    return None
+                self._cond.wait()
+            while len(self._pending) < self.max_batch and not self._closed:
+                remaining = self._pending[0][3] + self.max_delay - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = self._pending[:self.max_batch]
+            del self._pending[:self.max_batch]
+            self._inflight = batch
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            appends: Dict[str, List[Dict[str, Any]]] = {}
+            for session_id, entry, _, _ in batch:
+                appends.setdefault(session_id, []).append(entry)
+            ok = self._write(appends, len(batch))
+            with self._cond:
+                self._inflight = []
+            for _, _, future, _ in batch:
+                future.set_result(ok)
+
+    def _write(self, appends: Dict[str, List[Dict[str, Any]]], count: int) -> bool:
+        try:
+            ok = bool(self.store.bulk_write_messages([], appends))
+        except Exception as e:
+            logger.error("[ERROR_WRITE_BEHIND]: Error al escribir el lote: %s", e)
+            ok = False
+        self.batches += 1
+        self.messages += count
+        if not ok:
+            self.failed += count
+            logger.error("[ERROR_WRITE_BEHIND]: %d mensajes de %d sesiones no se escribieron", count, len(appends))
+        metrics.WRITE_BEHIND_BATCH.labels("ok" if ok else "failed").observe(count)
+        return ok
+
+
+def build_write_behind(store) -> Optional[WriteBehindQueue]:
+    """
+    Crea la cola de escritura diferida según el entorno (None si está desactivada):
+
+    - WRITE_BEHIND_MODE (off | provisional | durable): confirmación por defecto de cada mensaje.
+    - WRITE_BEHIND_MAX_BATCH (500): mensajes por lote.
+    - WRITE_BEHIND_MAX_DELAY_MS (5): espera máxima de un mensaje antes de escribir un lote incompleto.
+    - WRITE_BEHIND_DURABLE_TIMEOUT (10): segundos que espera una confirmación durable.
+    """
+    mode = os.getenv("WRITE_BEHIND_MODE", "off").strip().lower()
+    if mode not in ACK_MODES:
+        if mode not in ("", "off", "none", "false", "0"):
+            logger.warning("[WRITE_BEHIND]: WRITE_BEHIND_MODE desconocido %r, se desactiva la cola", mode)
+        return None
+    return WriteBehindQueue(
+        store,
+        max_batch=int(os.getenv("WRITE_BEHIND_MAX_BATCH", 500)),
+        max_delay_ms=float(os.getenv("WRITE_BEHIND_MAX_DELAY_MS", 5)),
+        ack=mode,
+        durable_timeout=float(os.getenv("WRITE_BEHIND_DURABLE_TIMEOUT", 10)),
+    )
+
+
+def drain_all(timeout: Optional[float] = None):
+    """Cierra y drena todas las colas del proceso (antes de cerrar el cliente de la base)."""
+    for queue in list(_queues):
+        queue.close(timeout)
+
+
+def _register_drain():
+    """
+    Registra `drain_all` en atexit al crear la primera cola. La cola recibe un store ya
+    conectado, así que `close_mongo_client` (configs.config) ya está registrado: atexit ejecuta
+    los handlers en orden inverso, por lo que las colas se drenan antes de cerrar el cliente.
+    """
+    global _drain_registered
+    with _drain_lock:
+        if not _drain_registered:
+            atexit.register(drain_all)
+            _drain_registered = True
@@ -1,17 +1,46 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, Response, stream_with_context
+from datetime import date
+from typing import Optional
 import json
+import os
 import sys
+import threading
+import time
 from pathlib import Path
-from datetime import datetime
-from bson.objectid import ObjectId
 
 # Asegurar que el directorio 'backend' esté en sys.path para poder importar controller
 sys.path.append(str(Path(__file__).resolve().parent.parent))
 
 from controller.core_bot import CoreBot
+from modules.write_behind import ACK_MODES
+from routes.json_provider import dumps_bytes
 
 bp = Blueprint('core_bot', __name__)
-bot = CoreBot()
+
+# CoreBot se construye en la primera petición (o en el warm-up de create_app), no al importar
+# el módulo: importar las rutas no abre conexiones ni falla si la base no está disponible.
+_bot: Optional[CoreBot] = None
+_bot_lock = threading.Lock()
+
+
+def get_bot() -> CoreBot:
+    """CoreBot del proceso, creado de forma perezosa (una única instancia por proceso)."""
+    global _bot
+    if _bot is None:
+        with _bot_lock:
+            if _bot is None:
+                _bot = CoreBot()
+    return _bot
+
+
+def reset_bot():
+    """
+    Descarta el CoreBot heredado del proceso padre sin cerrarlo (sus stores usan el cliente Mongo
+    y los hilos del padre). Debe llamarse en el hijo tras un fork; el próximo `get_bot` crea uno nuevo.
+    """
+    global _bot, _bot_lock
+    _bot = None
+    _bot_lock = threading.Lock()
 
 
 """
@@ -26,24 +55,56 @@ Endpoints disponibles:
             "content": {"role": "user|bot", "text": "..."},
             "tokens": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
             "send_data": {"audio": null, "image": null, "location": null, "document": null, "video": null},
-            "phone": "+549...", "email": "x@x.com", "chat_id": "...", "meta_id": "..."
+            "phone": "+549...", "email": "x@x.com", "chat_id": "...", "meta_id": "...",
+            "history": 20 | {"limit": 20, "since_message_id": "..."},  (opcional)
+            "ack": "provisional" | "durable",                            (opcional)
+            "external_id": "<id del mensaje en el canal>"                (opcional)
         }
-    - Respuesta JSON: {"success": True|False, "session_id": "...", "created": True|False, "conversation": {...}}
+    - `history` acota los mensajes devueltos en `conversation` (últimos N y/o posteriores a un message_id).
+    - `ack` sólo aplica con la escritura diferida activa (WRITE_BEHIND_MODE): responder al encolar el
+      mensaje o esperar a que su lote se confirme. La respuesta incluye entonces "durable" y "message_id", y
+      "pending": True si el lote seguía escribiéndose al vencer la espera (no reintentar: se escribirá).
+    - `external_id` hace idempotente la escritura (el mismo mensaje puede llegar por n8n y por
+      workers/whatsapp_consumer.py): si ya se persistió se responde "duplicate": True con el historial guardado.
+    - Respuesta JSON: {"success": True|False, "session_id": "...", "created": True|False, "conversation": {...}, "timings": {"resolve_session_ms": ..., "total_ms": ...}}
+
+- POST /api/process_messages
+    - Descripción: Procesa en lote una ráfaga de mensajes (mismo payload que /process_message, sin `history`).
+    - Payload (JSON): {"messages": [<payload>, ...]} o directamente [<payload>, ...]
+    - Respuesta JSON: {"success": True|False, "results": [{"success": ..., "session_id": "...", "created": ..., "message_id": "..."}, ...]}
+      (un resultado por mensaje, en el mismo orden)
+    - Siempre se responde tras confirmarse la escritura. Con la escritura diferida activa, los mensajes de
+      sesiones existentes pasan por su cola para quedar detrás de los ya encolados de la misma sesión.
 
-- GET /api/conversations/<id_type>/<value>
-    - Descripción: Retorna todas las conversaciones cuyo campo `transmitter` coincide exactamente con `value`.
+- GET /api/conversations/<id_type>/<value>[?limit=N&after=<cursor>&summary=1&format=ndjson]
+    - Descripción: Retorna las conversaciones cuyo campo `transmitter` coincide exactamente con `value`,
+      ordenadas por creación.
     - id_type: one of `phone`, `email`, `chat`, `meta`.
-    - Respuesta JSON: {"success": True, "conversations": [doc,...]}
+    - `limit` pagina el resultado; `after` es el `next_cursor` de la página anterior (opaco).
+    - `summary=1` omite el historial de mensajes de cada conversación.
+    - `format=ndjson` transmite un documento por línea (application/x-ndjson) a medida que se leen.
+    - Respuesta JSON: {"ok": True, "conversations": [doc,...], "next_cursor": "..."|null}
 
-- GET /api/conversation/<session_id>
-    - Descripción: Retorna el documento de conversación completo para `session_id`.
-    - Respuesta: 200 con {"success": True, "conversation": doc} o 404 si no existe.
+- GET /api/conversation/<session_id>[?limit=N&since_message_id=...|after_message_id=...|since_version=V]
+    - Descripción: Retorna el documento de conversación para `session_id`; con `limit` y/o
+      `since_message_id` (alias `after_message_id`) sólo se incluye esa ventana del historial.
+    - El documento incluye "version", un entero que crece con cada mensaje o cambio de estado, y la
+      respuesta lleva `ETag: "<version>"`. Con `If-None-Match` y la misma versión se responde 304 sin cuerpo.
+    - `since_version=V` (una versión recibida antes): sólo lo nuevo -> {"session_id", "version", "delta": True,
+      "message": [mensajes posteriores], "states": {...} (completo, sólo si cambió)}. Si V no es anterior a la
+      versión actual se devuelve el documento completo con "delta": False.
+    - Respuesta: 200 con {"ok": True, "conversation": doc}, 304, o 404 si no existe.
 
 - POST /api/state
-    - Descripción: Inserta o reemplaza un estado (state) en la conversación.
+    - Descripción: Inserta o reemplaza uno o varios estados (state) en la conversación.
     - Payload: {"session_id": "...", "state": {"name": "state_name", "value": ...}}
+      o en lote: {"session_id": "...", "states": [{"name": "...", "value": ...}, ...]} | {"states": {"name": value, ...}}
     - Respuesta: {"success": True|False}
 
+- GET /api/state/<session_id>
+    - Descripción: Retorna sólo los estados de la conversación.
+    - Respuesta: {"ok": True, "states": {"name": value, ...}} o 404 si no existe.
+
 - DELETE /api/state
     - Descripción: Elimina un estado por nombre.
     - Payload: {"session_id": "...", "state_name": "..."}
@@ -51,17 +112,87 @@ Endpoints disponibles:
 
 - GET /api/transmitter/sessions/<id_type>/<value>
     - Descripción: Lista sesiones registradas para un transmitter (últimas primero si las hay).
+    - Con TRANSMITTER_SESSION_TTL_SECONDS > 0 (Mongo) los contactos sin sesiones en ese lapso se eliminan junto
+      con este historial; sus conversaciones se conservan (ver /api/conversations/<id_type>/<value>).
     - Respuesta: {"success": True, "sessions": [{"session_id":"...","timestamp":"ISO"}, ...]}
 
+- GET /api/cache/stats
+    - Descripción: Contadores de la cache identificador -> sesión activa.
+    - Respuesta: {"ok": True, "cache": {"backend": "memory|redis", "hits": N, "misses": N, ...}}
+
+- GET /api/usage?transmitter=<value>|session_id=<id>[&from=YYYY-MM-DD&to=YYYY-MM-DD&limit=N]
+    - Descripción: Consumo de tokens leído de los acumulados mantenidos al escribir (no recorre mensajes).
+    - `transmitter`: acumulado por día del contacto -> {"ok": True, "transmitter": "...", "days": [{"day", "prompt_tokens",
+      "completion_tokens", "total_tokens", "messages", "sessions"}, ...], "total": {...}}
+    - sin `transmitter`: por contacto en el rango -> {"ok": True, "contacts": [{"transmitter", ...}, ...], "total": {...}}
+      (mayor total_tokens primero; con `limit`, sólo los N primeros y `total` suma esos N)
+    - `session_id`: {"ok": True, "session": {"session_id", "transmitter", "usage": {...}}} o 404.
+    - Los días son UTC e inclusive.
+
+- GET /api/search?q=<texto>[&transmitter=<value>&from=YYYY-MM-DD&to=YYYY-MM-DD&limit=20&offset=0]
+    - Descripción: Mensajes que contienen todas las palabras de `q` (sin distinguir mayúsculas ni tildes,
+      sin stopwords, plurales simples), ordenados por relevancia y luego por recencia.
+    - `transmitter` y `from`/`to` (días UTC, inclusive) filtran; `limit` (máx. 100) y `offset` paginan.
+    - Respuesta: {"ok": True, "terms": [...], "results": [{"message_id", "session_id", "transmitter", "created_at",
+      "role", "snippet", "score"}, ...], "next_offset": N|null, "truncated": bool}
+      (`truncated`: sólo se puntuaron las coincidencias más recientes)
+
+- GET /api/stream?session_id=<id>|transmitter=<value>
+    - Descripción: Server-Sent Events (text/event-stream) con los mensajes y cambios de estado de una
+      sesión o de un contacto a medida que se escriben, en lugar de consultar /conversation en bucle.
+    - Eventos: `message` {"session_id", "transmitter", "message": {...}}, `state` {"session_id", "states": {...}},
+      `state_removed` {"session_id", "name"} y `resync` (se perdieron eventos: releer la conversación,
+      p.ej. con since_message_id). Cada evento lleva `id`; al reconectar, EventSource envía Last-Event-ID
+      (o `?last_event_id=`) y se reenvían los eventos recientes que faltaban.
+    - Un comentario ": keepalive" cada LIVE_UPDATES_HEARTBEAT_SECONDS (15); el stream se cierra tras
+      LIVE_UPDATES_MAX_STREAM_SECONDS (300) y el cliente se reconecta. Cada stream ocupa un hilo del worker:
+      por defecto se admiten streams para la mitad de GUNICORN_THREADS (LIVE_UPDATES_MAX_SUBSCRIBERS).
+    - Con varios workers los eventos deben repartirse entre procesos: LIVE_UPDATES_SOURCE=redis (Redis pub/sub)
+      o change_stream (Mongo desplegado como replica set); local sólo se admite con GUNICORN_WORKERS=1.
+    - 400 sin session_id ni transmitter, 404 si los eventos en vivo están desactivados (LIVE_UPDATES_SOURCE=off,
+      o local con varios workers), 503 si se alcanzó LIVE_UPDATES_MAX_SUBSCRIBERS.
+
+- GET /api/stream/stats
+    - Respuesta: {"ok": True, "live_updates": {"source": "local|redis|change_stream"|null, "subscribers": N, "published": N, "dropped": N, ...}}
+
+- GET /api/write_behind/stats
+    - Descripción: Estado de la cola de escritura diferida.
+    - Respuesta: {"ok": True, "write_behind": {"ack": "provisional|durable"|null, "queued": N, "batches": N, "messages": N, "failed": N, ...}}
+
 Notas:
-- Todos los endpoints devuelven JSON.
+- Todos los endpoints devuelven JSON (ObjectId -> str, fechas -> ISO 8601; ver routes/json_provider.py).
 - Los identificadores de transmitter (phone/email/chat/meta) son usados tal cual se almacenan en los documentos.
 """
 
 
-@bp.route('/process_message', methods=['POST'])
-def process_message():
-    data = request.get_json() or {}
+def _parse_history(raw):
+    """
+    Normaliza la opción de historial: entero (últimos N) o dict {"limit", "since_message_id"}.
+    Devuelve None si no se pidió ventana o el valor es inválido.
+    """
+    if raw is None or raw == "":
+        return None
+    if isinstance(raw, (int, str)) and not isinstance(raw, bool):
+        raw = {"limit": raw}
+    if not isinstance(raw, dict):
+        return None
+    history = {}
+    try:
+        limit = int(raw.get("limit")) if raw.get("limit") not in (None, "") else None
+    except (TypeError, ValueError):
+        limit = None
+    if limit and limit > 0:
+        history["limit"] = limit
+    if raw.get("since_message_id"):
+        history["since_message_id"] = str(raw["since_message_id"])
+    return history or None
+
+
+def _normalize_message_payload(data):
+    """
+    Normaliza el payload de un mensaje (content/tokens/send_data pueden venir como JSON string).
+    Devuelve (kwargs para CoreBot.process_message, None) o (None, mensaje de error).
+    """
     content = data.get('content')
     # Normalizar `content` a dict:
     # - si viene como string, intentar parsear JSON (p. ej. "{\"role\":\"user\",\"text\":\"...\"}")
@@ -76,9 +207,9 @@ def process_message():
         except Exception:
             content = {"text": content}
     if content is None:
-        return jsonify({"success": False, "error": "missing content"}), 400
+        return None, "missing content"
     if not isinstance(content, dict):
-        return jsonify({"success": False, "error": "content must be object or JSON string"}), 400
+        return None, "content must be object or JSON string"
     # Normalizar `tokens` (puede venir como JSON string desde integraciones como n8n)
     tokens_raw = data.get('tokens')
     tokens_default = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
@@ -104,33 +235,57 @@ def process_message():
         send_data = send_raw
     else:
         send_data = send_default
-    phone = data.get('phone')
-    email = data.get('email')
-    chat_id = data.get('chat_id')
-    meta_id = data.get('meta_id')
-
-    result = bot.process_message(content, tokens, send_data, phone=phone, email=email, chat_id=chat_id, meta_id=meta_id)
-    # Serializar objetos no JSON-serializables (ObjectId, datetime) recursivamente
-    def _serialize(obj):
-        if isinstance(obj, ObjectId):
-            return str(obj)
-        if isinstance(obj, datetime):
-            try:
-                return obj.isoformat()
-            except Exception:
-                return str(obj)
-        if isinstance(obj, dict):
-            return {k: _serialize(v) for k, v in obj.items()}
-        if isinstance(obj, list):
-            return [_serialize(v) for v in obj]
-        return obj
-
-    safe_result = _serialize(result)
-    return jsonify(safe_result)
+    return {
+        "content": content,
+        "tokens": tokens,
+        "send_data": send_data,
+        "phone": data.get('phone'),
+        "email": data.get('email'),
+        "chat_id": data.get('chat_id'),
+        "meta_id": data.get('meta_id'),
+        "external_id": data.get('external_id')
+    }, None
+
+
+@bp.route('/process_message', methods=['POST'])
+def process_message():
+    data = request.get_json() or {}
+    message, error = _normalize_message_payload(data)
+    if error:
+        return jsonify({"success": False, "error": error}), 400
+    history = _parse_history(data.get('history'))
+    ack = data.get('ack')
+    if ack is not None and ack not in ACK_MODES:
+        return jsonify({"success": False, "error": "ack must be 'provisional' or 'durable'"}), 400
+
+    result = get_bot().process_message(**message, history=history, ack=ack)
+    # ObjectId/datetime se serializan en el proveedor JSON de la app (routes/json_provider.py)
+    return jsonify(result)
+
+
+@bp.route('/process_messages', methods=['POST'])
+def process_messages():
+    data = request.get_json() or {}
+    raw_items = data.get('messages') if isinstance(data, dict) else data
+    if not isinstance(raw_items, list):
+        return jsonify({"success": False, "error": "messages must be an array"}), 400
+    results = [None] * len(raw_items)
+    valid, positions = [], []
+    for i, raw in enumerate(raw_items):
+        message, error = _normalize_message_payload(raw if isinstance(raw, dict) else {})
+        if error:
+            results[i] = {"success": False, "error": error}
+            continue
+        valid.append(message)
+        positions.append(i)
+    for i, res in zip(positions, get_bot().process_messages(valid) if valid else []):
+        results[i] = res
+    return jsonify({"success": all(r.get("success") for r in results), "results": results})
 
 
 @bp.route('/conversations/<id_type>/<value>', methods=['GET'])
 def conversations_by(id_type, value):
+    bot = get_bot()
     mapping = {
         'phone': bot.get_conversations_by_phone,
         'email': bot.get_conversations_by_email,
@@ -140,26 +295,59 @@ def conversations_by(id_type, value):
     func = mapping.get(id_type)
     if not func:
         return jsonify({"ok": False, "error": "invalid id_type"}), 400
+    try:
+        limit = int(request.args.get('limit') or 0) or None
+    except ValueError:
+        return jsonify({"ok": False, "error": "invalid limit"}), 400
+    after = request.args.get('after')
+    summary = request.args.get('summary', '').lower() in ('1', 'true', 'yes')
+
+    if request.args.get('format') == 'ndjson':
+        try:
+            docs = bot.iter_conversations_by_transmitter(value, limit=limit, after=after, summary=summary)
+            first = next(docs, None)
+        except ValueError:
+            return jsonify({"ok": False, "error": "invalid cursor"}), 400
+
+        def generate():
+            if first is not None:
+                yield dumps_bytes(first) + b"\n"
+            for doc in docs:
+                yield dumps_bytes(doc) + b"\n"
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    if limit or after or summary:
+        try:
+            page = bot.page_conversations_by_transmitter(value, limit=limit, after=after, summary=summary)
+        except ValueError:
+            return jsonify({"ok": False, "error": "invalid cursor"}), 400
+        return jsonify({"ok": True, **page})
     docs = func(value)
-    # serializar _id a str si existe
-    safe_docs = []
-    for d in docs:
-        if isinstance(d, dict) and '_id' in d:
-            d = d.copy()
-            d['_id'] = str(d['_id'])
-        safe_docs.append(d)
-    return jsonify({"ok": True, "conversations": safe_docs})
+    return jsonify({"ok": True, "conversations": docs})
 
 
 @bp.route('/conversation/<session_id>', methods=['GET'])
 def get_conversation(session_id):
-    convo = bot.conversation_module.get_conversation(session_id)
+    since_message_id = request.args.get('after_message_id') or request.args.get('since_message_id')
+    history = _parse_history({"limit": request.args.get('limit'), "since_message_id": since_message_id}) or {}
+    try:
+        since_version = int(request.args['since_version']) if request.args.get('since_version') else None
+    except ValueError:
+        return jsonify({"ok": False, "error": "invalid since_version"}), 400
+    bot = get_bot()
+    if request.if_none_match:
+        # sólo se leen los contadores: un 304 no carga ni serializa mensajes
+        version = bot.get_conversation_version(session_id)
+        if version is not None and request.if_none_match.contains_weak(str(version)):
+            response = Response(status=304)
+            response.set_etag(str(version))
+            return response
+    convo = bot.get_conversation(session_id, history_limit=history.get("limit"), since_message_id=history.get("since_message_id"), since_version=since_version)
     if not convo:
         return jsonify({"ok": False, "error": "not_found"}), 404
-    if '_id' in convo:
-        convo = convo.copy()
-        convo['_id'] = str(convo['_id'])
-    return jsonify({"ok": True, "conversation": convo})
+    response = jsonify({"ok": True, "conversation": convo})
+    response.set_etag(str(convo["version"]))
+    return response
 
 
 @bp.route('/state', methods=['POST'])
@@ -167,12 +355,23 @@ def add_state():
     data = request.get_json() or {}
     session_id = data.get('session_id')
     state = data.get('state')
+    states = data.get('states')
+    if session_id and isinstance(states, (list, dict)) and states:
+        return jsonify({"ok": get_bot().set_states(session_id, states)})
     if not session_id or not isinstance(state, dict):
         return jsonify({"ok": False, "error": "missing session_id or state"}), 400
-    ok = bot.add_or_replace_state(session_id, state)
+    ok = get_bot().add_or_replace_state(session_id, state)
     return jsonify({"ok": ok})
 
 
+@bp.route('/state/<session_id>', methods=['GET'])
+def get_states(session_id):
+    states = get_bot().get_states(session_id)
+    if states is None:
+        return jsonify({"ok": False, "error": "not_found"}), 404
+    return jsonify({"ok": True, "states": states})
+
+
 @bp.route('/state', methods=['DELETE'])
 def delete_state():
     data = request.get_json() or {}
@@ -180,20 +379,118 @@ def delete_state():
     state_name = data.get('state_name')
     if not session_id or not state_name:
         return jsonify({"ok": False, "error": "missing session_id or state_name"}), 400
-    ok = bot.remove_state(session_id, state_name)
+    ok = get_bot().remove_state(session_id, state_name)
     return jsonify({"ok": ok})
 
 
 @bp.route('/transmitter/sessions/<id_type>/<value>', methods=['GET'])
 def transmitter_sessions(id_type, value):
+    transmitter = get_bot().transmitter_module
     mapping = {
-        'phone': bot.transmitter_module.get_sessions_by_phone,
-        'email': bot.transmitter_module.get_sessions_by_email,
-        'chat': bot.transmitter_module.get_sessions_by_chat_id,
-        'meta': bot.transmitter_module.get_sessions_by_meta_id
+        'phone': transmitter.get_sessions_by_phone,
+        'email': transmitter.get_sessions_by_email,
+        'chat': transmitter.get_sessions_by_chat_id,
+        'meta': transmitter.get_sessions_by_meta_id
     }
     func = mapping.get(id_type)
     if not func:
         return jsonify({"ok": False, "error": "invalid id_type"}), 400
     sessions = func(value)
     return jsonify({"ok": True, "sessions": sessions})
+
+
+@bp.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify({"ok": True, "cache": get_bot().cache_stats()})
+
+
+@bp.route('/write_behind/stats', methods=['GET'])
+def write_behind_stats():
+    return jsonify({"ok": True, "write_behind": get_bot().write_behind_stats()})
+
+
+def _parse_day(raw):
+    """Día "YYYY-MM-DD" validado; None si no se indicó. ValueError si es inválido."""
+    if not raw:
+        return None
+    return date.fromisoformat(raw).isoformat()
+
+
+@bp.route('/usage', methods=['GET'])
+def usage():
+    session_id = request.args.get('session_id')
+    if session_id:
+        session = get_bot().get_session_usage(session_id)
+        if session is None:
+            return jsonify({"ok": False, "error": "not found"}), 404
+        return jsonify({"ok": True, "session": session})
+    try:
+        start_day = _parse_day(request.args.get('from'))
+        end_day = _parse_day(request.args.get('to'))
+    except ValueError:
+        return jsonify({"ok": False, "error": "from/to must be YYYY-MM-DD"}), 400
+    try:
+        limit = int(request.args.get('limit') or 0) or None
+    except ValueError:
+        return jsonify({"ok": False, "error": "invalid limit"}), 400
+    result = get_bot().get_usage(request.args.get('transmitter'), start_day, end_day, limit)
+    return jsonify({"ok": True, **result})
+
+
+@bp.route('/search', methods=['GET'])
+def search():
+    query = (request.args.get('q') or '').strip()
+    if not query:
+        return jsonify({"ok": False, "error": "q is required"}), 400
+    try:
+        start_day = _parse_day(request.args.get('from'))
+        end_day = _parse_day(request.args.get('to'))
+    except ValueError:
+        return jsonify({"ok": False, "error": "from/to must be YYYY-MM-DD"}), 400
+    try:
+        limit = min(int(request.args.get('limit') or 20), 100)
+        offset = int(request.args.get('offset') or 0)
+    except ValueError:
+        return jsonify({"ok": False, "error": "invalid limit/offset"}), 400
+    if limit < 1 or offset < 0:
+        return jsonify({"ok": False, "error": "invalid limit/offset"}), 400
+    result = get_bot().search(query, request.args.get('transmitter'), start_day, end_day, limit, offset)
+    return jsonify({"ok": True, **result})
+
+
+@bp.route('/stream', methods=['GET'])
+def stream():
+    session_id = request.args.get('session_id')
+    transmitter = request.args.get('transmitter')
+    if not session_id and not transmitter:
+        return jsonify({"ok": False, "error": "session_id or transmitter is required"}), 400
+    bot = get_bot()
+    if bot.live_updates is None:
+        return jsonify({"ok": False, "error": "live updates disabled"}), 404
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    subscription = bot.subscribe(session_id, transmitter, last_event_id)
+    if subscription is None:
+        return jsonify({"ok": False, "error": "too many subscribers"}), 503
+    heartbeat = float(os.getenv("LIVE_UPDATES_HEARTBEAT_SECONDS", 15))
+    deadline = time.monotonic() + float(os.getenv("LIVE_UPDATES_MAX_STREAM_SECONDS", 300))
+
+    def generate():
+        try:
+            yield b"retry: 2000\n\n"
+            while time.monotonic() < deadline:
+                event = subscription.get(timeout=min(heartbeat, max(0.0, deadline - time.monotonic())))
+                if event is None:
+                    if subscription.closed:
+                        return
+                    yield b": keepalive\n\n"
+                    continue
+                data = {k: v for k, v in event.items() if k not in ("id", "type")}
+                yield b"id: %s\nevent: %s\ndata: %s\n\n" % (event["id"].encode(), event["type"].encode(), dumps_bytes(data))
+        finally:
+            bot.unsubscribe(subscription)
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@bp.route('/stream/stats', methods=['GET'])
+def stream_stats():
+    return jsonify({"ok": True, "live_updates": get_bot().live_updates_stats()})
@@ -0,0 +1,40 @@
+from flask import Flask, jsonify
+import os
+import sys
+import threading
+from pathlib import Path
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+# Sondas para el orquestador (fuera de /api):
+# - GET /healthz: el proceso responde (liveness). No toca la base.
+# - GET /readyz: el proceso puede atender peticiones (readiness): hubo un warm-up exitoso y la
+#   base responde a un ping acotado por READINESS_TIMEOUT_SECONDS (2). Si el warm-up no se hizo
+#   o falló (p.ej. Mongo caído al arrancar, o contactos duplicados que impiden los índices únicos:
+#   ver scripts/dedupe_transmitters.py), se reintenta aquí. 503 mientras no esté listo.
+_warm_up_lock = threading.Lock()
+
+
+def register_health(app: Flask):
+    from routes.core_bot_routes import get_bot
+
+    try:
+        timeout = float(os.getenv("READINESS_TIMEOUT_SECONDS", 2))
+    except ValueError:
+        timeout = 2.0
+
+    @app.route("/healthz")
+    def healthz():
+        return jsonify({"ok": True})
+
+    @app.route("/readyz")
+    def readyz():
+        bot = get_bot()
+        if not bot.ready:
+            # una sola sonda a la vez reintenta el warm-up; el resto responde 503 sin esperar
+            if _warm_up_lock.acquire(blocking=False):
+                try:
+                    bot.warm_up()
+                finally:
+                    _warm_up_lock.release()
+        ready = bot.is_ready(timeout)
+        return jsonify({"ok": ready, "ready": ready}), 200 if ready else 503
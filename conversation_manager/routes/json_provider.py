@@ -0,0 +1,58 @@
+"""
+Serialización JSON de las respuestas del blueprint.
+
+`BsonJSONProvider` reemplaza al proveedor por defecto de Flask: `jsonify` serializa en una sola
+pasada los documentos de Mongo tal como salen del driver (ObjectId, datetime, Decimal128), sin
+recorridos previos ni copias para convertir `_id`. Usa orjson si está instalado y, si no,
+el módulo json estándar con el mismo `default`.
+"""
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from uuid import UUID
+
+from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # dependencia opcional
+    orjson = None
+
+
+def bson_default(obj):
+    """Convierte los tipos BSON/Python que el encoder no conoce de forma nativa."""
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, Decimal128):
+        return str(obj.to_decimal())
+    if isinstance(obj, Decimal):
+        return str(obj)
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, UUID):
+        return str(obj)
+    if isinstance(obj, (bytes, bytearray)):
+        return obj.decode("utf-8", errors="replace")
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps_bytes(obj) -> bytes:
+    """Serializa `obj` a JSON (bytes UTF-8)."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=bson_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, default=bson_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class BsonJSONProvider(DefaultJSONProvider):
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs) -> str:
+        return dumps_bytes(obj).decode("utf-8")
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps_bytes(obj), mimetype=self.mimetype)
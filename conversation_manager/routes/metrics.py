@@ -0,0 +1,33 @@
+from flask import Flask, Response, g, request
+import time
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from modules import metrics
+
+
+def register_metrics(app: Flask):
+    """
+    Mide la latencia de cada petición (por método, regla de ruta y status) y expone GET /metrics.
+    No hace nada si las métricas están desactivadas o prometheus_client no está instalado.
+    """
+    if not metrics.ENABLED:
+        return
+
+    @app.before_request
+    def _start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def _observe(response):
+        start = g.pop("metrics_start", None)
+        if start is not None:
+            # la regla (p.ej. /api/conversation/<session_id>) mantiene acotada la cardinalidad
+            route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+            metrics.HTTP_REQUEST_DURATION.labels(request.method, route, str(response.status_code)).observe(time.perf_counter() - start)
+        return response
+
+    @app.route("/metrics")
+    def prometheus_metrics():
+        body, content_type = metrics.render()
+        return Response(body, content_type=content_type)
@@ -0,0 +1,46 @@
+"""
+Mueve al archivo (colección 'conversation_archive', compresión zstd) las conversaciones creadas
+hace más de --older-than-days días (por defecto CONVERSATION_ARCHIVE_AFTER_DAYS o 30).
+
+Uso:
+    python scripts/archive_conversations.py [--older-than-days N] [--limit N] [--dry-run]
+
+Pensado para ejecutarse periódicamente (cron). Es seguro re-ejecutarlo: una sesión que recibe
+mensajes mientras se copia no se elimina del nivel caliente y se reintenta en la siguiente ejecución.
+Las lecturas por session_id y por transmitter consultan el archivo de forma transparente.
+"""
+import argparse
+import os
+import sys
+from datetime import timedelta
+from pathlib import Path
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from modules.conversation import Conversation
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archiva conversaciones antiguas.")
+    parser.add_argument("--older-than-days", type=float, default=float(os.getenv("CONVERSATION_ARCHIVE_AFTER_DAYS", 30)))
+    parser.add_argument("--limit", type=int, default=0, help="máximo de sesiones a archivar (0 = todas)")
+    parser.add_argument("--dry-run", action="store_true", help="sólo cuenta las sesiones archivables")
+    args = parser.parse_args()
+
+    if args.older_than_days < 1:
+        # nunca archivar sesiones que aún pueden estar dentro de la ventana de 24h
+        parser.error("--older-than-days debe ser >= 1")
+
+    conversation = Conversation()
+    # crea la colección de archivo (zstd) y sus índices si aún no existen
+    conversation.warm_up()
+    older_than = timedelta(days=args.older_than_days)
+    if args.dry_run:
+        pending = conversation.collection.count_documents(conversation.archivable_query(older_than))
+        print(f"[ARCHIVE_CONVERSATIONS]: sesiones archivables: {pending}")
+        return
+
+    archived, retry = conversation.archive_older_than(older_than, limit=args.limit)
+    print(f"[ARCHIVE_CONVERSATIONS]: archivadas: {archived}, pendientes de reintento: {retry}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Completa la contabilidad de tokens ('usage' de cada sesión y acumulados diarios en 'token_usage')
+para los mensajes escritos antes de que se mantuviera de forma incremental.
+
+Uso:
+    python scripts/backfill_token_usage.py [--batch-size 500] [--dry-run]
+
+Recorre una única vez 'conversation' y 'conversation_archive'. Los mensajes ya contados son los
+últimos `usage.messages` de cada sesión (los nuevos se agregan al final), por lo que sólo se
+suma el prefijo sin contar: es seguro ejecutarlo con tráfico y re-ejecutarlo (no cuenta dos veces).
+Cada mensaje se acumula en el día de su message_id (o de la creación de la sesión si el id no
+lleva fecha); la sesión se cuenta en el día de su creación.
+"""
+import argparse
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from pymongo import UpdateOne
+from modules.conversation import Conversation
+from modules.id_generator import id_timestamp_ms
+from modules.storage import USAGE_FIELDS, message_usage, usage_day
+
+
+def message_day(message, fallback: str) -> str:
+    message_id = message.get("message_id")
+    ms = id_timestamp_ms(message_id)
+    # formato anterior: "<epoch ms><4 dígitos aleatorios>"
+    if ms is None and isinstance(message_id, str) and message_id.isdigit() and len(message_id) == 17:
+        ms = int(message_id[:13])
+    if ms is None:
+        return fallback
+    return datetime.fromtimestamp(ms / 1000, timezone.utc).date().isoformat()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Completa la contabilidad de tokens de mensajes anteriores.")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--dry-run", action="store_true", help="sólo cuenta las sesiones y mensajes pendientes")
+    args = parser.parse_args()
+
+    conversation = Conversation()
+    conversation.warm_up()
+    rollups = {}
+    for name, collection in (("conversation", conversation.collection), ("conversation_archive", conversation.archive)):
+        ops = []
+        pending_sessions, pending_messages = 0, 0
+        projection = {"session_id": 1, "transmitter": 1, "created_at": 1, "usage": 1, "layout": 1, "message_count": 1, "bucket_size": 1,
+                      "message.message_id": 1, "message.tokens": 1}
+        for doc in collection.find({}, projection):
+            doc = conversation.load_messages(doc)
+            messages = doc.get("message") or []
+            counted = (doc.get("usage") or {}).get("messages", 0)
+            uncounted = messages[:max(0, len(messages) - counted)]
+            if not uncounted:
+                continue
+            pending_sessions += 1
+            pending_messages += len(uncounted)
+            if args.dry_run:
+                continue
+            inc = message_usage(uncounted)
+            ops.append(UpdateOne({"_id": doc["_id"]}, {"$inc": {f"usage.{field}": value for field, value in inc.items()}}))
+            transmitter = doc.get("transmitter")
+            if transmitter:
+                created_day = usage_day(doc.get("created_at"))
+                # el primer mensaje no estaba contado: la creación de la sesión tampoco
+                rollups.setdefault((transmitter, created_day), dict.fromkeys(USAGE_FIELDS + ("sessions",), 0))["sessions"] += 1
+                for message in uncounted:
+                    acc = rollups.setdefault((transmitter, message_day(message, created_day)), dict.fromkeys(USAGE_FIELDS + ("sessions",), 0))
+                    for field, value in message_usage([message]).items():
+                        acc[field] += value
+            if len(ops) >= args.batch_size:
+                collection.bulk_write(ops, ordered=False)
+                ops = []
+        if ops:
+            collection.bulk_write(ops, ordered=False)
+        print(f"[BACKFILL_TOKEN_USAGE]: {name}: sesiones pendientes: {pending_sessions}, mensajes: {pending_messages}")
+
+    if args.dry_run:
+        return
+    ops = [
+        UpdateOne({"transmitter": transmitter, "day": day}, {"$inc": acc, "$set": {"updated_at": datetime.now(timezone.utc)}}, upsert=True)
+        for (transmitter, day), acc in rollups.items()
+    ]
+    for i in range(0, len(ops), args.batch_size):
+        conversation.token_usage.bulk_write(ops[i:i + args.batch_size], ordered=False)
+    print(f"[BACKFILL_TOKEN_USAGE]: acumulados diarios actualizados: {len(ops)}")
+
+
+if __name__ == "__main__":
+    main()
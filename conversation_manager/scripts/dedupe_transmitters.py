@@ -0,0 +1,107 @@
+"""
+Fusiona los contactos duplicados de transmitter_sessions (varios documentos con el mismo phone,
+email, chat_id o meta_id) y crea los índices únicos por identificador.
+
+Mientras haya duplicados `Transmitter.ensure_indexes` no puede crear los índices únicos (deja
+índices no únicos), `resolve_or_create_session` no es atómico y /readyz responde 503.
+
+Por cada grupo de duplicados sobrevive el documento con la sesión más reciente y recibe:
+- las sesiones de todos (sin repetir session_id, en orden cronológico) y la más reciente como latest_session;
+- los identificadores que le falten, tomados de los demás (del más reciente al más antiguo).
+Los demás documentos se eliminan. Como la fusión puede juntar identificadores que a su vez estaban
+duplicados, se repite hasta que no queden grupos. Al final se reemplazan los índices no únicos
+por los únicos.
+
+Uso:
+    python scripts/dedupe_transmitters.py [--dry-run]
+
+Conviene ejecutarlo después de scripts/migrate_timestamps.py (el orden usa los timestamps) y con
+un respaldo de la colección.
+"""
+import argparse
+import sys
+from pathlib import Path
+from typing import Any, Dict, List
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from modules.conversation import Conversation
+from modules.transmitter import Transmitter
+
+MAX_PASSES = 10
+
+
+def _latest(doc: Dict[str, Any]) -> Dict[str, Any]:
+    transmitter = doc.get("transmitter") or {}
+    sessions = transmitter.get("sessions") or []
+    return transmitter.get("latest_session") or (sessions[-1] if sessions else {})
+
+
+def duplicate_groups(collection, field: str) -> List[Dict[str, Any]]:
+    """Grupos {"_id": valor, "ids": [_id, ...]} de documentos que comparten `field` (no vacío)."""
+    path = f"transmitter.{field}"
+    return list(collection.aggregate([
+        {"$match": {path: {"$type": "string", "$gt": ""}}},
+        {"$group": {"_id": f"${path}", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ], allowDiskUse=True))
+
+
+def merge(docs: List[Dict[str, Any]]):
+    """(_id del sobreviviente, campos a fijar en él, _ids a eliminar) para un grupo de duplicados."""
+    docs = sorted(docs, key=lambda d: Transmitter._session_sort_key(_latest(d)), reverse=True)
+    survivor = docs[0]
+    sessions: Dict[str, Dict[str, Any]] = {}
+    for doc in docs:
+        transmitter = doc.get("transmitter") or {}
+        for session in (transmitter.get("sessions") or []) + ([transmitter["latest_session"]] if transmitter.get("latest_session") else []):
+            if session.get("session_id"):
+                sessions.setdefault(session["session_id"], session)
+    ordered = sorted(sessions.values(), key=Transmitter._session_sort_key)
+    fields = {"transmitter.sessions": ordered, "transmitter.latest_session": ordered[-1] if ordered else None}
+    for field in Transmitter.IDENTIFIER_FIELDS:
+        value = next((d["transmitter"].get(field) for d in docs if (d.get("transmitter") or {}).get(field)), "")
+        fields[f"transmitter.{field}"] = value
+    return survivor["_id"], fields, [d["_id"] for d in docs[1:]]
+
+
+def dedupe(collection, dry_run: bool = False) -> Dict[str, int]:
+    """Fusiona los grupos de duplicados. Retorna {"groups", "removed"}."""
+    stats = {"groups": 0, "removed": 0}
+    for _ in range(MAX_PASSES):
+        found = False
+        for field in Transmitter.IDENTIFIER_FIELDS:
+            for group in duplicate_groups(collection, field):
+                found = True
+                stats["groups"] += 1
+                docs = list(collection.find({"_id": {"$in": group["ids"]}}))
+                survivor_id, fields, removed = merge(docs)
+                stats["removed"] += len(removed)
+                if dry_run:
+                    continue
+                # primero se eliminan los duplicados: si quedan índices únicos de otros
+                # identificadores, el sobreviviente no puede tomar sus valores mientras existan
+                collection.delete_many({"_id": {"$in": removed}})
+                collection.update_one({"_id": survivor_id}, {"$set": fields})
+        if not found or dry_run:
+            break
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fusiona contactos duplicados y crea los índices únicos.")
+    parser.add_argument("--dry-run", action="store_true", help="sólo cuenta los grupos de duplicados")
+    args = parser.parse_args()
+
+    transmitter = Transmitter(Conversation().db_manager)
+    stats = dedupe(transmitter.collection, dry_run=args.dry_run)
+    print(f"[DEDUPE_TRANSMITTERS]: grupos de duplicados: {stats['groups']}, documentos {'a eliminar' if args.dry_run else 'eliminados'}: {stats['removed']}")
+    if args.dry_run:
+        return
+    transmitter.drop_fallback_indexes()
+    unique = transmitter.ensure_indexes()
+    print(f"[DEDUPE_TRANSMITTERS]: índices únicos: {'creados' if unique else 'NO creados (revisar el log)'}")
+    if not unique:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
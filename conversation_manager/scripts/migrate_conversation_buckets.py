@@ -0,0 +1,46 @@
+"""
+Migra conversaciones del formato embedded (array 'message' en un único documento) al formato
+bucketed (cabecera en 'conversation' + documentos en 'conversation_buckets').
+
+Uso:
+    python scripts/migrate_conversation_buckets.py [--limit N] [--dry-run]
+
+El tamaño de bucket se toma de CONVERSATION_BUCKET_SIZE. Es seguro re-ejecutarlo: sólo procesa
+sesiones que aún no están en formato bucketed, y las que reciben mensajes durante la copia se
+reintentan en la siguiente ejecución.
+"""
+import argparse
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from modules.conversation import Conversation, LAYOUT_BUCKETED
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migra conversaciones al formato bucketed.")
+    parser.add_argument("--limit", type=int, default=0, help="máximo de sesiones a migrar (0 = todas)")
+    parser.add_argument("--dry-run", action="store_true", help="sólo cuenta las sesiones pendientes")
+    args = parser.parse_args()
+
+    conversation = Conversation()
+    # índice único (session_id, bucket) antes de escribir buckets
+    conversation.warm_up()
+    query = {"layout": {"$ne": LAYOUT_BUCKETED}}
+    if args.dry_run:
+        print(f"[MIGRATE_BUCKETS]: sesiones pendientes: {conversation.collection.count_documents(query)}")
+        return
+
+    cursor = conversation.collection.find(query, {"session_id": 1})
+    if args.limit:
+        cursor = cursor.limit(args.limit)
+    migrated, retry = 0, 0
+    for doc in cursor:
+        if conversation.migrate_to_buckets(doc["session_id"]):
+            migrated += 1
+        else:
+            retry += 1
+    print(f"[MIGRATE_BUCKETS]: migradas: {migrated}, pendientes de reintento: {retry}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Convierte los timestamps guardados como string ISO a fechas BSON:
+
+- conversation.created_at
+- transmitter_sessions: transmitter.latest_session.timestamp y transmitter.sessions[].timestamp
+  (los documentos sin latest_session lo reciben a partir de la última entrada de sessions).
+
+Uso:
+    python scripts/migrate_timestamps.py [--dry-run]
+
+Cada colección se migra con un único update_many con pipeline (MongoDB >= 4.2): la conversión
+($dateFromString) la hace el servidor. Es idempotente: sólo toca documentos que aún tienen strings.
+Mientras tanto la aplicación lee ambos formatos.
+
+Si el warm-up avisó de contactos duplicados (sin índices únicos), ejecutar después
+scripts/dedupe_transmitters.py.
+"""
+import argparse
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from modules.conversation import Conversation
+from modules.transmitter import Transmitter
+
+
+def _to_date(expr):
+    """Expresión que convierte `expr` a fecha si es string y lo deja igual en otro caso."""
+    return {"$cond": [
+        {"$eq": [{"$type": expr}, "string"]},
+        {"$dateFromString": {"dateString": expr, "onError": expr}},
+        expr
+    ]}
+
+
+CONVERSATION_QUERY = {"created_at": {"$type": "string"}}
+CONVERSATION_PIPELINE = [{"$set": {"created_at": _to_date("$created_at")}}]
+
+TRANSMITTER_QUERY = {"$or": [
+    {"transmitter.latest_session.timestamp": {"$type": "string"}},
+    {"transmitter.sessions.timestamp": {"$type": "string"}},
+    {"transmitter.latest_session": None, "transmitter.sessions.0": {"$exists": True}},
+]}
+TRANSMITTER_PIPELINE = [
+    {"$set": {"transmitter.sessions": {"$map": {
+        "input": {"$ifNull": ["$transmitter.sessions", []]},
+        "as": "s",
+        "in": {"$mergeObjects": ["$$s", {"timestamp": _to_date("$$s.timestamp")}]}
+    }}}},
+    {"$set": {"transmitter.latest_session": {"$cond": [
+        {"$gt": ["$transmitter.latest_session", None]},
+        {"$mergeObjects": ["$transmitter.latest_session", {"timestamp": _to_date("$transmitter.latest_session.timestamp")}]},
+        {"$arrayElemAt": ["$transmitter.sessions", -1]}
+    ]}}},
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migra timestamps string ISO a fechas BSON.")
+    parser.add_argument("--dry-run", action="store_true", help="sólo cuenta los documentos pendientes")
+    args = parser.parse_args()
+
+    conversation = Conversation()
+    transmitter = Transmitter(conversation.db_manager)
+    targets = [
+        ("conversation", conversation.collection, CONVERSATION_QUERY, CONVERSATION_PIPELINE),
+        ("transmitter_sessions", transmitter.collection, TRANSMITTER_QUERY, TRANSMITTER_PIPELINE),
+    ]
+    for name, collection, query, pipeline in targets:
+        if args.dry_run:
+            print(f"[MIGRATE_TIMESTAMPS]: {name}: documentos pendientes: {collection.count_documents(query)}")
+            continue
+        result = collection.update_many(query, pipeline)
+        print(f"[MIGRATE_TIMESTAMPS]: {name}: migrados: {result.modified_count}")
+
+
+if __name__ == "__main__":
+    main()
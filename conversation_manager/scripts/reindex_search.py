@@ -0,0 +1,76 @@
+"""
+Indexa para la búsqueda (colección 'message_search', ver modules.search) los mensajes escritos
+antes de que se indexaran al escribirlos.
+
+Uso:
+    python scripts/reindex_search.py [--batch-size 1000] [--transmitter <value>]
+
+Recorre 'conversation' y 'conversation_archive'. Cada mensaje se indexa con la fecha de su
+message_id (o de la creación de la sesión si el id no lleva fecha). El _id de cada documento es
+el message_id, por lo que los mensajes ya indexados se omiten: es seguro ejecutarlo con tráfico
+y re-ejecutarlo.
+"""
+import argparse
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from pymongo.errors import BulkWriteError
+from modules.conversation import Conversation
+from modules.id_generator import id_timestamp_ms
+from modules.search import search_document
+from modules.storage import as_utc_datetime
+
+
+def message_time(message, fallback):
+    message_id = message.get("message_id")
+    ms = id_timestamp_ms(message_id)
+    # formato anterior: "<epoch ms><4 dígitos aleatorios>"
+    if ms is None and isinstance(message_id, str) and message_id.isdigit() and len(message_id) == 17:
+        ms = int(message_id[:13])
+    if ms is None:
+        return fallback
+    return datetime.fromtimestamp(ms / 1000, timezone.utc)
+
+
+def insert(conversation, docs) -> int:
+    """Inserta los documentos; devuelve cuántos eran nuevos."""
+    try:
+        return len(conversation.message_search.insert_many(docs, ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+            raise
+        return e.details.get("nInserted", 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Indexa para la búsqueda los mensajes anteriores.")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--transmitter", help="sólo las conversaciones de este contacto")
+    args = parser.parse_args()
+
+    conversation = Conversation()
+    conversation.warm_up()
+    query = {"transmitter": args.transmitter} if args.transmitter else {}
+    for name, collection in (("conversation", conversation.collection), ("conversation_archive", conversation.archive)):
+        docs, indexed, sessions = [], 0, 0
+        projection = {"session_id": 1, "transmitter": 1, "created_at": 1, "layout": 1, "message_count": 1, "bucket_size": 1,
+                      "message.message_id": 1, "message.content": 1, "message.role": 1}
+        for doc in collection.find(query, projection):
+            doc = conversation.load_messages(doc)
+            sessions += 1
+            created_at = as_utc_datetime(doc.get("created_at")) or datetime.now(timezone.utc)
+            for message in doc.get("message") or []:
+                entry = search_document(doc["session_id"], doc.get("transmitter"), message, message_time(message, created_at))
+                if entry:
+                    docs.append(entry)
+            if len(docs) >= args.batch_size:
+                indexed += insert(conversation, docs)
+                docs = []
+        if docs:
+            indexed += insert(conversation, docs)
+        print(f"[REINDEX_SEARCH]: {name}: sesiones: {sessions}, mensajes indexados: {indexed}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Prueba de concurrencia de la creación de sesiones: muchos hilos envían a la vez mensajes del
+mismo contacto (como los mensajes partidos de WhatsApp) y se verifica que exista una única
+sesión activa, un único documento transmitter y que no se pierda ningún mensaje.
+
+Uso (contra la base configurada en DB_MONGO_*; usa un teléfono de prueba y lo borra al final):
+    python scripts/stress_session_creation.py [--threads 32] [--messages 8] [--batch]
+"""
+import argparse
+import sys
+import threading
+import time
+from pathlib import Path
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from controller.core_bot import CoreBot
+
+SEND_DATA = {"audio": None, "image": None, "location": None, "document": None, "video": None}
+TOKENS = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Martilla un mismo contacto desde muchos hilos.")
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--messages", type=int, default=8, help="mensajes por hilo")
+    parser.add_argument("--batch", action="store_true", help="usar process_messages (un lote por hilo)")
+    parser.add_argument("--phone", default=f"stress-{int(time.time() * 1000)}")
+    args = parser.parse_args()
+
+    # cada hilo usa su propio CoreBot (sin cache compartida) para simular workers independientes
+    bots = [CoreBot() for _ in range(args.threads)]
+    # los índices únicos son los que evitan sesiones duplicadas: deben existir antes de empezar
+    bots[0].warm_up()
+    for bot in bots:
+        bot.session_cache = None
+    barrier = threading.Barrier(args.threads)
+    errors = []
+
+    def worker(n):
+        bot = bots[n]
+        barrier.wait()
+        texts = [f"{n}-{i}" for i in range(args.messages)]
+        if args.batch:
+            results = bot.process_messages([{"content": {"role": "user", "text": t}, "tokens": TOKENS, "send_data": SEND_DATA, "phone": args.phone} for t in texts])
+        else:
+            results = [bot.process_message({"role": "user", "text": t}, TOKENS, SEND_DATA, phone=args.phone) for t in texts]
+        errors.extend(r for r in results if not r.get("success"))
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(args.threads)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    bot = bots[0]
+    conversations = bot.get_conversations_by_phone(args.phone)
+    transmitters = list(bot.transmitter_module.collection.find({"transmitter.phone": args.phone}))
+    stored = sum(len(c.get("message", [])) for c in conversations)
+    expected = args.threads * args.messages
+    print(f"[STRESS]: {expected} mensajes en {elapsed:.2f}s | conversaciones: {len(conversations)} | "
+          f"transmitters: {len(transmitters)} | mensajes guardados: {stored} | errores: {len(errors)}")
+
+    bot.conversation_module.collection.delete_many({"transmitter": args.phone})
+    bot.conversation_module.buckets.delete_many({"session_id": {"$in": [c["session_id"] for c in conversations]}})
+    bot.transmitter_module.collection.delete_many({"transmitter.phone": args.phone})
+
+    ok = len(conversations) == 1 and len(transmitters) == 1 and stored == expected and not errors
+    print("[STRESS]: OK" if ok else "[STRESS]: FALLÓ")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Fixtures comunes: backends embebidos (sqlite en memoria) y MongoDB sustituido por mongomock
+(`pip install mongomock`). Cada prueba usa una base nueva.
+"""
+import copy
+import os
+import sys
+import uuid
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from configs.config import set_mongo_client, reset_mongo_client
+
+
+def _patch_mongomock(mongomock):
+    # pymongo >= 4.9 pasa `sort` (y otras opciones) a las operaciones del bulk_write, que
+    # mongomock todavía no acepta
+    from mongomock.collection import BulkOperationBuilder, Collection
+    for name in ("add_update", "add_replace", "add_delete"):
+        original = getattr(BulkOperationBuilder, name, None)
+        if original is None or getattr(original, "_ignores_options", False):
+            continue
+
+        def wrapper(self, *args, _original=original, **kwargs):
+            for option in ("sort", "hint", "collation", "namespace"):
+                kwargs.pop(option, None)
+            return _original(self, *args, **kwargs)
+        wrapper._ignores_options = True
+        setattr(BulkOperationBuilder, name, wrapper)
+
+    # como MongoDB: una proyección que sólo tiene $slice devuelve también el resto de los campos
+    # (mongomock devuelve sólo el _id y el array recortado)
+    copy_only_fields = Collection._copy_only_fields
+    if getattr(copy_only_fields, "_slice_keeps_fields", False):
+        return
+
+    def _copy_only_fields(self, doc, fields, container):
+        if fields and all(isinstance(v, dict) and set(v) == {"$slice"} for v in fields.values()):
+            out = copy.deepcopy(doc)
+            self._apply_projection_operators(dict(fields), doc, out)
+            return out
+        return copy_only_fields(self, doc, fields, container)
+    _copy_only_fields._slice_keeps_fields = True
+    Collection._copy_only_fields = _copy_only_fields
+
+
+@pytest.fixture
+def mongo_db(monkeypatch):
+    """Nombre de una base mongomock nueva instalada como cliente compartido del proceso."""
+    mongomock = pytest.importorskip("mongomock")
+    _patch_mongomock(mongomock)
+    name = f"test_{uuid.uuid4().hex[:8]}"
+    monkeypatch.setenv("DB_MONGO_NAME", name)
+    client = mongomock.MongoClient(tz_aware=True)
+    # mongomock no soporta opciones de almacenamiento (zstd): se crea el archivo sin ellas
+    client[name].create_collection("conversation_archive")
+    set_mongo_client(client)
+    yield name
+    reset_mongo_client()
+
+
+@pytest.fixture
+def mongo_transmitter(mongo_db):
+    from modules.transmitter import Transmitter
+    transmitter = Transmitter()
+    transmitter.ensure_indexes()
+    return transmitter
+
+
+@pytest.fixture
+def sqlite_transmitter():
+    from modules.sqlite_store import SqliteDatabase, SqliteTransmitter
+    return SqliteTransmitter(SqliteDatabase(":memory:"))
+
+
+@pytest.fixture(params=["mongo", "sqlite"])
+def transmitter(request):
+    """Transmitter de cada backend (mongomock y sqlite en memoria)."""
+    return request.getfixturevalue(f"{request.param}_transmitter")
+
+
+@pytest.fixture(params=["memory", "sqlite", "mongo"])
+def backend(request, monkeypatch, tmp_path):
+    """Configura STORAGE_BACKEND (memory, sqlite en un archivo temporal o mongomock)."""
+    monkeypatch.setenv("STORAGE_BACKEND", request.param)
+    monkeypatch.setenv("SQLITE_PATH", str(tmp_path / "conversation_manager.db"))
+    monkeypatch.setenv("LIVE_UPDATES_SOURCE", "off")
+    monkeypatch.delenv("WRITE_BEHIND_MODE", raising=False)
+    if request.param == "mongo":
+        request.getfixturevalue("mongo_db")
+    return request.param
+
+
+@pytest.fixture
+def make_bot(backend):
+    """Construye CoreBots sobre el backend (con warm-up: índices únicos) y los cierra al terminar."""
+    from controller.core_bot import CoreBot
+    bots = []
+
+    def make():
+        bot = CoreBot()
+        bot.warm_up()
+        bots.append(bot)
+        return bot
+    yield make
+    for bot in bots:
+        bot.close()
+
+
+@pytest.fixture
+def redis_client():
+    """Cliente de un redis-server local (REDIS_TEST_URL, base 15 por defecto); se omite el test si no hay."""
+    redis = pytest.importorskip("redis")
+    client = redis.Redis.from_url(os.getenv("REDIS_TEST_URL", "redis://localhost:6379/15"))
+    try:
+        client.ping()
+    except redis.RedisError:
+        pytest.skip("redis-server no disponible")
+    return client
@@ -0,0 +1,10 @@
+TOKENS = {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15}
+SEND_DATA = {"audio": None, "image": None, "location": None, "document": None, "video": None}
+
+
+def message(text):
+    return {"role": "user", "text": text}
+
+
+def stored_messages(bot, session_id):
+    return [m["content"] for m in bot.get_conversation(session_id)["message"]]
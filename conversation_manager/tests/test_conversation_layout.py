@@ -0,0 +1,28 @@
+from tests.helpers import TOKENS, SEND_DATA, message
+
+
+def texts(doc):
+    return [m["content"] for m in doc["message"]]
+
+
+def test_append_to_a_migrated_session_with_the_default_layout(mongo_db, monkeypatch):
+    monkeypatch.delenv("CONVERSATION_STORAGE_LAYOUT", raising=False)
+    monkeypatch.setenv("CONVERSATION_BUCKET_SIZE", "2")
+    from modules.conversation import Conversation, LAYOUT_BUCKETED
+    conversation = Conversation()
+    conversation.warm_up()
+    session_id = conversation.new_conversation(message("m0"), TOKENS, SEND_DATA, transmitter="+5491100000500")["session_id"]
+    conversation.add_message(session_id, message("m1"), TOKENS, SEND_DATA)
+    assert conversation.migrate_to_buckets(session_id)
+
+    assert conversation.add_message(session_id, message("m2"), TOKENS, SEND_DATA)
+    returned = conversation.add_message_and_get(session_id, message("m3"), TOKENS, SEND_DATA, history_limit=2)
+    assert texts(returned) == ["m2", "m3"]
+    entries = [conversation.build_message_entry(message(t), TOKENS, SEND_DATA) for t in ("m4", "m5")]
+    assert conversation.bulk_write_messages([], {session_id: entries})
+
+    header = conversation.collection.find_one({"session_id": session_id})
+    assert header["layout"] == LAYOUT_BUCKETED and "message" not in header
+    assert header["message_count"] == 6
+    assert texts(conversation.get_conversation(session_id)) == ["m0", "m1", "m2", "m3", "m4", "m5"]
+    assert conversation.get_session_usage(session_id)["usage"]["messages"] == 6
@@ -0,0 +1,52 @@
+import pytest
+
+from tests.helpers import TOKENS, SEND_DATA, message
+
+
+@pytest.fixture
+def client(make_bot, monkeypatch):
+    import routes.core_bot_routes as routes
+    from app import create_app
+    monkeypatch.setattr(routes, "_bot", make_bot())
+    return create_app(warm_up=False).test_client()
+
+
+def post_message(client, text, phone="+5491100000400"):
+    response = client.post("/api/process_message", json={"content": message(text), "tokens": TOKENS, "send_data": SEND_DATA, "phone": phone})
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_since_version_returns_only_changes(client):
+    session_id = post_message(client, "m0")["session_id"]
+    post_message(client, "m1")
+
+    full = client.get(f"/api/conversation/{session_id}")
+    version = full.get_json()["conversation"]["version"]
+    assert full.headers["ETag"] == f'"{version}"'
+    assert [m["content"] for m in full.get_json()["conversation"]["message"]] == ["m0", "m1"]
+
+    unchanged = client.get(f"/api/conversation/{session_id}", headers={"If-None-Match": f'"{version}"'})
+    assert unchanged.status_code == 304
+    empty = client.get(f"/api/conversation/{session_id}?since_version={version}").get_json()["conversation"]
+    assert empty["delta"] and empty["message"] == [] and "states" not in empty
+
+    post_message(client, "m2")
+    delta = client.get(f"/api/conversation/{session_id}?since_version={version}").get_json()["conversation"]
+    assert delta["delta"] and delta["version"] > version
+    assert [m["content"] for m in delta["message"]] == ["m2"]
+    assert "states" not in delta
+    assert client.get(f"/api/conversation/{session_id}", headers={"If-None-Match": f'"{version}"'}).status_code == 200
+
+    assert client.post("/api/state", json={"session_id": session_id, "state": {"name": "step", "value": 1}}).get_json()["ok"]
+    states = client.get(f"/api/conversation/{session_id}?since_version={delta['version']}").get_json()["conversation"]
+    assert states["delta"] and states["message"] == []
+    assert states["version"] > delta["version"]
+    assert "step" in str(states["states"])
+
+
+def test_since_version_of_another_state_returns_full_document(client):
+    session_id = post_message(client, "m0")["session_id"]
+    conversation = client.get(f"/api/conversation/{session_id}?since_version={1 << 40}").get_json()["conversation"]
+    assert conversation["delta"] is False
+    assert [m["content"] for m in conversation["message"]] == ["m0"]
@@ -0,0 +1,23 @@
+import runpy
+from pathlib import Path
+
+CONF = str(Path(__file__).resolve().parent.parent / "gunicorn.conf.py")
+
+
+def test_preload_workers_rebuild_the_bot(monkeypatch):
+    monkeypatch.setenv("GUNICORN_PRELOAD", "1")
+    monkeypatch.setenv("STORAGE_BACKEND", "memory")
+    monkeypatch.setenv("WARM_UP_ON_START", "1")
+    # gunicorn.conf.py exporta GUNICORN_WORKERS: así se restaura al terminar
+    monkeypatch.setenv("GUNICORN_WORKERS", "1")
+    conf = runpy.run_path(CONF)
+    # en el master la app se crea sin CoreBot
+    assert conf["wsgi_app"] == "app:create_app(warm_up=False)"
+
+    import routes.core_bot_routes as routes
+    monkeypatch.setattr(routes, "_bot", None)
+    inherited = routes.get_bot()
+    conf["post_fork"](None, None)
+    conf["post_worker_init"](None)
+    assert routes._bot is not None and routes._bot is not inherited
+    assert routes._bot.ready
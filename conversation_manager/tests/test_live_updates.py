@@ -0,0 +1,54 @@
+import uuid
+
+from modules.live_updates import build_live_updates, default_max_subscribers
+
+
+class Store:
+    event_hook = None
+
+
+def test_streams_leave_threads_for_requests(monkeypatch):
+    monkeypatch.delenv("LIVE_UPDATES_MAX_SUBSCRIBERS", raising=False)
+    monkeypatch.delenv("GUNICORN_WORKER_CLASS", raising=False)
+    monkeypatch.setenv("GUNICORN_THREADS", "4")
+    hub = build_live_updates(Store())
+    assert hub.max_subscribers == 2
+    assert hub.subscribe("s1") and hub.subscribe("s2")
+    assert hub.subscribe("s3") is None
+
+    monkeypatch.setenv("GUNICORN_THREADS", "1")
+    assert default_max_subscribers() == 0
+    monkeypatch.setenv("GUNICORN_WORKER_CLASS", "gevent")
+    assert default_max_subscribers() == 64
+
+
+def test_max_subscribers_from_env(monkeypatch):
+    monkeypatch.setenv("LIVE_UPDATES_MAX_SUBSCRIBERS", "10")
+    assert build_live_updates(Store()).max_subscribers == 10
+
+
+def test_local_source_is_refused_with_several_workers(monkeypatch):
+    monkeypatch.setenv("LIVE_UPDATES_SOURCE", "local")
+    monkeypatch.setenv("GUNICORN_WORKERS", "4")
+    store = Store()
+    assert build_live_updates(store) is None
+    assert store.event_hook is None
+
+    monkeypatch.setenv("GUNICORN_WORKERS", "1")
+    assert build_live_updates(store).source == "local"
+
+
+def test_redis_source_fans_out_across_processes(redis_client, monkeypatch):
+    monkeypatch.setenv("LIVE_UPDATES_SOURCE", "redis")
+    monkeypatch.setenv("LIVE_UPDATES_REDIS_CHANNEL", f"test:live:{uuid.uuid4().hex}")
+    monkeypatch.setenv("GUNICORN_WORKERS", "4")
+    monkeypatch.setattr("modules.live_updates._redis_client", lambda: redis_client)
+    # dos workers: se escribe en uno y el suscriptor está en el otro
+    writer, reader = Store(), Store()
+    writer_hub, reader_hub = build_live_updates(writer), build_live_updates(reader)
+    subscription = reader_hub.subscribe("s1")
+    writer.event_hook({"type": "message", "session_id": "s1", "transmitter": "595981", "message": {"content": "hola"}})
+    event = subscription.get(timeout=5)
+    assert event["type"] == "message" and event["message"] == {"content": "hola"}
+    writer_hub.close()
+    reader_hub.close()
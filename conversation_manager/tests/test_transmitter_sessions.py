@@ -0,0 +1,100 @@
+import threading
+from datetime import datetime, timedelta, timezone
+
+from tests.helpers import TOKENS, SEND_DATA, message, stored_messages
+
+WINDOW = timedelta(hours=24)
+
+
+def test_new_phone_with_email_of_another_transmitter(transmitter):
+    existing, created = transmitter.resolve_or_create_session("s-email", "email", WINDOW, email="ana@example.com")
+    assert created and existing["session_id"] == "s-email"
+
+    session, created = transmitter.resolve_or_create_session("s-phone", "phone", WINDOW, phone="+5491100000001", email="ana@example.com")
+    assert created
+    assert session["session_id"] == "s-phone"
+    # los mensajes siguientes del mismo contacto encuentran la sesión
+    again, created = transmitter.resolve_or_create_session("s-other", "phone", WINDOW, phone="+5491100000001", email="ana@example.com")
+    assert not created
+    assert again["session_id"] == "s-phone"
+    assert transmitter.get_latest_session("email", "ana@example.com")["session_id"] == "s-email"
+
+
+def test_new_phone_with_email_of_another_transmitter_bulk(transmitter):
+    transmitter.resolve_or_create_session("s-email", "email", WINDOW, email="ana@example.com")
+
+    entries = [
+        {"session_id": "s-phone", "id_field": "phone", "phone": "+5491100000002", "email": "ana@example.com"},
+        {"session_id": "s-chat", "id_field": "chat_id", "chat_id": "chat-1"},
+    ]
+    results = transmitter.resolve_or_create_sessions_bulk(entries, WINDOW)
+    assert [(s["session_id"], created) for s, created in results] == [("s-phone", True), ("s-chat", True)]
+    assert transmitter.get_latest_session("phone", "+5491100000002")["session_id"] == "s-phone"
+
+
+def test_concurrent_messages_share_one_session(backend, make_bot):
+    # varios CoreBot sobre la misma base simulan workers; ":memory:" es propio de cada instancia
+    bots = [make_bot() for _ in range(1 if backend == "memory" else 4)]
+    for bot in bots:
+        bot.session_cache = None
+    threads, per_thread = 8, 4
+    barrier = threading.Barrier(threads)
+    results = []
+
+    def worker(n):
+        bot = bots[n % len(bots)]
+        barrier.wait()
+        for i in range(per_thread):
+            results.append(bot.process_message(message(f"{n}-{i}"), TOKENS, SEND_DATA, phone="+5491100000100"))
+
+    pool = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+
+    assert all(r["success"] for r in results)
+    sessions = {r["session_id"] for r in results}
+    assert len(sessions) == 1
+    assert sum(r["created"] for r in results) == 1
+    texts = stored_messages(bots[0], sessions.pop())
+    assert sorted(texts) == sorted(f"{n}-{i}" for n in range(threads) for i in range(per_thread))
+
+
+def test_new_phone_with_known_email_gets_a_session(make_bot):
+    bot = make_bot()
+    first = bot.process_message(message("hola"), TOKENS, SEND_DATA, email="ana@example.com")
+    assert first["success"]
+
+    results = [bot.process_message(message(f"m{i}"), TOKENS, SEND_DATA, phone="+5491100000200", email="ana@example.com") for i in range(3)]
+    assert all(r["success"] for r in results)
+    assert len({r["session_id"] for r in results}) == 1
+    assert results[0]["session_id"] != first["session_id"]
+
+
+def test_duplicate_contacts_block_readiness_until_deduplicated(monkeypatch, mongo_db):
+    from controller.core_bot import CoreBot
+    from scripts.dedupe_transmitters import dedupe
+    monkeypatch.setenv("STORAGE_BACKEND", "mongo")
+    monkeypatch.setenv("LIVE_UPDATES_SOURCE", "off")
+    monkeypatch.delenv("WRITE_BEHIND_MODE", raising=False)
+    now = datetime.now(timezone.utc)
+    old, new = {"session_id": "s-old", "timestamp": now - timedelta(days=2)}, {"session_id": "s-new", "timestamp": now}
+    bot = CoreBot()
+    collection = bot.transmitter_module.collection
+    # creados por workers en paralelo antes de que existieran los índices únicos
+    collection.insert_many([
+        {"transmitter": {"phone": "+5491100000400", "email": "ana@example.com", "chat_id": "", "meta_id": "", "sessions": [old], "latest_session": old}},
+        {"transmitter": {"phone": "+5491100000400", "email": "", "chat_id": "chat-400", "meta_id": "", "sessions": [new], "latest_session": new}},
+    ])
+    result = bot.warm_up()
+    assert not result["ready"] and not result["unique_identifiers"]
+
+    assert dedupe(collection) == {"groups": 1, "removed": 1}
+    bot.transmitter_module.drop_fallback_indexes()
+    assert bot.warm_up()["ready"]
+    (doc,) = collection.find()
+    assert doc["transmitter"]["email"] == "ana@example.com" and doc["transmitter"]["chat_id"] == "chat-400"
+    assert [s["session_id"] for s in doc["transmitter"]["sessions"]] == ["s-old", "s-new"]
+    assert bot.transmitter_module.get_latest_session("email", "ana@example.com")["session_id"] == "s-new"
+    bot.close()
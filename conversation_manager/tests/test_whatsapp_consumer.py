@@ -0,0 +1,58 @@
+import json
+import uuid
+
+import pytest
+
+from tests.helpers import TOKENS, SEND_DATA, message, stored_messages
+from workers.whatsapp_consumer import WhatsappStreamConsumer, payload_to_message
+
+
+def payload(text, message_id, phone="5959810001"):
+    return {"transmitter": "whatsapp", "phone": phone, "name": "Ana", "message": text, "send": {}, "message_id": message_id}
+
+
+def test_inbound_message_is_persisted_once(make_bot, backend):
+    # n8n (/api/process_message) y el consumidor reciben el mismo mensaje de WhatsApp
+    # (procesos distintos salvo con memory, que es una base por proceso)
+    n8n = make_bot()
+    consumer = n8n if backend == "memory" else make_bot()
+    first = n8n.process_message(message("hola"), TOKENS, SEND_DATA, phone="5959810001", external_id="WA1")
+    again = consumer.process_messages([payload_to_message(payload("hola", "WA1"))])[0]
+    assert first["success"] and again == {"success": True, "duplicate": True}
+
+    retried = n8n.process_message(message("hola"), TOKENS, SEND_DATA, phone="5959810001", external_id="WA1")
+    assert retried["success"] and retried["duplicate"]
+    assert retried["session_id"] == first["session_id"]
+    assert [m["content"] for m in retried["conversation"]["message"]] == ["hola"]
+
+    consumer.process_messages([payload_to_message(payload("otro", "WA2"))])
+    assert stored_messages(n8n, first["session_id"]) == ["hola", "otro"]
+
+
+def test_failed_write_releases_the_inbound_key(make_bot):
+    bot = make_bot()
+    results = bot.process_messages([{**payload_to_message(payload("hola", "WA1")), "tokens": None}])
+    assert not results[0]["success"]
+    assert bot.process_message(message("hola"), TOKENS, SEND_DATA, phone="5959810001", external_id="WA1").get("duplicate") is None
+
+
+def test_consumer_persists_and_acks_stream_entries(redis_client, monkeypatch):
+    from controller.core_bot import CoreBot
+    client = redis_client
+    stream = f"test:inbound:{uuid.uuid4().hex}"
+    monkeypatch.setenv("STORAGE_BACKEND", "memory")
+    monkeypatch.setenv("LIVE_UPDATES_SOURCE", "off")
+    monkeypatch.delenv("WRITE_BEHIND_MODE", raising=False)
+    bot = CoreBot()
+    bot.warm_up()
+    consumer = WhatsappStreamConsumer(bot, client, stream=stream, group="test", consumer="c1", block_ms=100)
+    consumer.ensure_group()
+    client.xadd(stream, {"payload": json.dumps(payload("hola", "WA1"))})
+    client.xadd(stream, {"payload": "no es json"})
+
+    assert consumer.run_once() == 2
+    assert client.xpending(stream, "test")["pending"] == 0
+    session = bot.transmitter_module.get_latest_session("phone", "5959810001")
+    assert stored_messages(bot, session["session_id"]) == ["hola"]
+    bot.close()
+    client.delete(stream)
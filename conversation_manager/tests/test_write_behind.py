@@ -0,0 +1,130 @@
+import json
+import subprocess
+import sys
+import textwrap
+import threading
+from pathlib import Path
+
+from tests.helpers import TOKENS, SEND_DATA, message, stored_messages
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# El proceso termina sin cerrar la cola: los mensajes encolados se escriben en atexit, antes de
+# cerrar el cliente Mongo (un MongoClient cerrado rechaza las escrituras).
+EXIT_SCRIPT = textwrap.dedent("""
+    import json, os, sys
+    sys.path.insert(0, {root!r})
+    # mismo orden que app.py: CoreBot (y la cola) se importan antes que configs.config
+    from controller.core_bot import CoreBot
+    import mongomock
+    from tests.conftest import _patch_mongomock
+    from configs.config import set_mongo_client
+    _patch_mongomock(mongomock)
+    state = {{"closed": False}}
+
+    class Client(mongomock.MongoClient):
+        def close(self):
+            state["closed"] = True
+            super().close()
+
+    client = Client(tz_aware=True)
+    client[os.environ["DB_MONGO_NAME"]].create_collection("conversation_archive")
+    set_mongo_client(client)
+    bot = CoreBot()
+    write = bot.conversation_module.bulk_write_messages
+
+    def bulk_write_messages(created, appends):
+        if state["closed"]:
+            raise RuntimeError("Cannot use MongoClient after close")
+        ok = write(created, appends)
+        print(json.dumps({{"written": sum(len(v) for v in appends.values()), "ok": ok}}), flush=True)
+        return ok
+
+    bot.conversation_module.bulk_write_messages = bulk_write_messages
+    tokens = {{"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}}
+    send_data = {{"audio": None, "image": None, "location": None, "document": None, "video": None}}
+    for i in range(4):
+        result = bot.process_message({{"role": "user", "text": f"mensaje {{i}}"}}, tokens, send_data, phone="+5491100000009")
+        assert result["success"], result
+""")
+
+
+def test_queued_messages_are_written_before_the_client_closes(tmp_path):
+    env = {
+        "PATH": "",
+        "DB_MONGO_NAME": "test_write_behind_exit",
+        "WRITE_BEHIND_MODE": "provisional",
+        # nada se escribe antes de salir: todo queda para el drenado en atexit
+        "WRITE_BEHIND_MAX_DELAY_MS": "60000",
+        "LIVE_UPDATES_SOURCE": "off",
+        "PROMETHEUS_MULTIPROC_DIR": "",
+    }
+    result = subprocess.run([sys.executable, "-c", EXIT_SCRIPT.format(root=str(ROOT))], cwd=tmp_path, env=env, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    writes = [json.loads(line) for line in result.stdout.splitlines() if line.startswith("{")]
+    assert writes == [{"written": 3, "ok": True}], result.stderr
+
+
+def test_write_behind_is_drained_on_close(monkeypatch, make_bot):
+    monkeypatch.setenv("WRITE_BEHIND_MODE", "provisional")
+    # los lotes sólo se escriben al cerrar
+    monkeypatch.setenv("WRITE_BEHIND_MAX_DELAY_MS", "60000")
+    bot = make_bot()
+    created = bot.process_message(message("m0"), TOKENS, SEND_DATA, phone="+5491100000300")
+    session_id = created["session_id"]
+    for i in range(1, 6):
+        assert bot.process_message(message(f"m{i}"), TOKENS, SEND_DATA, phone="+5491100000300")["success"]
+    assert bot.write_behind.stats()["queued"] == 5
+
+    bot.close(timeout=10)
+    assert bot.write_behind.stats()["queued"] == 0
+    assert stored_messages(bot, session_id) == [f"m{i}" for i in range(6)]
+
+
+def test_durable_timeout_withdraws_the_queued_message(monkeypatch, make_bot):
+    monkeypatch.setenv("WRITE_BEHIND_MODE", "durable")
+    monkeypatch.setenv("WRITE_BEHIND_MAX_DELAY_MS", "60000")
+    monkeypatch.setenv("WRITE_BEHIND_DURABLE_TIMEOUT", "0.05")
+    bot = make_bot()
+    session_id = bot.process_message(message("m0"), TOKENS, SEND_DATA, phone="+5491100000301")["session_id"]
+    result = bot.process_message(message("m1"), TOKENS, SEND_DATA, phone="+5491100000301")
+    assert not result["success"]
+
+    # el reintento del cliente no duplica el mensaje fallido
+    assert bot.process_message(message("m1"), TOKENS, SEND_DATA, phone="+5491100000301", ack="provisional")["success"]
+    bot.close(timeout=10)
+    assert stored_messages(bot, session_id) == ["m0", "m1"]
+
+
+def test_durable_timeout_while_writing_reports_pending(monkeypatch, make_bot):
+    monkeypatch.setenv("WRITE_BEHIND_MODE", "durable")
+    monkeypatch.setenv("WRITE_BEHIND_MAX_DELAY_MS", "0")
+    monkeypatch.setenv("WRITE_BEHIND_DURABLE_TIMEOUT", "0.05")
+    bot = make_bot()
+    session_id = bot.process_message(message("m0"), TOKENS, SEND_DATA, phone="+5491100000302")["session_id"]
+    release = threading.Event()
+    write = bot.conversation_module.bulk_write_messages
+
+    def slow_bulk_write(created, appends):
+        release.wait(10)
+        return write(created, appends)
+    monkeypatch.setattr(bot.conversation_module, "bulk_write_messages", slow_bulk_write)
+    result = bot.process_message(message("m1"), TOKENS, SEND_DATA, phone="+5491100000302")
+    assert result["success"] and result["pending"] and not result["durable"]
+    assert result["message_id"]
+
+    release.set()
+    bot.close(timeout=10)
+    assert stored_messages(bot, session_id) == ["m0", "m1"]
+
+
+def test_batch_appends_keep_order_behind_queued_messages(monkeypatch, make_bot):
+    monkeypatch.setenv("WRITE_BEHIND_MODE", "provisional")
+    monkeypatch.setenv("WRITE_BEHIND_MAX_DELAY_MS", "50")
+    bot = make_bot()
+    session_id = bot.process_message(message("m0"), TOKENS, SEND_DATA, phone="+5491100000303")["session_id"]
+    for i in (1, 2):
+        assert bot.process_message(message(f"m{i}"), TOKENS, SEND_DATA, phone="+5491100000303")["success"]
+    results = bot.process_messages([{"content": message("m3"), "tokens": TOKENS, "send_data": SEND_DATA, "phone": "+5491100000303"}])
+    assert results[0]["success"] and results[0]["session_id"] == session_id
+    assert stored_messages(bot, session_id) == ["m0", "m1", "m2", "m3"]
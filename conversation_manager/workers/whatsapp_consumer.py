@@ -0,0 +1,202 @@
+"""
+Consumidor de mensajes entrantes de WhatsApp directamente desde Redis, sin pasar por n8n.
+
+Modo `stream` (recomendado): lee del Redis Stream que publica el servicio whatsapp
+(REDIS_INBOUND_STREAM) con un consumer group, de modo que varios workers se reparten la carga.
+Cada lote se persiste con `CoreBot.process_messages` y sólo se confirma (XACK) lo que se guardó;
+lo pendiente de un consumidor caído se reclama con XAUTOCLAIM tras WHATSAPP_CLAIM_IDLE_MS.
+
+Modo `pubsub`: se suscribe al canal `whatsapp_platia` (fire-and-forget, sin reintentos).
+
+Puede convivir con el flujo de n8n, que también persiste cada mensaje entrante con
+/api/process_message: ambos caminos envían el id del mensaje de WhatsApp como `external_id` y sólo
+el primero lo escribe (el otro recibe "duplicate": True con el historial ya guardado).
+
+Uso:
+    python workers/whatsapp_consumer.py [--mode stream|pubsub]
+
+Variables de entorno:
+    REDIS_HOST, REDIS_PORT, REDIS_PASSWORD
+    WHATSAPP_INBOUND_STREAM (whatsapp_platia:inbound), WHATSAPP_CHANNEL (whatsapp_platia)
+    WHATSAPP_CONSUMER_GROUP (conversation_manager), WHATSAPP_CONSUMER_NAME (<hostname>-<pid>)
+    WHATSAPP_BATCH_SIZE (100), WHATSAPP_BLOCK_MS (5000), WHATSAPP_CLAIM_IDLE_MS (60000)
+"""
+import argparse
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+logger = logging.getLogger(__name__)
+
+SEND_DEFAULT = {"audio": None, "image": None, "location": None, "document": None, "video": None}
+TOKENS_DEFAULT = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+# errores transitorios de CoreBot.process_messages: la entrada queda pendiente para reintento
+RETRYABLE_ERRORS = {"bulk write failed", "failed to register session"}
+
+
+def payload_to_message(payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Convierte el payload publicado por whatsapp/index.js
+    ({"transmitter": "whatsapp", "phone", "name", "message", "send", "message_id"}) en los
+    argumentos de `CoreBot.process_message`. Devuelve None si no es un mensaje entrante válido.
+    """
+    if not isinstance(payload, dict) or payload.get("transmitter") != "whatsapp" or not payload.get("phone"):
+        return None
+    send = payload.get("send") if isinstance(payload.get("send"), dict) else {}
+    return {
+        "content": {"role": "user", "text": payload.get("message") or ""},
+        "tokens": dict(TOKENS_DEFAULT),
+        "send_data": {**SEND_DEFAULT, **{k: v for k, v in send.items() if k in SEND_DEFAULT}},
+        "phone": str(payload["phone"]),
+        "external_id": payload.get("message_id"),
+    }
+
+
+class WhatsappStreamConsumer:
+    def __init__(self, bot, client, stream: str, group: str, consumer: str, batch_size: int = 100, block_ms: int = 5000, claim_idle_ms: int = 60000):
+        self.bot = bot
+        self.client = client
+        self.stream = stream
+        self.group = group
+        self.consumer = consumer
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self.claim_idle_ms = claim_idle_ms
+        self.running = True
+
+    def ensure_group(self):
+        """Crea el consumer group (y el stream) si no existen."""
+        import redis
+        try:
+            self.client.xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def process_entries(self, entries) -> int:
+        """
+        Persiste un lote de entradas [(entry_id, {b"payload": ...}), ...] y confirma las procesadas.
+        Las entradas inválidas se confirman (no tiene sentido reintentarlas); las que fallan al
+        escribir quedan pendientes para reintento.
+        """
+        if not entries:
+            return 0
+        ack_ids: List[Any] = []
+        batch, batch_ids = [], []
+        for entry_id, fields in entries:
+            raw = fields.get(b"payload") or fields.get("payload")
+            try:
+                message = payload_to_message(json.loads(raw))
+            except (TypeError, ValueError):
+                message = None
+            if message is None:
+                logger.warning("[WHATSAPP_CONSUMER]: entrada inválida descartada: %s", entry_id)
+                ack_ids.append(entry_id)
+                continue
+            batch.append(message)
+            batch_ids.append(entry_id)
+        if batch:
+            for entry_id, result in zip(batch_ids, self.bot.process_messages(batch)):
+                if result.get("success") or result.get("error") not in RETRYABLE_ERRORS:
+                    ack_ids.append(entry_id)
+        if ack_ids:
+            self.client.xack(self.stream, self.group, *ack_ids)
+        return len(ack_ids)
+
+    def claim_stale(self) -> int:
+        """Reclama y procesa entradas pendientes de consumidores caídos o de intentos fallidos."""
+        start, processed = "0-0", 0
+        while True:
+            reply = self.client.xautoclaim(self.stream, self.group, self.consumer, self.claim_idle_ms, start_id=start, count=self.batch_size)
+            start, entries = reply[0], reply[1]
+            processed += self.process_entries(entries)
+            if start in (b"0-0", "0-0") or not entries:
+                return processed
+
+    def run_once(self) -> int:
+        reply = self.client.xreadgroup(self.group, self.consumer, {self.stream: ">"}, count=self.batch_size, block=self.block_ms)
+        processed = 0
+        for _, entries in reply or []:
+            processed += self.process_entries(entries)
+        return processed
+
+    def run(self):
+        self.ensure_group()
+        self.claim_stale()
+        logger.info("[WHATSAPP_CONSUMER]: consumiendo %s (grupo %s, consumidor %s)", self.stream, self.group, self.consumer)
+        idle_rounds = 0
+        while self.running:
+            if self.run_once() == 0:
+                idle_rounds += 1
+                # en periodos sin tráfico, revisar pendientes de otros consumidores
+                if idle_rounds * self.block_ms >= self.claim_idle_ms:
+                    self.claim_stale()
+                    idle_rounds = 0
+
+    def stop(self, *_):
+        self.running = False
+
+
+def run_pubsub(bot, client, channel: str):
+    pubsub = client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(channel)
+    logger.info("[WHATSAPP_CONSUMER]: suscrito al canal %s", channel)
+    for item in pubsub.listen():
+        try:
+            message = payload_to_message(json.loads(item["data"]))
+        except (TypeError, ValueError):
+            message = None
+        # el canal también transporta las respuestas salientes de n8n: se ignoran
+        if message is not None:
+            bot.process_message(**message)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Consume mensajes entrantes de WhatsApp desde Redis.")
+    parser.add_argument("--mode", choices=("stream", "pubsub"), default=os.getenv("WHATSAPP_CONSUMER_MODE", "stream"))
+    args = parser.parse_args()
+
+    import redis
+    from configs.logging_config import configure_logging
+    from controller.core_bot import CoreBot
+
+    configure_logging()
+
+    client = redis.Redis(
+        host=os.getenv("REDIS_HOST", "localhost"),
+        port=int(os.getenv("REDIS_PORT", 6379)),
+        password=os.getenv("REDIS_PASSWORD") or None
+    )
+    bot = CoreBot()
+    warm_up = bot.warm_up()
+    if not warm_up["unique_identifiers"]:
+        logger.error("[WHATSAPP_CONSUMER]: faltan los índices únicos de contactos; ejecutar scripts/dedupe_transmitters.py")
+    elif not warm_up["ready"]:
+        logger.warning("[WHATSAPP_CONSUMER]: la base no respondió en el warm-up; se reintentará al procesar")
+    if args.mode == "pubsub":
+        run_pubsub(bot, client, os.getenv("WHATSAPP_CHANNEL", "whatsapp_platia"))
+        return
+
+    consumer = WhatsappStreamConsumer(
+        bot,
+        client,
+        stream=os.getenv("WHATSAPP_INBOUND_STREAM", "whatsapp_platia:inbound"),
+        group=os.getenv("WHATSAPP_CONSUMER_GROUP", "conversation_manager"),
+        consumer=os.getenv("WHATSAPP_CONSUMER_NAME", f"{socket.gethostname()}-{os.getpid()}"),
+        batch_size=int(os.getenv("WHATSAPP_BATCH_SIZE", 100)),
+        block_ms=int(os.getenv("WHATSAPP_BLOCK_MS", 5000)),
+        claim_idle_ms=int(os.getenv("WHATSAPP_CLAIM_IDLE_MS", 60000)),
+    )
+    signal.signal(signal.SIGTERM, consumer.stop)
+    signal.signal(signal.SIGINT, consumer.stop)
+    consumer.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -28,6 +28,9 @@ app.listen(PORT, () => {
 });
 
 const REDIS_CHANNEL = 'whatsapp_platia';
+// Stream opcional para entrega confiable a conversation_manager (workers/whatsapp_consumer.py)
+const REDIS_INBOUND_STREAM = process.env.REDIS_INBOUND_STREAM || '';
+const REDIS_INBOUND_STREAM_MAXLEN = parseInt(process.env.REDIS_INBOUND_STREAM_MAXLEN || '100000', 10);
 
 
 async function connectToWhatsApp () {
@@ -128,13 +131,23 @@ async function connectToWhatsApp () {
                 phone,
                 name,
                 message: mensaje,
-                send
+                send,
+                // id del mensaje en WhatsApp: conversation_manager lo usa para no persistirlo dos veces (n8n y consumidor)
+                message_id: msgObj.key.id
             };
             // Guardar últimos mensajes recibidos para el endpoint HTTP
             ultimosMensajes.unshift({ phone, name, message: mensaje, fecha: new Date().toISOString() });
             if (ultimosMensajes.length > 20) ultimosMensajes.length = 20;
             console.log(`[Mensaje]: Mensaje recibido por ${phone} y enviado a ${REDIS_CHANNEL} date: ${new Date().toISOString()}`);
-            await redisPub.publish(REDIS_CHANNEL, JSON.stringify(payload));
+            const serialized = JSON.stringify(payload);
+            await redisPub.publish(REDIS_CHANNEL, serialized);
+            if (REDIS_INBOUND_STREAM) {
+                try {
+                    await redisPub.xadd(REDIS_INBOUND_STREAM, 'MAXLEN', '~', REDIS_INBOUND_STREAM_MAXLEN, '*', 'payload', serialized);
+                } catch (e) {
+                    console.error(`[Redis]: Error agregando mensaje al stream ${REDIS_INBOUND_STREAM}:`, e);
+                }
+            }
         }
     });
 